@@ -0,0 +1,172 @@
+"""HTTP throughput benchmark: Flask's development server, waitress and the unified server side by side.
+
+For each server mode, starts enhanced_pacemaker_server's app in a child
+process on the simulated input backend, then for each client count runs
+that many client threads polling the endpoints the web app polls, each on
+its own connection (kept alive when the server allows it). Requests/s and
+latency per mode are printed as a table and written as JSON:
+
+    python3 benchmark_http.py --servers dev,waitress,unified --clients 1,8,32 --duration 5
+
+The clients run in this process and the server in its own, so the server
+has a core to itself only on a multi-core machine; compare modes on the
+same machine rather than absolute numbers across machines.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def serve(mode, port, threads):
+    """Child process: serve the app with the given server until killed"""
+    os.environ.setdefault('PACEMAKER_INPUT_BACKEND', 'sim')
+    os.environ.setdefault('PACEMAKER_HISTORY_DIR', '')
+    os.environ.setdefault('PACEMAKER_LOG_LEVEL', 'warning')
+    import logging
+    import pacemaker_http
+    import enhanced_pacemaker_server as server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)  # Queueing is expected under load
+    if mode == 'unified':
+        server.HTTP_PORT = port
+        server.WS_PORT = port + 1
+        pacemaker_http.THREADS = threads
+        server.run_unified_server()
+    else:
+        pacemaker_http.serve(server.app, '127.0.0.1', port, mode, threads)
+
+
+def start_server(mode, port, threads):
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode,
+                              '--port', str(port), '--threads', str(threads)],
+                             stdout=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return child
+        except OSError:
+            if child.poll() is not None:
+                break
+            time.sleep(0.1)
+    child.kill()
+    raise RuntimeError(f'{mode} server did not start on port {port}')
+
+
+def client(port, paths, stop, latencies, errors):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    index = 0
+    while not stop.is_set():
+        path = paths[index % len(paths)]
+        index += 1
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            connection.close()
+            continue
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def run_case(mode, port, clients, args):
+    paths = args.paths.split(',')
+    stop = threading.Event()
+    latency_lists = [[] for _ in range(clients)]
+    errors = []
+    threads = [threading.Thread(target=client, args=(port, paths, stop, latencies, errors))
+               for latencies in latency_lists]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=15)
+
+    latencies = sorted(latency for latencies in latency_lists for latency in latencies)
+    result = {
+        'server': mode,
+        'clients': clients,
+        'requests': len(latencies),
+        'requests_per_s': round(len(latencies) / args.duration, 1),
+        'errors': len(errors),
+    }
+    if latencies:
+        result.update({
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+        })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--servers', default='dev,waitress,unified',
+                        help='any of dev, waitress and unified (default: all three)')
+    parser.add_argument('--clients', default='1,8,32', help='comma-separated client counts (default 1,8,32)')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per run (default 5)')
+    parser.add_argument('--paths', default='/api/health,/api/health,/api/health,/api/sensitivity,/api/lock',
+                        help="endpoints each client cycles through (default: the web app's polling mix)")
+    parser.add_argument('--threads', type=int, default=16, help='waitress/unified worker threads (default 16)')
+    parser.add_argument('--port', type=int, default=5910)
+    parser.add_argument('--output', default='benchmark_http.json', help='where to write the results')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.threads)
+        return
+
+    results = []
+    for mode in args.servers.split(','):
+        child = start_server(mode, args.port, args.threads)
+        try:
+            for clients in (int(count) for count in args.clients.split(',')):
+                results.append(run_case(mode, args.port, clients, args))
+        finally:
+            child.terminate()
+            child.wait()
+
+    print(f"{'server':<10}{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for result in results:
+        print(f"{result['server']:<10}{result['clients']:>8}{result['requests_per_s']:>10}"
+              f"{result.get('p50_ms', '-'):>10}{result.get('p99_ms', '-'):>10}{result['errors']:>8}")
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'commit': git_commit(),
+            'timestamp': time.time(),
+            'config': {'duration_s': args.duration, 'paths': args.paths, 'threads': args.threads},
+            'results': results,
+        }, output, indent=2)
+    print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
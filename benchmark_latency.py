@@ -0,0 +1,273 @@
+"""End-to-end latency benchmark: simulated encoder detent -> value seen by a client.
+
+Runs enhanced_pacemaker_server in-process on the simulated input backend,
+turns the rate encoder at a fixed rate and, for each client count, connects
+that many WebSocket clients and /api/health pollers. --server picks how the
+server is run: unified (the default, as the server runs normally: HTTP and
+WebSocket on one port and one event loop) or dev (Werkzeug's development
+server for HTTP, WebSocket on its own port). Every time a client
+sees a new rate value, the time since the detent that produced it is one
+latency sample. Results (p50/p95/p99, throughput, CPU) are written as JSON
+so runs can be compared across commits:
+
+    python3 benchmark_latency.py --clients 1,10,50 --duration 5 --output bench.json
+    python3 benchmark_latency.py --server dev --output bench-dev.json
+
+CPU is the whole process (server and benchmark clients) over the run.
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import http.client
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('PACEMAKER_INPUT_BACKEND', 'sim')
+# Record history as the server normally does, but not into the checkout
+_history_dir = tempfile.TemporaryDirectory(prefix='pacemaker-bench-history-')
+os.environ.setdefault('PACEMAKER_HISTORY_DIR', _history_dir.name)
+
+import websockets
+from werkzeug.serving import make_server
+
+import pacemaker_hardware as hardware
+import enhanced_pacemaker_server as server
+
+# Rate sweep for the injected detents: up from LOW to HIGH and back, one ppm per detent
+SWEEP_LOW = 60
+SWEEP_HIGH = 140
+
+# The sweep predicts the value each detent produces, so turn encoder
+# acceleration off: every detent moves the rate exactly one ppm
+server.rate_detents.curve = ()
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class InjectionLog:
+    """When each rate value was last produced by a detent"""
+
+    def __init__(self):
+        self.times = collections.defaultdict(list)
+
+    def record(self, value, when):
+        self.times[value].append(when)
+
+    def latency(self, value, seen):
+        """Time from the latest detent that produced value before seen, or None"""
+        times = self.times.get(value)
+        if not times:
+            return None
+        position = bisect.bisect_right(times, seen)
+        if position == 0:
+            return None
+        return seen - times[position - 1]
+
+
+def inject_detents(log, rate, duration):
+    """Turn the rate encoder at rate detents per second; returns the number of detents"""
+    value = server.pacemaker_state.rate
+    direction = 1
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    count = 0
+    while time.perf_counter() - start < duration:
+        delay = start + count * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if value >= SWEEP_HIGH:
+            direction = -1
+        elif value <= SWEEP_LOW:
+            direction = 1
+        value += direction
+        log.record(value, time.perf_counter())
+        hardware.rotate('rate', direction)
+        count += 1
+    return count
+
+
+async def websocket_client(uri, seen, connected, stop):
+    async with websockets.connect(uri, max_size=None) as ws:
+        last = None
+        while not stop.is_set():
+            try:
+                message = await asyncio.wait_for(ws.recv(), timeout=0.2)
+            except asyncio.TimeoutError:
+                continue
+            now = time.perf_counter()
+            message = json.loads(message)
+            if message['type'] == 'snapshot':
+                last = message['state']['rate']
+                connected.release()
+            elif message['type'] == 'delta':
+                rate = message['changes'].get('rate', last)
+                if rate != last:
+                    seen.append((now, rate))
+                    last = rate
+
+
+def run_websocket_clients(port, seen_lists, connected, stop):
+    async def main():
+        uri = f'ws://127.0.0.1:{port}/'
+        await asyncio.gather(*(websocket_client(uri, seen, connected, stop) for seen in seen_lists))
+
+    asyncio.run(main())
+
+
+def health_poller(port, interval, seen, connected, stop):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    last = None
+    first = True
+    while not stop.is_set():
+        connection.request('GET', '/api/health')
+        response = connection.getresponse()
+        body = json.loads(response.read())
+        now = time.perf_counter()
+        if first:
+            first = False
+            connected.release()
+        elif body['rate'] != last:
+            seen.append((now, body['rate']))
+        last = body['rate']
+        time.sleep(interval)
+    connection.close()
+
+
+def run_case(transport, clients, args):
+    """Benchmark one transport with one client count; returns the result record"""
+    # Start every run from the same place
+    server.state_commands.call('reset_rate', server.reset_rate)
+    log = InjectionLog()
+    seen_lists = [[] for _ in range(clients)]
+    connected = threading.Semaphore(0)
+    stop = threading.Event()
+
+    if transport == 'ws':
+        # The unified server takes WebSocket upgrades on the HTTP port too
+        ws_port = args.http_port if args.server == 'unified' else args.ws_port
+        threads = [threading.Thread(target=run_websocket_clients,
+                                    args=(ws_port, seen_lists, connected, stop))]
+    else:
+        threads = [threading.Thread(target=health_poller,
+                                    args=(args.http_port, args.poll_interval, seen, connected, stop))
+                   for seen in seen_lists]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for _ in range(clients):
+        if not connected.acquire(timeout=10):
+            raise RuntimeError(f'{transport} clients did not connect')
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    detents = inject_detents(log, args.rate, args.duration)
+    time.sleep(args.settle)
+    stop.set()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    for thread in threads:
+        thread.join(timeout=5)
+
+    latencies = sorted(
+        latency for seen in seen_lists for when, value in seen
+        if (latency := log.latency(value, when)) is not None
+    )
+    received = sum(len(seen) for seen in seen_lists)
+    result = {
+        'transport': transport,
+        'clients': clients,
+        'detents': detents,
+        'detents_per_s': round(detents / args.duration, 1),
+        'updates_received': received,
+        'updates_per_s': round(received / wall, 1),
+        'samples': len(latencies),
+        'cpu_percent': round(100 * cpu / wall, 1),
+    }
+    if latencies:
+        result.update({
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+        })
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', default='1,10,50', help='comma-separated client counts (default 1,10,50)')
+    parser.add_argument('--transports', default='ws,http', help='ws, http or both (default ws,http)')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of input per run (default 5)')
+    parser.add_argument('--rate', type=float, default=100.0, help='detents per second (default 100)')
+    parser.add_argument('--poll-interval', type=float, default=0.1,
+                        help='seconds between /api/health polls, as the web app does (default 0.1)')
+    parser.add_argument('--settle', type=float, default=0.5, help='seconds to wait for stragglers (default 0.5)')
+    parser.add_argument('--server', default='unified', choices=('unified', 'dev'),
+                        help='unified single-port server or the development server (default unified)')
+    parser.add_argument('--ws-port', type=int, default=5901)
+    parser.add_argument('--http-port', type=int, default=5900)
+    parser.add_argument('--output', default='benchmark_latency.json', help='where to write the results')
+    parser.add_argument('--verbose', action='store_true', help="keep the server's log output")
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    report = sys.stdout
+    if not args.verbose:
+        # The server logs every change; keep that out of the measurement
+        sys.stdout = open(os.devnull, 'w')
+
+    server.WS_PORT = args.ws_port
+    http_server = None
+    if args.server == 'unified':
+        server.HTTP_PORT = args.http_port
+        threading.Thread(target=server.run_unified_server, daemon=True).start()
+    else:
+        threading.Thread(target=server.run_websocket_server, daemon=True).start()
+        http_server = make_server('127.0.0.1', args.http_port, server.app, threaded=True)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    time.sleep(0.5)
+
+    results = []
+    for transport in args.transports.split(','):
+        for clients in (int(count) for count in args.clients.split(',')):
+            result = run_case(transport, clients, args)
+            results.append(result)
+            print(json.dumps(result), file=report)
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'commit': git_commit(),
+            'timestamp': time.time(),
+            'backend': hardware.BACKEND,
+            'config': {
+                'server': args.server,
+                'duration_s': args.duration,
+                'detent_rate': args.rate,
+                'poll_interval_s': args.poll_interval,
+            },
+            'results': results,
+        }, output, indent=2)
+    print(f'Wrote {args.output}', file=report)
+    if http_server is not None:
+        http_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
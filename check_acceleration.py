@@ -0,0 +1,93 @@
+"""Check encoder acceleration against the ENCODER_ACCELERATION curves on the simulated backend.
+
+Runs enhanced_pacemaker_server in-process with PACEMAKER_INPUT_BACKEND=sim,
+turns the rate and V. output encoders with hardware.rotate(name, detents,
+interval) and compares the resulting values with what the curves give.
+The sim clock only moves by the intervals given, so the results are the
+same on every machine:
+
+    python3 check_acceleration.py
+
+Exits with status 1 if any case fails.
+"""
+import os
+import sys
+
+os.environ['PACEMAKER_INPUT_BACKEND'] = 'sim'
+os.environ['PACEMAKER_HISTORY_DIR'] = ''  # Nothing to record
+os.environ.setdefault('PACEMAKER_LOG_LEVEL', 'warning')
+
+import pacemaker_hardware as hardware
+import enhanced_pacemaker_server as server
+
+# Long enough that the first detent of a turn never counts as fast
+PAUSE = 10.0
+
+
+def turn(name, detents, interval):
+    """Pause, turn name by detents interval seconds apart, and wait until they are applied"""
+    hardware.advance(PAUSE)
+    hardware.rotate(name, detents, interval)
+    # The drain was queued before this, so once it has run the state is final
+    server.state_commands.call('check', lambda: None)
+
+
+def set_state(**fields):
+    server.state_commands.call('check', lambda: server.pacemaker_state.update(**fields))
+
+
+def rate_after(start, detents, interval):
+    set_state(rate=start)
+    turn('rate', detents, interval)
+    return server.pacemaker_state.rate
+
+
+def v_output_after(start, detents, interval):
+    set_state(v_output=start)
+    turn('v_output', detents, interval)
+    return server.pacemaker_state.v_output
+
+
+def replayed_rate(start, detents, rate):
+    set_state(rate=start)
+    hardware.advance(PAUSE)
+    hardware.replay(hardware.spin_trace('rate', detents), rate)
+    server.state_commands.call('check', lambda: None)
+    return server.pacemaker_state.rate
+
+
+def main():
+    set_state(is_locked=False)
+    ladder = server.V_OUTPUT_LADDER
+    cases = [
+        # (description, got, expected)
+        ('rate: slow turn moves one ppm per detent', rate_after(80, 5, 0.5), 85),
+        ('rate: 10 fast detents (5 rungs after the first)', rate_after(80, 10, 0.01), 126),
+        ('rate: 10 detents 40 ms apart (3 rungs after the first)', rate_after(80, 10, 0.04), 108),
+        ('rate: 10 detents 80 ms apart (2 rungs after the first)', rate_after(80, 10, 0.08), 99),
+        ('rate: fast turn down', rate_after(126, -10, 0.01), 80),
+        ('rate: clamped at the maximum', rate_after(190, 10, 0.01), server.max_rate),
+        ('rate: replayed at 100 detents/s', replayed_rate(80, 10, 100), 126),
+        ('v_output: slow turn moves one rung per detent', v_output_after(0.0, 3, 0.5), ladder.step(0.0, 3)),
+        ('v_output: 5 fast detents (3 rungs after the first)', v_output_after(0.0, 5, 0.02), ladder.step(0.0, 13)),
+    ]
+
+    # A change of direction right after a fast turn is a fine adjustment
+    set_state(rate=80)
+    turn('rate', 10, 0.01)
+    hardware.advance(0.01)
+    hardware.rotate('rate', -1)
+    server.state_commands.call('check', lambda: None)
+    cases.append(('rate: reversing after a fast turn moves one ppm', server.pacemaker_state.rate, 125))
+
+    failed = 0
+    for description, got, expected in cases:
+        ok = got == expected
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {description}: {got}" + ('' if ok else f' (expected {expected})'))
+    print(f'{len(cases) - failed}/{len(cases)} passed')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Check the button event log and /api/events on the simulated backend.
+
+Runs enhanced_pacemaker_server in-process with PACEMAKER_INPUT_BACKEND=sim
+and checks EventLog.since() and the /api/events route on edge cases: cursors
+that are negative, ahead of the log or fallen out of the ring, and bad
+query parameters:
+
+    python3 check_events.py
+
+Exits with status 1 if any case fails.
+"""
+import os
+import sys
+
+os.environ['PACEMAKER_INPUT_BACKEND'] = 'sim'
+os.environ['PACEMAKER_HISTORY_DIR'] = ''  # Nothing to record
+os.environ.setdefault('PACEMAKER_LOG_LEVEL', 'warning')
+
+import pacemaker_events
+import enhanced_pacemaker_server as server
+
+
+def cursors(result):
+    events, next_cursor, missed = result
+    return [event['cursor'] for event in events], next_cursor, missed
+
+
+def main():
+    log = pacemaker_events.EventLog(4)
+    empty = cursors(log.since(0))
+    for _ in range(6):
+        log.append('up')
+
+    client = server.app.test_client()
+    server.button_events.append('up')
+
+    def status(query):
+        return client.get('/api/events' + query).status_code
+
+    cases = [
+        # (description, got, expected)
+        ('since on an empty log', empty, ([], 0, 0)),
+        ('since(4): the events after it', cursors(log.since(4)), ([5, 6], 6, 0)),
+        ('since(0): the ring, and how many fell out', cursors(log.since(0)), ([3, 4, 5, 6], 6, 2)),
+        ('since ahead of the log counts as 0', cursors(log.since(99)), ([3, 4, 5, 6], 6, 2)),
+        ('negative since counts as 0', cursors(log.since(-3)), ([3, 4, 5, 6], 6, 2)),
+        ('limit below 1 counts as 1', cursors(log.since(4, -1)), ([5], 5, 0)),
+        ('/api/events?since=0', status('?since=0'), 200),
+        ('/api/events?since=-3 is rejected', status('?since=-3'), 400),
+        ('/api/events?limit=0 is rejected', status('?since=0&limit=0'), 400),
+        ('/api/events?limit=-1 is rejected', status('?since=0&limit=-1'), 400),
+        ('/api/events events are never null',
+         None in client.get('/api/events?since=0').get_json()['events'], False),
+    ]
+
+    failed = 0
+    for description, got, expected in cases:
+        ok = got == expected
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {description}: {got}" + ('' if ok else f' (expected {expected})'))
+    print(f'{len(cases) - failed}/{len(cases)} passed')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
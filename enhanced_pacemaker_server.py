@@ -1,46 +1,169 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
-from gpiozero import RotaryEncoder, Button, LED
+import pacemaker_hardware as hardware
+import pacemaker_buttons
+import pacemaker_events
+import pacemaker_http
+import pacemaker_log
+import pacemaker_metrics as metrics
+import pacemaker_recorder
 import time
 import json
 import threading
-import socket
+import asyncio
+import collections
 import base64
+import bisect
 import hashlib
+import os
+import queue
 import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+CORS(app, expose_headers=['X-State-Version'])  # Enable CORS for all routes
 
-# WebSocket server configuration
+# Server configuration. The unified server (the default) answers REST, WebSocket
+# upgrades and the SSE stream on HTTP_PORT from one asyncio loop; WS_PORT is
+# kept open for WebSocket clients that still connect there
+HTTP_PORT = 5000
 WS_PORT = 5001
+HTTP_SERVER = os.environ.get('PACEMAKER_HTTP_SERVER', 'unified')
+HTTP_KEEP_ALIVE_TIMEOUT = 60.0  # seconds an idle connection waits for its next request
+HTTP_MAX_BODY_SIZE = 1024 * 1024  # bytes
 connected_clients = []
+stream_clients = []  # /api/stream (SSE) connections served by the unified server
+ws_loop = None  # asyncio loop that owns the WebSocket connections
+wsgi_executor = None  # Threads the Flask app runs on under the unified server
+
+# Per-client send limits: frames queued before a client counts as lagging,
+# how long one write may stall before the client is dropped, and the
+# transport buffer size above which writes wait
+WS_SEND_QUEUE_DEPTH = 32
+WS_SEND_TIMEOUT = 5.0  # seconds
+WS_WRITE_BUFFER_HIGH = 16 * 1024  # bytes
+
+# Largest message (after reassembling fragments) accepted from a client
+WS_MAX_MESSAGE_SIZE = 1024 * 1024  # bytes
+
+# permessage-deflate: accept clients' offers to compress messages, keeping the
+# compression context between messages unless they ask otherwise. Frames
+# smaller than the threshold (heartbeats, binary state) go out uncompressed
+WS_DEFLATE = True
+WS_DEFLATE_THRESHOLD = 64  # bytes
+
+# Broadcast scheduling: wait this long after a change so a burst of detents
+# goes out as one frame, and send a heartbeat when nothing has changed
+BROADCAST_COALESCE_WINDOW = 0.005  # seconds
+BROADCAST_HEARTBEAT_INTERVAL = 5.0  # seconds
+
+# HTTP push: how long a /api/state?since= long poll is held, and how often
+# an idle /api/stream sends a keepalive comment
+LONG_POLL_TIMEOUT = 25.0  # seconds
+SSE_KEEPALIVE_INTERVAL = 15.0  # seconds
+
+# Button presses kept for /api/events; a client further behind than this
+# many presses is told how many it missed
+BUTTON_EVENT_BUFFER = 256
+
+# Debounce and gestures per button (see pacemaker_buttons.py), in seconds.
+# Held, up and down auto-repeat so menus scroll; a long press on emergency
+# and a double press on left are reported for the web app to act on
+BUTTON_GESTURES = {
+    'lock': pacemaker_buttons.ButtonConfig(debounce=0.25),
+    'up': pacemaker_buttons.ButtonConfig(debounce=0.05, repeat_delay=0.4, repeat_interval=0.1),
+    'down': pacemaker_buttons.ButtonConfig(debounce=0.05, repeat_delay=0.4, repeat_interval=0.1),
+    'left': pacemaker_buttons.ButtonConfig(debounce=0.05, double_press=0.35),
+    'emergency': pacemaker_buttons.ButtonConfig(debounce=0.25, long_press=1.0),
+}
+# /api/health reports a button as pressed for this long after a press
+BUTTON_PRESSED_WINDOW = 0.5
+
+# Encoder acceleration: (gap, rungs) pairs, shortest gap first. A detent that
+# follows the previous one in the same direction within gap seconds moves
+# that many rungs of the setting's ladder instead of one; slow turns and
+# direction changes always move one rung, so fine adjustment is unchanged
+ENCODER_ACCELERATION = {
+    'rate_encoder': ((0.025, 5), (0.05, 3), (0.1, 2)),
+    'a_output_encoder': ((0.03, 3), (0.08, 2)),
+    'v_output_encoder': ((0.03, 3), (0.08, 2)),
+}
+
+# Number of recent state commands whose apply latency is kept for /api/commands
+COMMAND_LATENCY_SAMPLES = 1024
+
+# Logging: records go into a ring buffer of LOG_BUFFER_SIZE and a background
+# thread writes them out. PACEMAKER_LOG_LEVEL sets what reaches stdout and
+# PACEMAKER_LOG_CAPTURE_LEVEL what is kept for /api/logs
+LOG_BUFFER_SIZE = 4096
+log = pacemaker_log.RingBufferLogger(
+    LOG_BUFFER_SIZE,
+    level=pacemaker_log.parse_level(os.environ.get('PACEMAKER_LOG_CAPTURE_LEVEL'), pacemaker_log.DEBUG),
+    stream_level=pacemaker_log.parse_level(os.environ.get('PACEMAKER_LOG_LEVEL'), pacemaker_log.INFO),
+)
+log.start()
+
+# Parameter history: every change to the pacing parameters is appended to
+# segment files under HISTORY_DIR (PACEMAKER_HISTORY_DIR moves it; set it to
+# an empty string to turn recording off) and served at /api/history
+HISTORY_DIR = os.environ.get('PACEMAKER_HISTORY_DIR',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history'))
+HISTORY_SEGMENT_RECORDS = 65536
+HISTORY_SEGMENT_SECONDS = 3600
+# Oldest segments beyond this many are deleted: about 30 days of hourly
+# segments, at most HISTORY_SEGMENT_RECORDS * 24 bytes each
+HISTORY_MAX_SEGMENTS = 720
+history = None
+if HISTORY_DIR:
+    history = pacemaker_recorder.HistoryRecorder(HISTORY_DIR, HISTORY_SEGMENT_RECORDS, HISTORY_SEGMENT_SECONDS,
+                                                 max_segments=HISTORY_MAX_SEGMENTS)
+    history.start()
+
+# Metrics served at /api/metrics
+INPUT_CALLBACK_SECONDS = metrics.Histogram(
+    'pacemaker_input_callback_seconds', 'Time spent in a GPIO encoder/button callback', ['input'])
+COMMAND_LATENCY_SECONDS = metrics.Histogram(
+    'pacemaker_command_latency_seconds', 'Time from queueing a state command to it being applied', ['command'])
+SERIALIZATION_SECONDS = metrics.Histogram(
+    'pacemaker_serialization_seconds', 'Time to serialize the state for clients', ['kind'])
+BROADCAST_FANOUT_SECONDS = metrics.Histogram(
+    'pacemaker_broadcast_fanout_seconds', 'Time to queue one frame for every WebSocket client')
+WS_SEND_SECONDS = metrics.Histogram(
+    'pacemaker_ws_send_seconds', 'Time to write and drain one frame to a WebSocket client')
+WS_QUEUE_DEPTH = metrics.Histogram(
+    'pacemaker_ws_queue_depth', 'Frames already waiting in a client send queue when another is queued',
+    buckets=(0, 1, 2, 4, 8, 16, 32))
+WS_DROPPED_FRAMES = metrics.Counter(
+    'pacemaker_ws_dropped_frames_total', 'Queued frames thrown away because a client was lagging')
+WS_DEFLATE_BYTES = metrics.Counter(
+    'pacemaker_ws_deflate_bytes_total', 'Payload bytes sent with permessage-deflate, before and after', ['stage'])
+HTTP_REQUEST_SECONDS = metrics.Histogram(
+    'pacemaker_http_request_seconds', 'Flask route latency', ['route', 'method', 'status'])
+WS_CLIENTS = metrics.Gauge(
+    'pacemaker_ws_clients', 'Connected WebSocket clients', function=lambda: len(connected_clients))
+SSE_CLIENTS = metrics.Gauge(
+    'pacemaker_sse_clients', 'Open /api/stream connections', ['server'])
+STATE_VERSION = metrics.Gauge(
+    'pacemaker_state_version', 'Current state version', function=lambda: pacemaker_state.version)
 
 # Use your existing encoder and button setup from pacemaker_server.py
-rate_encoder = RotaryEncoder(27, 22, max_steps=200, wrap=False)
-a_output_encoder = RotaryEncoder(21, 20, max_steps=200, wrap=False)
-v_output_encoder = RotaryEncoder(13, 6, max_steps=200, wrap=False)
-mode_output_encoder = RotaryEncoder(10, 9, max_steps=200, wrap=False)
-lock_button = Button(17, bounce_time=0.05)
-up_button = Button(26, bounce_time=0.05)
-down_button = Button(16, bounce_time=0.05)
-left_button = Button(18, bounce_time=0.05)
-emergency_button = Button(23, bounce_time=0.05)
-
-# Initial values
+rate_encoder = hardware.create_encoder('rate', 27, 22, max_steps=200, wrap=False)
+a_output_encoder = hardware.create_encoder('a_output', 21, 20, max_steps=200, wrap=False)
+v_output_encoder = hardware.create_encoder('v_output', 13, 6, max_steps=200, wrap=False)
+mode_output_encoder = hardware.create_encoder('mode', 10, 9, max_steps=200, wrap=False)
+lock_button = hardware.create_button('lock', 17, bounce_time=0.05)
+up_button = hardware.create_button('up', 26, bounce_time=0.05)
+down_button = hardware.create_button('down', 16, bounce_time=0.05)
+left_button = hardware.create_button('left', 18, bounce_time=0.05)
+emergency_button = hardware.create_button('emergency', 23, bounce_time=0.05)
+
+# Initial encoder positions
 rate_encoder.steps = 80
-current_rate = 80
 a_output_encoder.steps = 100
-current_a_output = 10.0
 v_output_encoder.steps = 100
-current_v_output = 10.0
 mode_output_encoder.steps = 50
 current_mode_output = 5.0
-a_sensitivity = 0.5
-v_sensitivity = 2.0
-active_control = 'none'
-is_locked = False
-current_mode = 0
 
 # Min/max values
 min_rate = 30
@@ -54,534 +177,990 @@ max_a_sensitivity = 10.0
 min_v_sensitivity = 0.8
 max_v_sensitivity = 20.0
 
-# Track last encoder position for outputs
-last_a_output_steps = 100
-last_v_output_steps = 100
-
-# Button state trackers
-up_button_pressed = False
-last_up_press_time = 0
-down_button_pressed = False
-last_down_press_time = 0
-left_button_pressed = False
-last_left_press_time = 0
-emergency_button_pressed = False
-last_emergency_press_time = 0
-last_mode_encoder_activity = time.time()
-encoder_activity_flag = False
-button_cooldown = 0.5
-
-# Current state to be shared with WebSocket clients
-current_state = {
-    "rate": current_rate,
-    "a_output": current_a_output,
-    "v_output": current_v_output,
-    "aSensitivity": a_sensitivity,
-    "vSensitivity": v_sensitivity,
-    "mode": current_mode,
-    "isLocked": is_locked,
-    "isPaused": False,
-    "pauseTimeLeft": 0,
-    "batteryLevel": 100,
-    "lastUpdate": time.time()
-}
+# Every accepted button press, for /api/events and the push clients
+button_events = pacemaker_events.EventLog(BUTTON_EVENT_BUFFER)
+
+class PacemakerState:
+    """All pacing state, shared by the GPIO callbacks, Flask and WebSocket threads.
+
+    Writes go through update(), which changes any number of fields under one
+    lock; if a published field moved it stamps last_update, bumps the version
+    once and records the change for the next delta broadcast. Read-modify-write
+    sequences (encoder diffs, toggles) hold the lock with `with state:` around
+    the read and the update(). Readers that need more than one field take a
+    consistent snapshot().
+    """
+
+    # Fields sent to clients, with their wire names
+    PUBLISHED = {
+        'rate': 'rate',
+        'a_output': 'a_output',
+        'v_output': 'v_output',
+        'a_sensitivity': 'aSensitivity',
+        'v_sensitivity': 'vSensitivity',
+        'mode': 'mode',
+        'is_locked': 'isLocked',
+        'is_paused': 'isPaused',
+        'pause_time_left': 'pauseTimeLeft',
+        'battery_level': 'batteryLevel',
+        'last_update': 'lastUpdate',
+    }
 
+    __slots__ = tuple(PUBLISHED) + (
+        # Server-side only
+        'active_control', 'encoder_active', 'last_mode_activity',
+        'last_mode_steps',
+        # Versioning and publishing
+        '_lock', '_changed', '_version', '_broadcast_version', '_dirty', '_cache', '_on_change',
+        '_on_transition',
+    )
+
+    def __init__(self, on_change=None, on_transition=None):
+        self.rate = 80
+        self.a_output = 10.0
+        self.v_output = 10.0
+        self.a_sensitivity = 0.5
+        self.v_sensitivity = 2.0
+        self.mode = 0
+        self.is_locked = False
+        self.is_paused = False
+        self.pause_time_left = 0
+        self.battery_level = 100
+        self.last_update = time.time()
+
+        self.active_control = 'none'
+        self.encoder_active = False
+        self.last_mode_activity = time.time()
+        self.last_mode_steps = None  # None until the mode encoder is tracked
+
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._version = 0
+        self._broadcast_version = 0
+        self._dirty = {}
+        self._cache = {}
+        self._on_change = on_change
+        self._on_transition = on_transition  # Called with the state, under the lock, for every version
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+    def update(self, **fields):
+        """Set several fields as one change: a single version bump and notification"""
+        with self._lock:
+            changed = {}
+            for name, value in fields.items():
+                if getattr(self, name) != value:
+                    setattr(self, name, value)
+                    if name in self.PUBLISHED:
+                        changed[self.PUBLISHED[name]] = value
+            if not changed:
+                return
+            if 'last_update' not in fields:
+                self.last_update = time.time()
+                changed['lastUpdate'] = self.last_update
+            self._dirty.update(changed)
+            self._version += 1
+            self._cache.clear()
+            self._changed.notify_all()
+            if self._on_transition:
+                self._on_transition(self)
+        if self._on_change:
+            self._on_change()
+
+    def touch(self):
+        """Mark the state as updated without changing a value (e.g. a button press)"""
+        self.update(last_update=time.time())
+
+    def _published(self):
+        return {wire: getattr(self, name) for name, wire in self.PUBLISHED.items()}
+
+    @property
+    def version(self):
+        return self._version
+
+    def snapshot(self):
+        """Return (version, copy of the published state)"""
+        with self._lock:
+            return self._version, self._published()
+
+    def wait_for_change(self, since, timeout):
+        """Block until the version differs from since; returns False on timeout.
+
+        Versions restart at 0 with the server, so a since ahead of the
+        current version is stale (the client saw a previous run) and counts
+        as a change rather than something to wait for.
+        """
+        with self._lock:
+            return self._changed.wait_for(lambda: self._version != since, timeout)
+
+    def cached(self, name, build):
+        """Return build(version, state) for the current version.
+
+        The result is computed once per version and the same object is handed
+        to every caller until the next change, so all readers share one
+        immutable buffer instead of serializing their own.
+        """
+        with self._lock:
+            version = self._version
+            entry = self._cache.get(name)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            state = self._published()
+        value = build(version, state)
+        with self._lock:
+            if self._version == version:
+                self._cache[name] = (version, value)
+        return value
+
+    def take_delta(self):
+        """Return (base, seq, changes) for everything changed since the last call, or None"""
+        with self._lock:
+            if not self._dirty:
+                return None
+            base = self._broadcast_version
+            changes = self._dirty
+            self._dirty = {}
+            self._broadcast_version = self._version
+            return base, self._version, changes
+
+
+class BroadcastScheduler:
+    """Sends state deltas when the state changes instead of on a fixed timer.
+
+    Writers call notify(); the scheduler thread wakes, waits out the coalesce
+    window so a burst of changes becomes one frame, then broadcasts. With
+    nothing to send it only wakes every heartbeat interval.
+    """
+
+    def __init__(self, coalesce_window, heartbeat_interval):
+        self.coalesce_window = coalesce_window
+        self.heartbeat_interval = heartbeat_interval
+        self._wake = threading.Event()
+
+    def notify(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                if self._wake.wait(self.heartbeat_interval):
+                    if self.coalesce_window > 0:
+                        time.sleep(self.coalesce_window)
+                    # Clear before sending so changes made during the broadcast
+                    # schedule another one
+                    self._wake.clear()
+                    broadcast_state()
+                elif connected_clients or stream_clients:
+                    broadcast_heartbeat()
+            except Exception as e:
+                log.error("Error in broadcast scheduler: %s", e)
+
+
+broadcast_scheduler = BroadcastScheduler(BROADCAST_COALESCE_WINDOW, BROADCAST_HEARTBEAT_INTERVAL)
+
+def record_transition(state):
+    """Queue the parameters of a new state version for the history (called under the state lock)"""
+    history.record((state.last_update, state.version, state.rate, state.a_output, state.v_output,
+                    state.a_sensitivity, state.v_sensitivity, state.mode, state.is_locked))
+
+# The one state object every thread reads
+pacemaker_state = PacemakerState(on_change=broadcast_scheduler.notify,
+                                 on_transition=record_transition if history else None)
+if history:
+    record_transition(pacemaker_state)  # Where this session starts from
+
+
+class DeviceLockedError(Exception):
+    """Raised by a state command when the device is locked"""
+
+    def __init__(self, message='Device is locked'):
+        super().__init__(message)
+
+
+def require_unlocked(message='Device is locked'):
+    if pacemaker_state.is_locked:
+        raise DeviceLockedError(message)
+
+
+class StateCommand:
+    """One queued state mutation"""
+
+    __slots__ = ('name', 'func', 'args', 'on_done', 'enqueued', 'result', 'error', 'done')
+
+    def __init__(self, name, func, args, on_done=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.on_done = on_done
+        self.enqueued = time.perf_counter()
+        self.result = None
+        self.error = None
+        self.done = None  # Event for callers waiting on the result
+
+
+class StateCommandQueue:
+    """Applies every state mutation in order on a single state-owner thread.
+
+    Encoder and button callbacks, Flask routes and WebSocket clients don't
+    write pacemaker_state themselves: they queue a named command. Callbacks
+    post() and return at once; routes call() and wait for the result. With
+    one writer, mutations apply in the order they arrived and the GPIO
+    callback threads never wait on the state lock. The time from queueing to
+    applied is kept for the most recent commands.
+    """
+
+    def __init__(self, latency_samples):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self.latencies = collections.deque(maxlen=latency_samples)
+        self.applied = 0
+        self.failed = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='state-owner')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def post(self, name, func, *args, on_done=None):
+        """Queue func(*args) without waiting; on_done(result, error) runs once it is applied"""
+        self._queue.put(StateCommand(name, func, args, on_done))
+
+    def call(self, name, func, *args):
+        """Queue func(*args), wait until it is applied and return its result or raise its error"""
+        if threading.current_thread() is self._thread:
+            return func(*args)  # Already on the owner thread
+        command = StateCommand(name, func, args)
+        command.done = threading.Event()
+        self._queue.put(command)
+        command.done.wait()
+        if command.error is not None:
+            raise command.error
+        return command.result
+
+    def handler(self, name, func):
+        """A callback for gpiozero that queues func instead of running it on the GPIO thread"""
+        observe = INPUT_CALLBACK_SECONDS.labels(name).observe
+
+        def callback():
+            start = time.perf_counter()
+            self.post(name, func)
+            observe(time.perf_counter() - start)
+        return callback
+
+    def run(self):
+        while True:
+            command = self._queue.get()
+            try:
+                command.result = command.func(*command.args)
+                self.applied += 1
+            except Exception as e:
+                command.error = e
+                self.failed += 1
+                if command.done is None and command.on_done is None:
+                    log.error("Error applying %s: %s", command.name, e)
+            latency = time.perf_counter() - command.enqueued
+            self.latencies.append(latency)
+            COMMAND_LATENCY_SECONDS.labels(command.name).observe(latency)
+            if command.on_done:
+                try:
+                    command.on_done(command.result, command.error)
+                except Exception as e:
+                    log.error("Error completing %s: %s", command.name, e)
+            if command.done:
+                command.done.set()
 
-def handle_down_button():
-    global last_down_press_time, down_button_pressed, current_state
-    current_time = time.time()
-    
-    # Strict debounce logic with longer cooldown
-    if current_time - last_down_press_time > button_cooldown:
-        last_down_press_time = current_time
-        down_button_pressed = True
-        current_state["lastUpdate"] = time.time()
-        print("Down button pressed")
-        
-        # Only broadcast after sufficient time has passed since last press
-        broadcast_state()  # Send a single update
+    def latency_stats(self):
+        """Queue-to-applied latency of the recent commands, in milliseconds"""
+        samples = sorted(self.latencies)
+        stats = {'applied': self.applied, 'failed': self.failed, 'samples': len(samples)}
+        if samples:
+            def percentile(p):
+                return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+            stats.update(p50_ms=percentile(0.50), p99_ms=percentile(0.99), max_ms=percentile(1.0))
+        return stats
 
 
-def handle_up_button():
-    global last_up_press_time, up_button_pressed, current_state
-    current_time = time.time()
-    
-    # Strict debounce logic with longer cooldown
-    if current_time - last_up_press_time > button_cooldown:
-        last_up_press_time = current_time
-        up_button_pressed = True
-        current_state["lastUpdate"] = time.time()
-        print("Up button pressed")
-        
-        # Only broadcast after sufficient time has passed since last press
-        broadcast_state()  # Send a single update
-        
-        
-def handle_left_button():
-    global last_left_press_time, left_button_pressed, current_state
-    current_time = time.time()
-    
-    # Strict debounce logic with longer cooldown
-    if current_time - last_left_press_time > button_cooldown:
-        last_left_press_time = current_time
-        left_button_pressed = True
-        current_state["lastUpdate"] = time.time()
-        print("Left button pressed")
-        
-        # Only broadcast after sufficient time has passed since last press
-        broadcast_state()  # Send a single update
+# Every write to pacemaker_state goes through here
+state_commands = StateCommandQueue(COMMAND_LATENCY_SAMPLES)
+
+
+def button_event_message(event):
+    """A button event as (JSON message, SSE event)"""
+    data = json.dumps({"type": "button", **event})
+    # No id line: Last-Event-ID keeps tracking the state version
+    return data, b'event: button\ndata: %s\n\n' % data.encode()
+
+
+def publish_button_event(button, action):
+    """Add a gesture to the event log and push it to every WebSocket and stream client"""
+    data, sse_event = button_event_message(button_events.append(button, action))
+    send_to_all_clients(create_websocket_frame(data), None, sse_event)
+
+
+def handle_button_gesture(button, action):
+    """Apply a gesture from the button engine (on the state command thread)"""
+    if button == 'lock':
+        toggle_lock()
+        return
+    publish_button_event(button, action)
+    pacemaker_state.touch()
+    log.info("%s button %s", button.capitalize(), action)
+
+
+def post_button_gesture(button, action):
+    # Called by the gesture engine with its lock held: only queue the command
+    state_commands.post(button + '_button', handle_button_gesture, button, action)
 
-def handle_emergency_button():
-    global last_emergency_press_time, emergency_button_pressed, current_state
-    current_time = time.time()
-    
-    # Strict debounce logic with longer cooldown
-    if current_time - last_emergency_press_time > button_cooldown:
-        last_emergency_press_time = current_time
-        emergency_button_pressed = True
-        current_state["lastUpdate"] = time.time()
-        print("Emergency button pressed")
-        
-        # Only broadcast after sufficient time has passed since last press
-        broadcast_state()  # Send a single update
 
 # Function to update the current rate value - simplified approach
 def update_rate():
-    global current_rate, current_state
-
-    if is_locked:
+    rungs = rate_detents.drain()
+    if rungs == 0:
         return
 
-    # Get current encoder position
-    encoder_position = rate_encoder.steps
-    
-    # Ensure the position is within valid range
-    encoder_position = max(min_rate, min(encoder_position, max_rate))
-    
-    # Only update if there's an actual change
-    if encoder_position != current_rate:
-        current_rate = encoder_position
-        
-        # Make sure encoder position reflects our value
-        rate_encoder.steps = current_rate
-        
-        # Update state
-        current_state["rate"] = current_rate
-        current_state["lastUpdate"] = time.time()
-        
-        print(f"Rate updated: {current_rate} ppm")
+    with pacemaker_state:
+        if pacemaker_state.is_locked:
+            return
 
+        # 1 ppm per rung, within the valid range
+        rate = max(min_rate, min(pacemaker_state.rate + rungs, max_rate))
+        
+        # Only update if there's an actual change
+        if rate != pacemaker_state.rate:
+            # Make sure encoder position reflects our value
+            rate_encoder.steps = rate
+            
+            # Update state
+            pacemaker_state.update(rate=rate)
+            
+            log.info("Rate updated: %s ppm (%+d rungs)", rate, rungs)
+
+
+class ValueLadder:
+    """Every legal value of a setting in ascending order, built once at startup.
+
+    Encoder moves are integer index arithmetic on the ladder and arbitrary
+    values are snapped to the nearest rung with a binary search, so stored
+    values are always exact (0.3, never 0.30000000000000004).
+    """
+
+    def __init__(self, segments, extra=()):
+        # Each segment is (start, stop, step); values are rounded to 0.1 so
+        # the shared boundaries of neighbouring segments coincide exactly
+        values = set(extra)
+        for start, stop, step in segments:
+            count = round((stop - start) / step)
+            values.update(round(start + i * step, 1) for i in range(count + 1))
+        self.values = tuple(sorted(values))
+        self._positions = {value: i for i, value in enumerate(self.values)}
+
+    def index(self, value):
+        """Position of value on the ladder, or of the nearest rung if it is off the ladder"""
+        position = self._positions.get(value)
+        if position is not None:
+            return position
+        position = bisect.bisect_left(self.values, value)
+        if position == len(self.values):
+            return position - 1
+        if position > 0 and value - self.values[position - 1] <= self.values[position] - value:
+            return position - 1
+        return position
+
+    def snap(self, value):
+        """Nearest legal value"""
+        return self.values[self.index(value)]
+
+    def step(self, value, rungs):
+        """Move rungs up (positive) or down the ladder from value, stopping at the ends"""
+        position = self.index(value) + rungs
+        return self.values[max(0, min(position, len(self.values) - 1))]
+
+
+ASYNC = 0  # Sensitivity setting for asynchronous pacing
+
+# Outputs: 0.1 mA steps below 0.4, 0.2 below 1.0, 0.5 below 5.0, then 1.0
+A_OUTPUT_LADDER = ValueLadder([(min_a_output, 0.4, 0.1), (0.4, 1.0, 0.2), (1.0, 5.0, 0.5), (5.0, max_a_output, 1.0)])
+V_OUTPUT_LADDER = ValueLadder([(min_v_output, 0.4, 0.1), (0.4, 1.0, 0.2), (1.0, 5.0, 0.5), (5.0, max_v_output, 1.0)])
+
+# Sensitivities (mV), with ASYNC just below the minimum
+A_SENSITIVITY_LADDER = ValueLadder([(min_a_sensitivity, 1.0, 0.1), (1.0, 2.0, 0.2), (2.0, 5.0, 0.5),
+                                    (5.0, max_a_sensitivity, 1.0)], extra=(ASYNC,))
+V_SENSITIVITY_LADDER = ValueLadder([(min_v_sensitivity, 1.0, 0.2), (1.0, 3.0, 0.5), (3.0, 10.0, 1.0),
+                                    (10.0, max_v_sensitivity, 2.0)], extra=(ASYNC,))
+
+# Ladders by state field and by wire name
+VALUE_LADDERS = {
+    'a_output': A_OUTPUT_LADDER,
+    'v_output': V_OUTPUT_LADDER,
+    'a_sensitivity': A_SENSITIVITY_LADDER,
+    'v_sensitivity': V_SENSITIVITY_LADDER,
+    'aSensitivity': A_SENSITIVITY_LADDER,
+    'vSensitivity': V_SENSITIVITY_LADDER,
+}
 
-# Function to determine the appropriate step size based on the current value
-def get_output_step_size(value):
-    if value < 0.4:
-        return 0.1
-    elif value < 1.0:
-        return 0.2
-    elif value < 5.0:
-        return 0.5
-    else:
-        return 1.0
-
-# Function to get step size for sensitivity values
-def get_sensitivity_step_size(value, is_a_sensitivity=True):
-    if is_a_sensitivity:
-        # For A sensitivity (0.4-10.0 mV)
-        if value <= 1:
-            return 0.1
-        if value <= 2:
-            return 0.2
-        if value <= 5:
-            return 0.5
-        if value <= 9:  # Special case for approaching max
-            return 1.0
-        return 0.5  # Smaller steps near the maximum
-    else:
-        # For V sensitivity (0.8-20.0 mV)
-        if value <= 1:
-            return 0.2
-        if value <= 3:
-            return 0.5
-        if value <= 10:
-            return 1.0
-        if value <= 18:  # Special case for approaching max
-            return 2.0
-        return 0.5  # Smaller steps near the maximum
-
-# Function to update the current A. Output value
+class DetentAccumulator:
+    """Counts an encoder's detents between the GPIO callbacks and the state thread.
+
+    The clockwise/counter-clockwise callbacks only append +1/-1 and the time
+    to a deque (atomic, no lock) and queue a single drain command per burst,
+    so the GPIO thread is done in microseconds and a fast spin reaches the
+    state as one change carrying every detent.
+
+    drain() scales each detent by the acceleration curve (see
+    ENCODER_ACCELERATION) from the time since the detent before it. Times
+    come from hardware.clock, so under the sim backend they are the
+    simulated ones and the result does not depend on the machine.
+    """
+
+    def __init__(self, name, encoder, process, curve=()):
+        self.name = name
+        self.process = process
+        self.curve = curve
+        self._observe = INPUT_CALLBACK_SECONDS.labels(name).observe
+        self._detents = collections.deque()
+        self._scheduled = False
+        self._last_detent = 0
+        self._last_time = None
+        encoder.when_rotated_clockwise = self._clockwise
+        encoder.when_rotated_counter_clockwise = self._counter_clockwise
+
+    def _clockwise(self):
+        self._add(1)
+
+    def _counter_clockwise(self):
+        self._add(-1)
+
+    def _add(self, detent):
+        start = time.perf_counter()
+        # Append before checking the flag: drain() clears the flag before it
+        # reads, so a detent is never left behind without a drain queued
+        self._detents.append((detent, hardware.clock()))
+        if not self._scheduled:
+            self._scheduled = True
+            state_commands.post(self.name, self.process)
+        self._observe(time.perf_counter() - start)
+
+    def drain(self):
+        """Return the net rungs to move since the last drain (state thread only)"""
+        self._scheduled = False
+        total = 0
+        while self._detents:
+            detent, when = self._detents.popleft()
+            total += detent * self.rungs(detent, when)
+        return total
+
+    def rungs(self, detent, when):
+        """Rungs for one detent at time when, given the detent before it"""
+        gap = when - self._last_time if detent == self._last_detent else None
+        self._last_detent = detent
+        self._last_time = when
+        if gap is not None:
+            for max_gap, rungs in self.curve:
+                if gap <= max_gap:
+                    return rungs
+        return 1
+
+
+# Function to update the current A. Output value from the accumulated detents
 def update_a_output():
-    global current_a_output, last_a_output_steps, current_state
-    
-    # Skip updating if locked, but allow in DOO mode
-    if is_locked:
+    rungs = a_output_detents.drain()
+    if rungs == 0:
         return
     
-    # Get current steps from encoder
-    current_steps = a_output_encoder.steps
-    
-    # Calculate the difference in steps
-    diff = current_steps - last_a_output_steps
-    
-    # If there's a change in steps
-    if diff != 0:
-        # Get the step size based on the current value
-        step_size = get_output_step_size(current_a_output)
-        
-        # Apply the change - one encoder step = one logical step
-        # If diff is positive, increase by one step; if negative, decrease by one step
-        if diff > 0:
-            current_a_output += step_size
-        else:
-            current_a_output -= step_size
-            
-        # Ensure the value stays within bounds
-        current_a_output = max(min_a_output, min(current_a_output, max_a_output))
+    with pacemaker_state:
+        # Skip updating if locked, but allow in DOO mode
+        if pacemaker_state.is_locked:
+            return
         
-        # Round to the nearest step size to prevent floating point errors
-        current_a_output = round(current_a_output / step_size) * step_size
-        
-        # Update the encoder position to match the current value
-        last_a_output_steps = current_steps
-        
-        # Update state
-        current_state["a_output"] = current_a_output
-        current_state["lastUpdate"] = time.time()
-        
-        print(f"A. Output updated: {current_a_output} mA (step size: {step_size}, diff: {diff})")
+        # Clockwise increases, one or more rungs per detent; a burst is applied as one update
+        a_output = A_OUTPUT_LADDER.step(pacemaker_state.a_output, rungs)
+        pacemaker_state.update(a_output=a_output)
+    
+    log.info("A. Output updated: %s mA (%+d rungs)", a_output, rungs)
 
-# Replace your current V output handler function with this improved version
-# This should fix the V output encoder responsiveness
 
+# Function to update the current V. Output value from the accumulated detents
 def update_v_output():
-    global current_v_output, last_v_output_steps, current_state
-    
-    # Skip updating if locked
-    if is_locked:
+    rungs = v_output_detents.drain()
+    if rungs == 0:
         return
     
-    # Get current steps from encoder
-    current_steps = v_output_encoder.steps
-    
-    # Calculate the difference in steps
-    diff = current_steps - last_v_output_steps
+    with pacemaker_state:
+        # Skip updating if locked
+        if pacemaker_state.is_locked:
+            return
+        
+        v_output = V_OUTPUT_LADDER.step(pacemaker_state.v_output, rungs)
+        pacemaker_state.update(v_output=v_output)
     
-    # If there's a change in steps
-    if diff != 0:
-        # Get the step size based on the current value
-        step_size = get_output_step_size(current_v_output)
+    # Log the update
+    log.info("V. Output updated: %s mA (%+d rungs)", v_output, rungs)
+
+
+def update_mode_output():
+    with pacemaker_state:
+        # Skip if locked or no active control
+        if pacemaker_state.is_locked or pacemaker_state.active_control == 'none':
+            return
         
-        # Apply the change - one encoder step = one logical step
-        # If diff is positive, increase by one step; if negative, decrease by one step
-        if diff > 0:
-            current_v_output += step_size
-        else:
-            current_v_output -= step_size
-            
-        # Ensure the value stays within bounds
-        current_v_output = max(min_v_output, min(current_v_output, max_v_output))
+        # Get current steps
+        current_steps = mode_output_encoder.steps
         
-        # Round to the nearest step size to prevent floating point errors
-        current_v_output = round(current_v_output / step_size) * step_size
+        # Initialize tracking if needed
+        if pacemaker_state.last_mode_steps is None:
+            pacemaker_state.update(last_mode_steps=current_steps)
+            log.debug("Initialized mode encoder tracking: steps=%s", current_steps)
+            return
         
-        # Update the encoder position to match the current value
-        last_v_output_steps = current_steps
+        # Calculate difference
+        step_diff = current_steps - pacemaker_state.last_mode_steps
         
-        # Update state
-        current_state["v_output"] = current_v_output
-        current_state["lastUpdate"] = time.time()
+        # Only process if there's actual movement and it's not too large
+        if step_diff == 0:
+            return
         
-        # Log the update
-        print(f"V. Output updated: {current_v_output} mA (step size: {step_size}, diff: {diff})")
+        # Sanity check: encoder reports a weird jump?
+        if abs(step_diff) > 4:  # Reduced from 10 to 4 to catch smaller jumps
+            log.warning("[Mode Encoder] Ignoring jump: %s steps", step_diff)
+            pacemaker_state.update(last_mode_steps=current_steps)
+            return
         
-        # Important: Broadcast state immediately when V Output changes
-        broadcast_state()
-
-def update_mode_output():
-    global a_sensitivity, v_sensitivity, active_control, mode_output_encoder, last_mode_encoder_activity, encoder_activity_flag, current_state
-    
-    # Skip if locked or no active control
-    if is_locked or active_control == 'none':
-        return
-    
-    # Get current steps
-    current_steps = mode_output_encoder.steps
-    
-    # Initialize tracking if needed
-    if not hasattr(update_mode_output, 'last_steps'):
-        update_mode_output.last_steps = current_steps
-        print(f"Initialized mode encoder tracking: steps={current_steps}")
-        return
-    
-    # Calculate difference
-    step_diff = current_steps - update_mode_output.last_steps
-    
-    # Only process if there's actual movement and it's not too large
-    if step_diff == 0:
-        return
-    
-    # Sanity check: encoder reports a weird jump?
-    if abs(step_diff) > 4:  # Reduced from 10 to 4 to catch smaller jumps
-        print(f"[Mode Encoder] Ignoring jump: {step_diff} steps")
-        update_mode_output.last_steps = current_steps
-        return
-    
-    # Update activity timestamp and set flag
-    last_mode_encoder_activity = time.time()
-    encoder_activity_flag = True
-    
-    # Update tracking immediately to prevent multiple processing
-    update_mode_output.last_steps = current_steps
-    
-    print(f"Mode encoder movement detected: {step_diff} steps")
-    
-    # Process based on control type
-    if active_control == 'a_sensitivity':
-        # Use step_diff directly 
-        process_a_sensitivity_change(step_diff)
-    elif active_control == 'v_sensitivity':
-        process_v_sensitivity_change(step_diff)
-    
-    # Important: Broadcast state change to all WebSocket clients immediately
-    broadcast_state()
+        # Update activity timestamp and set flag, and update tracking
+        # immediately to prevent multiple processing
+        pacemaker_state.update(
+            last_mode_activity=time.time(),
+            encoder_active=True,
+            last_mode_steps=current_steps,
+        )
+        
+        log.debug("Mode encoder movement detected: %s steps", step_diff)
+        
+        # Process based on control type
+        if pacemaker_state.active_control == 'a_sensitivity':
+            # Use step_diff directly 
+            process_a_sensitivity_change(step_diff)
+        elif pacemaker_state.active_control == 'v_sensitivity':
+            process_v_sensitivity_change(step_diff)
 
 
 def process_a_sensitivity_change(step_diff):
-    global a_sensitivity, current_state
-    
-    # Determine step size based on the current value
-    step_size = 0.1
-    if a_sensitivity > 1.0 and a_sensitivity <= 2.0:
-        step_size = 0.2
-    elif a_sensitivity > 2.0 and a_sensitivity <= 5.0:
-        step_size = 0.5
-    elif a_sensitivity > 5.0:
-        step_size = 1.0
-    
-    # Apply smaller changes for each step (divide by 2 for smoother control)
-    actual_change = step_size * (abs(step_diff) / 2)
-    if actual_change < 0.1:  # Ensure minimum change
-        actual_change = 0.1
-    
-    # Direction control
-    if step_diff > 0:  # Clockwise - decrease sensitivity
-        if a_sensitivity > min_a_sensitivity:
-            a_sensitivity = max(min_a_sensitivity, a_sensitivity - actual_change)
-        elif a_sensitivity == min_a_sensitivity:
-            a_sensitivity = 0  # ASYNC
-    else:  # Counter-clockwise - increase sensitivity
-        if a_sensitivity == 0:
-            a_sensitivity = min_a_sensitivity  # Come out of ASYNC
-        elif a_sensitivity < max_a_sensitivity:
-            a_sensitivity = min(max_a_sensitivity, a_sensitivity + actual_change)
-            
-    a_sensitivity = round(a_sensitivity, 1)  # Round to 1 decimal place
-    current_state["aSensitivity"] = a_sensitivity
-    current_state["lastUpdate"] = time.time()
-    print(f"A Sensitivity: {a_sensitivity if a_sensitivity > 0 else 'ASYNC'}")
+    with pacemaker_state:
+        # Clockwise decreases sensitivity, one rung per step, down through
+        # the minimum into ASYNC; counter-clockwise comes back out
+        a_sensitivity = A_SENSITIVITY_LADDER.step(pacemaker_state.a_sensitivity, -step_diff)
+        pacemaker_state.update(a_sensitivity=a_sensitivity)
+    log.info("A Sensitivity: %s", a_sensitivity if a_sensitivity > 0 else 'ASYNC')
 
 
 def process_v_sensitivity_change(step_diff):
-    global v_sensitivity, current_state
-    
-    # Determine step size based on the current value
-    step_size = 0.2
-    if v_sensitivity > 1.0 and v_sensitivity <= 3.0:
-        step_size = 0.5
-    elif v_sensitivity > 3.0 and v_sensitivity <= 10.0:
-        step_size = 1.0
-    elif v_sensitivity > 10.0:
-        step_size = 2.0
-    
-    # Apply smaller changes for each step (divide by 2 for smoother control)
-    actual_change = step_size * (abs(step_diff) / 2)
-    if actual_change < 0.2:  # Ensure minimum change
-        actual_change = 0.2
-    
-    # Direction control
-    if step_diff > 0:  # Clockwise - decrease sensitivity
-        if v_sensitivity > min_v_sensitivity:
-            v_sensitivity = max(min_v_sensitivity, v_sensitivity - actual_change)
-        elif v_sensitivity == min_v_sensitivity:
-            v_sensitivity = 0  # ASYNC
-    else:  # Counter-clockwise - increase sensitivity
-        if v_sensitivity == 0:
-            v_sensitivity = min_v_sensitivity  # Come out of ASYNC
-        elif v_sensitivity < max_v_sensitivity:
-            v_sensitivity = min(max_v_sensitivity, v_sensitivity + actual_change)
-            
-    v_sensitivity = round(v_sensitivity, 1)  # Round to 1 decimal place
-    current_state["vSensitivity"] = v_sensitivity
-    current_state["lastUpdate"] = time.time()
-    print(f"V Sensitivity: {v_sensitivity if v_sensitivity > 0 else 'ASYNC'}")
+    with pacemaker_state:
+        # Clockwise decreases sensitivity, one rung per step, down through
+        # the minimum into ASYNC; counter-clockwise comes back out
+        v_sensitivity = V_SENSITIVITY_LADDER.step(pacemaker_state.v_sensitivity, -step_diff)
+        pacemaker_state.update(v_sensitivity=v_sensitivity)
+    log.info("V Sensitivity: %s", v_sensitivity if v_sensitivity > 0 else 'ASYNC')
 
 
 def hardware_reset_mode_encoder():
     """Force reset of mode encoder state at hardware level"""
-    global mode_output_encoder
-    
-    # Get current position
-    current_steps = mode_output_encoder.steps
-    
-    # Force reset tracking variable
-    if hasattr(update_mode_output, 'last_steps'):
-        update_mode_output.last_steps = current_steps
+    with pacemaker_state:
+        # Get current position
+        current_steps = mode_output_encoder.steps
+        
+        # Force reset tracking variable
+        if pacemaker_state.last_mode_steps is not None:
+            pacemaker_state.update(last_mode_steps=current_steps)
     
-    print(f"Hard reset of mode encoder to steps={current_steps}")
+    log.info("Hard reset of mode encoder to steps=%s", current_steps)
 
 
 def reset_stuck_encoders():
-    global mode_output_encoder, last_mode_encoder_activity, active_control
-    
     current_time = time.time()
     
-    # If it's been more than 2 seconds since last activity and there's an active control
-    if current_time - last_mode_encoder_activity > 2 and active_control != 'none':
-        # Reset the steps to match the logical state
-        current_steps = mode_output_encoder.steps
-        
-        # Only reset if update_mode_output.last_steps exists and differs
-        if hasattr(update_mode_output, 'last_steps') and update_mode_output.last_steps != current_steps:
-            print(f"Resetting stuck encoder: {update_mode_output.last_steps} → {current_steps}")
-            update_mode_output.last_steps = current_steps
+    with pacemaker_state:
+        # If it's been more than 2 seconds since last activity and there's an active control
+        if current_time - pacemaker_state.last_mode_activity > 2 and pacemaker_state.active_control != 'none':
+            # Reset the steps to match the logical state
+            current_steps = mode_output_encoder.steps
+            last_steps = pacemaker_state.last_mode_steps
             
-            # Also send a state update to ensure client and server are in sync
-            broadcast_state()
+            # Only reset if the mode encoder is tracked and differs
+            if last_steps is not None and last_steps != current_steps:
+                log.warning("Resetting stuck encoder: %s → %s", last_steps, current_steps)
+                pacemaker_state.update(last_mode_steps=current_steps)
+                
+                # Also send a state update to ensure client and server are in sync
+                broadcast_scheduler.notify()
 
 # Function to toggle lock state
 def toggle_lock():
-    global is_locked, current_state
-    is_locked = not is_locked
-    
-    # Update state
-    current_state["isLocked"] = is_locked
-    current_state["lastUpdate"] = time.time()
+    with pacemaker_state:
+        is_locked = not pacemaker_state.is_locked
+        
+        # Update state
+        pacemaker_state.update(is_locked=is_locked)
     
     # Update LED based on lock state
     if is_locked:
         # lock_led.on()  # Turn on LED when locked
-        print("Device LOCKED")
+        log.info("Device LOCKED")
     else:
         # lock_led.off()  # Turn off LED when unlocked
-        print("Device UNLOCKED")
+        log.info("Device UNLOCKED")
+    return is_locked
 
 # Function to reset the rate to default
 def reset_rate():
-    global current_rate, current_state
-    rate_encoder.steps = 80
-    current_rate = 80
-    update_rate.last_steps = 80  # <-- ADD THIS
-    current_state["rate"] = current_rate
-    current_state["lastUpdate"] = time.time()
-    print("Rate reset to 80 ppm!")
+    with pacemaker_state:
+        rate_encoder.steps = 80
+        pacemaker_state.update(rate=80)
+    log.info("Rate reset to 80 ppm!")
 
 # Function to reset the A. Output to default
 def reset_a_output():
-    global current_a_output, last_a_output_steps, current_state
-    a_output_encoder.steps = 100
-    last_a_output_steps = 100  # tracking
-    current_a_output = 10.0
-    # last_a_output_steps = a_output_encoder.steps
-    current_state["a_output"] = current_a_output
-    current_state["lastUpdate"] = time.time()
-    print("A. Output reset to 10.0 mA!")
+    with pacemaker_state:
+        a_output_encoder.steps = 100
+        pacemaker_state.update(a_output=10.0)
+    log.info("A. Output reset to 10.0 mA!")
 
 # Function to reset the V. Output to default
 def reset_v_output():
-    global current_v_output, last_v_output_steps, current_state
-    v_output_encoder.steps = 100
-    last_v_output_steps = 100 # tracking
-    current_v_output = 10.0
-    # last_v_output_steps = v_output_encoder.steps
-    current_state["v_output"] = current_v_output
-    current_state["lastUpdate"] = time.time()
-    print("V. Output reset to 10.0 mA!")
+    with pacemaker_state:
+        v_output_encoder.steps = 100
+        pacemaker_state.update(v_output=10.0)
+    log.info("V. Output reset to 10.0 mA!")
 
 # Simple WebSocket handling functions
-def parse_websocket_frame(data):
-    """Parse a WebSocket frame and return the payload"""
-    if len(data) < 6:
-        return None
-
-    # Get the FIN bit and opcode
-    fin = (data[0] & 0x80) >> 7
-    opcode = data[0] & 0x0F
-
-    # Get the MASK bit and payload length
-    mask = (data[1] & 0x80) >> 7
-    payload_len = data[1] & 0x7F
-
-    # Determine the actual payload length
-    if payload_len == 126:
-        mask_offset = 4
-        payload_len = int.from_bytes(data[2:4], byteorder='big')
-    elif payload_len == 127:
-        mask_offset = 10
-        payload_len = int.from_bytes(data[2:10], byteorder='big')
-    else:
-        mask_offset = 2
-
-    # Get the masking key and payload
-    if mask:
-        masking_key = data[mask_offset:mask_offset+4]
-        payload_offset = mask_offset + 4
-        payload = data[payload_offset:payload_offset+payload_len]
-
-        # Unmask the payload
-        unmasked = bytearray(payload_len)
-        for i in range(payload_len):
-            unmasked[i] = payload[i] ^ masking_key[i % 4]
-        payload = unmasked
-    else:
-        payload_offset = mask_offset
-        payload = data[payload_offset:payload_offset+payload_len]
+class WebSocketProtocolError(Exception):
+    """A client broke the framing rules; close_code goes in the close frame"""
+
+    def __init__(self, message, close_code=1002):
+        super().__init__(message)
+        self.close_code = close_code
+
+
+def unmask_payload(payload, masking_key):
+    """Unmask a client payload with one big-integer XOR instead of a per-byte loop"""
+    length = len(payload)
+    if length == 0:
+        return b''
+    key = (bytes(masking_key) * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+
+class WebSocketFrameDecoder:
+    """Incremental decoder for frames sent by a client.
+
+    feed() accepts whatever a read returned - part of a frame, one frame or
+    several - and returns the complete messages as (opcode, payload) pairs.
+    Incomplete frames stay buffered until the rest arrives, fragmented
+    messages are reassembled, and control frames (close/ping/pong) are
+    returned as soon as they arrive, even in the middle of a fragmented
+    message.
+    """
+
+    def __init__(self, max_message_size=None, deflate=None):
+        self.max_message_size = max_message_size or WS_MAX_MESSAGE_SIZE
+        self.deflate = deflate  # PerMessageDeflate if the extension was negotiated
+        self._buffer = bytearray()
+        self._fragments = []
+        self._fragments_size = 0
+        self._fragment_opcode = None
+        self._fragment_compressed = False
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        messages = []
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return messages
+            fin, rsv, opcode, payload = frame
+
+            # RSV1 marks a compressed message; it is only valid on the
+            # first frame of a data message, and only with permessage-deflate
+            compressed = bool(rsv & 0x4)
+            if rsv & 0x3 or (compressed and (self.deflate is None or opcode == 0x0 or opcode >= 0x8)):
+                raise WebSocketProtocolError("Unexpected RSV bits")
+
+            if opcode >= 0x8:
+                # Control frames are never fragmented and may be interleaved
+                if not fin or len(payload) > 125:
+                    raise WebSocketProtocolError("Invalid control frame")
+                messages.append((opcode, payload))
+            elif opcode == 0x0:
+                if self._fragment_opcode is None:
+                    raise WebSocketProtocolError("Continuation frame without a message to continue")
+                self._add_fragment(payload)
+                if fin:
+                    messages.append((self._fragment_opcode,
+                                     self._message(b''.join(self._fragments), self._fragment_compressed)))
+                    self._fragments = []
+                    self._fragments_size = 0
+                    self._fragment_opcode = None
+                    self._fragment_compressed = False
+            else:
+                if self._fragment_opcode is not None:
+                    raise WebSocketProtocolError("New message started before the previous one finished")
+                if fin:
+                    messages.append((opcode, self._message(payload, compressed)))
+                else:
+                    self._fragment_opcode = opcode
+                    self._fragment_compressed = compressed
+                    self._add_fragment(payload)
 
-    # Return the payload as string for text frames
-    if opcode == 0x1:  # Text frame
-        return payload.decode('utf-8')
-    else:
+    def _message(self, payload, compressed):
+        if compressed:
+            return self.deflate.decompress(payload, self.max_message_size)
         return payload
 
-def create_websocket_frame(data, opcode=0x1):
-    """Create a WebSocket frame for the given data"""
+    def _add_fragment(self, payload):
+        self._fragments_size += len(payload)
+        if self._fragments_size > self.max_message_size:
+            raise WebSocketProtocolError("Message too big", close_code=1009)
+        self._fragments.append(payload)
+
+    def _next_frame(self):
+        """Pop one complete frame off the buffer, or return None if it hasn't all arrived"""
+        buffer = self._buffer
+        if len(buffer) < 2:
+            return None
+
+        fin = buffer[0] & 0x80
+        rsv = (buffer[0] >> 4) & 0x7
+        opcode = buffer[0] & 0x0F
+        masked = buffer[1] & 0x80
+        payload_len = buffer[1] & 0x7F
+
+        # Determine the actual payload length
+        offset = 2
+        if payload_len == 126:
+            if len(buffer) < 4:
+                return None
+            payload_len = int.from_bytes(buffer[2:4], byteorder='big')
+            offset = 4
+        elif payload_len == 127:
+            if len(buffer) < 10:
+                return None
+            payload_len = int.from_bytes(buffer[2:10], byteorder='big')
+            offset = 10
+
+        # Clients must mask everything they send
+        if not masked:
+            raise WebSocketProtocolError("Client frame is not masked")
+        if payload_len > self.max_message_size:
+            raise WebSocketProtocolError("Message too big", close_code=1009)
+
+        frame_end = offset + 4 + payload_len
+        if len(buffer) < frame_end:
+            return None
+
+        masking_key = buffer[offset:offset + 4]
+        payload = unmask_payload(buffer[offset + 4:frame_end], masking_key)
+        del buffer[:frame_end]
+        return bool(fin), rsv, opcode, payload
+
+
+def create_websocket_frame(data, opcode=0x1, compressed=False):
+    """Create a WebSocket frame for the given data (compressed sets RSV1 for permessage-deflate)"""
     if isinstance(data, str):
         data = data.encode('utf-8')
 
-    # Create the frame header
-    frame = bytearray()
-    frame.append(0x80 | opcode)  # FIN bit set, text frame
-
-    # Set the payload length
-    if len(data) < 126:
-        frame.append(len(data))
-    elif len(data) < 65536:
-        frame.append(126)
-        frame.extend(len(data).to_bytes(2, byteorder='big'))
+    # FIN bit set, then the payload length in the smallest form that fits
+    first = 0x80 | (0x40 if compressed else 0) | opcode
+    length = len(data)
+    if length < 126:
+        header = struct.pack('!BB', first, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', first, 126, length)
     else:
-        frame.append(127)
-        frame.extend(len(data).to_bytes(8, byteorder='big'))
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + data
+
+
+class PerMessageDeflate:
+    """permessage-deflate (RFC 7692) state for one connection.
+
+    The compressor keeps its context between messages, so a state frame that
+    differs from the previous one in a few values compresses to a few bytes
+    of back-references. Frames are compressed in the order they are written,
+    which is why this is per client rather than cached with the shared frames.
+    """
+
+    def __init__(self, server_no_context_takeover=False, server_max_window_bits=15):
+        self.server_no_context_takeover = server_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self._compressor = self._new_compressor()
+        # Inflating with the largest window handles any client_max_window_bits
+        self._decompressor = zlib.decompressobj(-15)
+
+    def _new_compressor(self):
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -self.server_max_window_bits)
+
+    @classmethod
+    def negotiate(cls, header):
+        """Accept the first permessage-deflate offer in a Sec-WebSocket-Extensions header.
+
+        Returns (PerMessageDeflate, response header value), or (None, None)
+        if there is no offer we can accept.
+        """
+        for offer in header.split(','):
+            name, *params = [part.strip() for part in offer.split(';')]
+            if name != 'permessage-deflate':
+                continue
+            options = {}
+            for param in params:
+                key, _, value = param.partition('=')
+                options[key.strip()] = value.strip().strip('"')
+            response = ['permessage-deflate']
+            try:
+                if set(options) - {'server_no_context_takeover', 'client_no_context_takeover',
+                                   'server_max_window_bits', 'client_max_window_bits'}:
+                    continue
+                bits = int(options.get('server_max_window_bits', 15))
+                # zlib can't produce raw deflate with a 256-byte window
+                if not 9 <= bits <= 15 or not 8 <= int(options.get('client_max_window_bits') or 15) <= 15:
+                    continue
+            except ValueError:
+                continue
+            if 'server_no_context_takeover' in options:
+                response.append('server_no_context_takeover')
+            if 'client_no_context_takeover' in options:
+                response.append('client_no_context_takeover')
+            if 'server_max_window_bits' in options:
+                response.append(f'server_max_window_bits={bits}')
+            return cls('server_no_context_takeover' in options, bits), '; '.join(response)
+        return None, None
+
+    def compress_frame(self, frame):
+        """The compressed version of a frame from create_websocket_frame, or the frame itself
+        if it is a control frame or below WS_DEFLATE_THRESHOLD"""
+        opcode = frame[0] & 0x0F
+        offset = {126: 4, 127: 10}.get(frame[1] & 0x7F, 2)
+        if opcode >= 0x8 or len(frame) - offset < WS_DEFLATE_THRESHOLD:
+            return frame
+        payload = frame[offset:]
+        data = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.server_no_context_takeover:
+            self._compressor = self._new_compressor()
+        # A sync flush always ends with an empty stored block, which the receiver adds back
+        data = data[:-4]
+        WS_DEFLATE_BYTES.labels('in').inc(len(payload))
+        WS_DEFLATE_BYTES.labels('out').inc(len(data))
+        return create_websocket_frame(data, opcode, compressed=True)
+
+    def decompress(self, payload, max_size):
+        try:
+            data = self._decompressor.decompress(payload + b'\x00\x00\xff\xff', max_size + 1)
+        except zlib.error as e:
+            raise WebSocketProtocolError(f"Invalid compressed message: {e}", close_code=1007)
+        if len(data) > max_size:
+            raise WebSocketProtocolError("Message too big", close_code=1009)
+        return data
+
+class WebSocketClient:
+    """One connected WebSocket client; only touched from the asyncio loop.
+
+    Outgoing frames go through a bounded queue drained by the client's own
+    writer task, so a slow viewer only ever delays itself. When the queue
+    overflows the queued frames are thrown away and the writer sends one
+    fresh snapshot instead (latest state wins).
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.auth_token = None
+        self.binary = False  # State frames in the binary format instead of JSON
+        self.deflate = None  # PerMessageDeflate once negotiated in the handshake
+        self.compress = False  # Compress outgoing frames (toggled by the client)
+        self.event_stream = False  # An SSE connection: gets state events, not frames
+        self.queue = collections.deque()
+        self.resync_pending = False
+        self.lagging = False
+        self.dropped_frames = 0
+        self._ready = asyncio.Event()
+
+    def send(self, frame):
+        WS_QUEUE_DEPTH.observe(len(self.queue))
+        if len(self.queue) >= WS_SEND_QUEUE_DEPTH:
+            self.dropped_frames += len(self.queue)
+            WS_DROPPED_FRAMES.inc(len(self.queue))
+            self.queue.clear()
+            self.resync_pending = True
+            if not self.lagging:
+                self.lagging = True
+                log.warning("WebSocket client %s is lagging, collapsing its queue to a snapshot", self.peer)
+        else:
+            self.queue.append(frame)
+        self._ready.set()
 
-    # Add the payload
-    frame.extend(data)
-    return frame
+    def send_json(self, message):
+        self.send(create_websocket_frame(json.dumps(message)))
 
-def handle_websocket_handshake(client_socket):
-    """Handle the WebSocket handshake"""
-    try:
-        # Receive the handshake request
-        data = client_socket.recv(1024).decode('utf-8')
-        if not data:
-            return False
+    def request_snapshot(self):
+        """Have the writer send the full state as of when it gets to it"""
+        self.resync_pending = True
+        self._ready.set()
 
-        # Parse the Sec-WebSocket-Key header
-        key = None
-        for line in data.split('\r\n'):
-            if line.startswith('Sec-WebSocket-Key:'):
-                key = line.split(':')[1].strip()
-                break
+    def snapshot(self):
+        """The full state in this client's format"""
+        if self.event_stream:
+            return encoded_state().event
+        return binary_state_frame() if self.binary else snapshot_frame()
+
+    async def run_writer(self):
+        """Drain the send queue; gives up on the client if a write stalls too long"""
+        try:
+            while not self.writer.is_closing():
+                await self._ready.wait()
+                self._ready.clear()
+                while self.queue or self.resync_pending:
+                    if self.resync_pending:
+                        # The snapshot supersedes anything still queued
+                        self.resync_pending = False
+                        self.queue.clear()
+                        frame = self.snapshot()
+                    else:
+                        frame = self.queue.popleft()
+                    if self.compress:
+                        frame = self.deflate.compress_frame(frame)
+                    start = time.perf_counter()
+                    self.writer.write(frame)
+                    await asyncio.wait_for(self.writer.drain(), timeout=WS_SEND_TIMEOUT)
+                    WS_SEND_SECONDS.observe(time.perf_counter() - start)
+                self.lagging = False
+        except asyncio.TimeoutError:
+            log.warning("Dropping WebSocket client %s: send stalled for %ss", self.peer, WS_SEND_TIMEOUT)
+            # abort() rather than close(): close() would wait to flush the stalled buffer
+            self.writer.transport.abort()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+async def handle_websocket_handshake(request, writer, client):
+    """Answer a WebSocket upgrade request, negotiating permessage-deflate if the client offers it"""
+    try:
+        # The Sec-WebSocket-Key and Sec-WebSocket-Extensions headers
+        key = request.header('sec-websocket-key')
+        extensions = request.header('sec-websocket-extensions')
 
         if not key:
             return False
 
+        extension_header = ''
+        if WS_DEFLATE and extensions:
+            client.deflate, accepted = PerMessageDeflate.negotiate(extensions)
+            if client.deflate is not None:
+                client.compress = True
+                extension_header = f'Sec-WebSocket-Extensions: {accepted}\r\n'
+
         # Create the WebSocket accept key
         accept_key = key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
         accept_key = base64.b64encode(hashlib.sha1(accept_key.encode()).digest()).decode()
@@ -591,584 +1170,1172 @@ def handle_websocket_handshake(client_socket):
             'HTTP/1.1 101 Switching Protocols\r\n'
             'Upgrade: websocket\r\n'
             'Connection: Upgrade\r\n'
-            f'Sec-WebSocket-Accept: {accept_key}\r\n\r\n'
+            f'Sec-WebSocket-Accept: {accept_key}\r\n'
+            f'{extension_header}\r\n'
         )
-        client_socket.sendall(response.encode())
+        writer.write(response.encode())
+        await writer.drain()
         return True
     except Exception as e:
-        print(f"Handshake error: {e}")
+        log.error("Handshake error: %s", e)
         return False
 
-def handle_websocket_client(client_socket):
+async def handle_connection(reader, writer):
+    """Serve one connection: HTTP requests, kept alive, until one of them
+    upgrades to a WebSocket or opens the event stream"""
+    port = writer.get_extra_info('sockname')[1]
+    try:
+        while True:
+            try:
+                request = await pacemaker_http.read_request(reader, HTTP_KEEP_ALIVE_TIMEOUT)
+                if request is None:
+                    break
+                if request.header('upgrade', '').lower() == 'websocket':
+                    await handle_websocket_client(reader, writer, request)
+                    return
+                if request.method == 'GET' and request.path == '/api/stream':
+                    await handle_event_stream(reader, writer, request)
+                    return
+                body = await pacemaker_http.read_body(reader, request, HTTP_MAX_BODY_SIZE)
+            except pacemaker_http.HTTPError as e:
+                await pacemaker_http.send_error(writer, e.status)
+                break
+            if not await pacemaker_http.respond_wsgi(app, request, body, writer, wsgi_executor, port):
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        log.error("HTTP connection error: %s", e)
+    finally:
+        writer.close()
+
+async def handle_event_stream(reader, writer, request):
+    """Server-Sent Events from the event loop: the same fan-out and cached
+    state encoding as the WebSocket clients, and no thread per stream"""
+    client = WebSocketClient(reader, writer)
+    client.event_stream = True
+    writer.write(b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: text/event-stream; charset=utf-8\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'X-Accel-Buffering: no\r\n'
+                 b'Access-Control-Allow-Origin: *\r\n'
+                 b'Connection: close\r\n\r\n')
+    writer_task = asyncio.create_task(client.run_writer())
+    stream_clients.append(client)
+    SSE_CLIENTS.labels('unified').inc()
+
+    # Resume after the last event the browser saw when it reconnects
+    try:
+        last_seen = int(request.header('last-event-id', -1))
+    except ValueError:
+        last_seen = -1
+    if last_seen != pacemaker_state.version:
+        client.request_snapshot()
+    try:
+        # Nothing more is expected from the client; this returns when it goes away
+        while await reader.read(4096):
+            pass
+    finally:
+        stream_clients.remove(client)
+        SSE_CLIENTS.labels('unified').dec()
+        writer_task.cancel()
+
+async def handle_websocket_client(reader, writer, request):
     """Handle communication with a WebSocket client"""
-    global connected_clients, current_state
+    client = WebSocketClient(reader, writer)
 
     # Perform the WebSocket handshake
-    if not handle_websocket_handshake(client_socket):
-        print("Handshake failed")
-        try:
-            client_socket.close()
-        except:
-            pass
+    if not await handle_websocket_handshake(request, writer, client):
+        log.warning("Handshake failed")
+        writer.close()
         return
 
+    # Keep the kernel buffer small so a stalled client backs up into its
+    # own queue, where stale frames can be collapsed
+    writer.transport.set_write_buffer_limits(high=WS_WRITE_BUFFER_HIGH)
+    writer_task = asyncio.create_task(client.run_writer())
+
     # Add the client to the connected clients list
-    connected_clients.append(client_socket)
-    print(f"New WebSocket client connected: {client_socket.getpeername()}")
+    connected_clients.append(client)
+    log.info("New WebSocket client connected: %s%s", client.peer,
+             " (permessage-deflate)" if client.deflate else "")
 
     # Send the initial state
-    try:
-        initial_state = json.dumps(current_state)
-        client_socket.sendall(create_websocket_frame(initial_state))
-    except Exception as e:
-        print(f"Error sending initial state: {e}")
+    send_snapshot(client)
 
-    # Process client messages
-    client_auth_token = None
+    # Process client messages - the loop just awaits data, no polling
+    decoder = WebSocketFrameDecoder(deflate=client.deflate)
     try:
-        while True:
-            try:
-                # Set a timeout for receive operations
-                client_socket.settimeout(0.5)
-                data = client_socket.recv(1024)
-                if not data:
-                    break
-
-                # Parse the WebSocket frame
-                message = parse_websocket_frame(data)
-                if not message:
-                    continue
+        closing = False
+        while not closing:
+            data = await reader.read(4096)
+            if not data:
+                break
 
-                # Process the message as JSON
-                try:
-                    parsed = json.loads(message)
-                    
-                    # Handle authentication
-                    if 'token' in parsed:
-                        client_auth_token = parsed['token']
-                        print(f"Client authenticated with token: {client_auth_token}")
-                        
-                        # Send confirmation
-                        response = json.dumps({
-                            "type": "info",
-                            "message": "Authentication successful"
-                        })
-                        client_socket.sendall(create_websocket_frame(response))
-                    
-                    # Handle control updates
-                    elif 'type' in parsed and parsed['type'] == 'control_update' and 'updates' in parsed:
-                        # Check if this is an admin token or allow sensitivity updates for all
-                        if client_auth_token == 'pacemaker_token_123':
-                            # Admin can update everything
-                            apply_control_updates(parsed['updates'])
-                            response = json.dumps({
-                                "type": "info",
-                                "message": "Control updated successfully"
-                            })
-                            client_socket.sendall(create_websocket_frame(response))
-                        elif client_auth_token and ('vSensitivity' in parsed['updates'] or 'aSensitivity' in parsed['updates']):
-                            # Non-admin can only update sensitivity
-                            updates = {
-                                k: v for k, v in parsed['updates'].items() 
-                                if k in ['vSensitivity', 'aSensitivity']
-                            }
-                            apply_control_updates(updates)
-                            response = json.dumps({
-                                "type": "info",
-                                "message": "Sensitivity updated successfully"
-                            })
-                            client_socket.sendall(create_websocket_frame(response))
-                        else:
-                            # Unauthorized
-                            response = json.dumps({
-                                "type": "error",
-                                "message": "Unauthorized control update"
-                            })
-                            client_socket.sendall(create_websocket_frame(response))
-                except json.JSONDecodeError:
-                    print(f"Invalid JSON from client: {message}")
-
-            except socket.timeout:
-                # This is just a timeout on the socket.recv - continue the loop
-                pass
-            except Exception as e:
-                print(f"Error processing client message: {e}")
+            try:
+                messages = decoder.feed(data)
+            except WebSocketProtocolError as e:
+                log.error("WebSocket protocol error from %s: %s", client.peer, e)
+                writer.write(create_websocket_frame(e.close_code.to_bytes(2, 'big'), opcode=0x8))
+                await writer.drain()
                 break
 
+            for opcode, payload in messages:
+                if opcode == 0x1:  # Text frame
+                    try:
+                        handle_client_message(client, payload.decode('utf-8'))
+                    except Exception as e:
+                        log.error("Error processing client message: %s", e)
+                        closing = True
+                        break
+                elif opcode == 0x8:  # Close - echo the status code back and stop
+                    writer.write(create_websocket_frame(payload[:2], opcode=0x8))
+                    await writer.drain()
+                    closing = True
+                    break
+                elif opcode == 0x9:  # Ping
+                    client.send(create_websocket_frame(payload, opcode=0xA))
+
     except Exception as e:
-        print(f"WebSocket client error: {e}")
+        log.error("WebSocket client error: %s", e)
     finally:
-        if client_socket in connected_clients:
-            connected_clients.remove(client_socket)
-        try:
-            client_socket.close()
-        except:
-            pass
-        print(f"WebSocket client disconnected")
+        if client in connected_clients:
+            connected_clients.remove(client)
+        writer_task.cancel()
+        writer.close()
+        log.info("WebSocket client disconnected")
+
+def handle_client_message(client, message):
+    """Process one text message from a WebSocket client"""
+    # Process the message as JSON
+    try:
+        parsed = json.loads(message)
+    except json.JSONDecodeError:
+        # Only the start: a client can send up to WS_MAX_MESSAGE_SIZE
+        log.warning("Invalid JSON from client: %s", message[:200])
+        return
+
+    # Handle authentication
+    if 'token' in parsed:
+        client.auth_token = parsed['token']
+        log.info("Client authenticated with token: %s", client.auth_token)
+
+        # Clients may ask for state frames in the compact binary format
+        wire_format = parsed.get('format', 'binary' if client.binary else 'json')
+        if wire_format not in ('json', 'binary'):
+            client.send_json({"type": "error", "message": f"Unknown format: {wire_format}"})
+            return
+        switch_format = client.binary != (wire_format == 'binary')
+        client.binary = wire_format == 'binary'
+
+        # Send confirmation
+        client.send_json({
+            "type": "info",
+            "message": "Authentication successful",
+            "format": wire_format
+        })
+
+        # Restart the stream in the chosen format
+        if switch_format:
+            client.send(binary_state_frame() if client.binary else snapshot_frame())
+
+    # Client lost track of the delta sequence - send everything again
+    elif parsed.get('type') == 'resync':
+        send_snapshot(client)
+
+    # Turn compression of outgoing frames off (or back on) for this connection;
+    # only possible if permessage-deflate was negotiated
+    elif parsed.get('type') == 'compression':
+        client.compress = client.deflate is not None and bool(parsed.get('enabled', True))
+        client.send_json({"type": "info", "message": "Compression updated", "compression": client.compress})
+
+    # Handle control updates
+    elif 'type' in parsed and parsed['type'] == 'control_update' and 'updates' in parsed:
+        # Check if this is an admin token or allow sensitivity updates for all
+        if client.auth_token == 'pacemaker_token_123':
+            # Admin can update everything
+            queue_client_updates(client, parsed['updates'], "Control updated successfully")
+        elif client.auth_token and ('vSensitivity' in parsed['updates'] or 'aSensitivity' in parsed['updates']):
+            # Non-admin can only update sensitivity
+            updates = {
+                k: v for k, v in parsed['updates'].items() 
+                if k in ['vSensitivity', 'aSensitivity']
+            }
+            queue_client_updates(client, updates, "Sensitivity updated successfully")
+        else:
+            # Unauthorized
+            client.send_json({
+                "type": "error",
+                "message": "Unauthorized control update"
+            })
+
+def queue_client_updates(client, updates, success_message):
+    """Queue a client's control updates and answer it once they are applied.
+
+    The event loop doesn't wait for the state-owner thread; the reply is
+    handed back to the loop when the command completes.
+    """
+    def reply(result, error):
+        if error is None:
+            message = {"type": "info", "message": success_message}
+        else:
+            message = {"type": "error", "message": str(error)}
+        ws_loop.call_soon_threadsafe(client.send_json, message)
+
+    state_commands.post('ws_controls', apply_controls_command, updates, on_done=reply)
+
+# Alternate spellings accepted for control keys (the REST API uses snake_case)
+CONTROL_KEY_ALIASES = {
+    'a_sensitivity': 'aSensitivity',
+    'v_sensitivity': 'vSensitivity',
+}
+
+def _convert_control(key, value, kind):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid {key}: {value!r}')
+
+def validate_control_updates(updates):
+    """Check a batch of control updates against the limits without applying anything.
+
+    Returns the updates converted to the types we store, with outputs and
+    sensitivities snapped to their ladders; raises ValueError naming the first
+    invalid field.
+    """
+    if not isinstance(updates, dict):
+        raise ValueError('Updates must be an object')
+
+    validated = {}
+    for key, value in updates.items():
+        key = CONTROL_KEY_ALIASES.get(key, key)
+        if key == 'rate':
+            value = _convert_control(key, value, int)
+            if not min_rate <= value <= max_rate:
+                raise ValueError(f'rate out of range ({min_rate}-{max_rate})')
+        elif key in ('a_output', 'v_output'):
+            low, high = (min_a_output, max_a_output) if key == 'a_output' else (min_v_output, max_v_output)
+            value = _convert_control(key, value, float)
+            if not low <= value <= high:
+                raise ValueError(f'{key} out of range ({low}-{high})')
+            value = VALUE_LADDERS[key].snap(value)
+        elif key in ('aSensitivity', 'vSensitivity'):
+            low, high = ((min_a_sensitivity, max_a_sensitivity) if key == 'aSensitivity'
+                         else (min_v_sensitivity, max_v_sensitivity))
+            value = _convert_control(key, value, float)
+            if not (value == ASYNC or low <= value <= high):
+                raise ValueError(f'{key} out of range ({low}-{high} or 0)')
+            value = VALUE_LADDERS[key].snap(value)
+        elif key == 'mode':
+            value = _convert_control(key, value, int)
+            if not 0 <= value <= 7:
+                raise ValueError('Invalid mode value')
+        elif key == 'active_control':
+            if value not in ('none', 'a_sensitivity', 'v_sensitivity'):
+                raise ValueError('Invalid active control value')
+        elif key == 'isLocked':
+            # bool() would take "false" as True
+            if not isinstance(value, bool):
+                raise ValueError(f'Invalid {key}: {value!r}')
+        else:
+            raise ValueError(f'Unknown control: {key}')
+        validated[key] = value
+    return validated
 
 def apply_control_updates(updates):
-    """Apply updates from client to the current state"""
-    global current_state, a_sensitivity, v_sensitivity, current_rate, current_a_output, current_v_output, is_locked
-    
-    # Only apply specific updates that we support
-    if 'aSensitivity' in updates:
-        a_sensitivity = float(updates['aSensitivity'])
-        current_state["aSensitivity"] = a_sensitivity
-    
-    if 'vSensitivity' in updates:
-        v_sensitivity = float(updates['vSensitivity'])
-        current_state["vSensitivity"] = v_sensitivity
-    
-    if 'rate' in updates:
-        current_rate = int(updates['rate'])
-        current_state["rate"] = current_rate
-        rate_encoder.steps = current_rate
-        if hasattr(update_rate, 'last_steps'):
-            update_rate.last_steps = current_rate
-
-    if 'a_output' in updates:
-        current_a_output = float(updates['a_output'])
-        current_state["a_output"] = current_a_output
-        a_output_encoder.steps = int(current_a_output * 10)  # Optional: depends on scale
-        last_a_output_steps = a_output_encoder.steps
-
-    if 'v_output' in updates:
-        current_v_output = float(updates['v_output'])
-        current_state["v_output"] = current_v_output
-        v_output_encoder.steps = int(current_v_output * 10)
-        last_v_output_steps = v_output_encoder.steps
+    """Validate a batch of updates from a client and apply all of them or none.
 
+    Everything is applied under the state lock and lands in the shared state as
+    a single version, so viewers never see half a batch. Returns the applied
+    values; raises ValueError if any field is invalid.
+    """
+    updates = validate_control_updates(updates)
     
-    if 'isLocked' in updates:
-        is_locked = bool(updates['isLocked'])
-        current_state["isLocked"] = is_locked
+    # Entering DOO applies the emergency settings on top of whatever else was sent
+    if updates.get('mode') == 5:
+        updates.update(rate=80, a_output=max_a_output, v_output=max_v_output)
     
-    # Update the timestamp
-    current_state["lastUpdate"] = time.time()
+    with pacemaker_state:
+        fields = {}
+        
+        if 'aSensitivity' in updates:
+            fields['a_sensitivity'] = updates['aSensitivity']
+        
+        if 'vSensitivity' in updates:
+            fields['v_sensitivity'] = updates['vSensitivity']
+        
+        if 'rate' in updates:
+            fields['rate'] = updates['rate']
+            rate_encoder.steps = updates['rate']
+
+        if 'a_output' in updates:
+            fields['a_output'] = updates['a_output']
+            a_output_encoder.steps = int(updates['a_output'] * 10)  # Optional: depends on scale
+
+        if 'v_output' in updates:
+            fields['v_output'] = updates['v_output']
+            v_output_encoder.steps = int(updates['v_output'] * 10)
+
+        if 'mode' in updates:
+            fields['mode'] = updates['mode']
+
+        if 'active_control' in updates and updates['active_control'] != pacemaker_state.active_control:
+            fields['active_control'] = updates['active_control']
+            # Changing controls restarts mode encoder tracking, as in /api/sensitivity/set
+            fields['last_mode_steps'] = None
+            if updates['active_control'] == 'none':
+                mode_output_encoder.steps = 50  # Neutral position
+            fields['last_mode_activity'] = time.time()
+        
+        if 'isLocked' in updates:
+            fields['is_locked'] = updates['isLocked']
+        
+        # One write: one version bump and one broadcast for the whole batch
+        pacemaker_state.update(**fields)
+    
+    return updates
+
+# Binary wire format, chosen per client with {"token": ..., "format": "binary"}.
+# Frames are WebSocket binary frames, little-endian, starting with a message
+# type byte and the state version (uint32):
+#   1 state      rate (uint16, ppm), a_output, v_output (uint16, 0.1 mA),
+#                aSensitivity, vSensitivity (uint16, 0.1 mV), mode (uint8),
+#                flags (uint8: bit 0 locked, bit 1 paused), pauseTimeLeft
+#                (uint16, s), batteryLevel (uint8, %), lastUpdate (float64, unix time)
+#   2 heartbeat  nothing else
+# Every change sends the whole 28-byte state, so binary clients never need
+# deltas or resyncs. Outputs and sensitivities are exact in tenths because
+# they are always rungs of their value ladders.
+# Only state and heartbeats are binary. Every other message to a binary
+# client (auth replies, errors, button, replay and replay_status) is the same
+# JSON text frame the JSON clients get, so clients tell the two apart by
+# opcode: in a browser, event.data is a string for text and an ArrayBuffer
+# (or Blob) for binary.
+BINARY_STATE = struct.Struct('<BIHHHHHBBHBd')
+BINARY_HEARTBEAT = struct.Struct('<BI')
+BINARY_TYPE_STATE = 1
+BINARY_TYPE_HEARTBEAT = 2
+
+def encode_binary_state(seq, state):
+    flags = (1 if state['isLocked'] else 0) | (2 if state['isPaused'] else 0)
+    return BINARY_STATE.pack(
+        BINARY_TYPE_STATE, seq, state['rate'],
+        round(state['a_output'] * 10), round(state['v_output'] * 10),
+        round(state['aSensitivity'] * 10), round(state['vSensitivity'] * 10),
+        state['mode'], flags, state['pauseTimeLeft'], state['batteryLevel'], state['lastUpdate'])
+
+EncodedState = collections.namedtuple('EncodedState', 'seq json frame event binary')
+
+def _encode_state(seq, state):
+    start = time.perf_counter()
+    body = json.dumps(state).encode()
+    frame = create_websocket_frame(b'{"type": "snapshot", "seq": %d, "state": %s}' % (seq, body))
+    event = b'id: %d\nevent: state\ndata: %s\n\n' % (seq, body)
+    binary = create_websocket_frame(encode_binary_state(seq, state), opcode=0x2)
+    SERIALIZATION_SECONDS.labels('snapshot').observe(time.perf_counter() - start)
+    return EncodedState(seq, body, frame, event, binary)
+
+def encoded_state():
+    """The full state serialized once per version as JSON, a WebSocket frame and an SSE event"""
+    return pacemaker_state.cached('state', _encode_state)
+
+def state_json():
+    """JSON bytes of the full state, serialized once per state version"""
+    return encoded_state().json
+
+def snapshot_frame():
+    """Frame carrying the full state, built once per state version and shared by all clients"""
+    return encoded_state().frame
+
+def binary_state_frame():
+    """Binary frame carrying the full state, built once per state version"""
+    return encoded_state().binary
+
+def send_snapshot(client):
+    """Send the full state to one client so it can (re)start applying deltas"""
+    client.request_snapshot()
 
 def broadcast_state():
-    """Broadcast the current state to all WebSocket clients"""
-    global connected_clients, current_state
-    
-    if not connected_clients:
+    """Broadcast the keys changed since the last broadcast to all WebSocket clients.
+
+    Clients apply a delta when its base is not newer than the seq they hold
+    (changes are absolute values, so overlap is harmless), skip it when its seq
+    is not newer, and send {"type": "resync"} when they detect a gap.
+    """
+    # Always consume the delta so changes made with nobody listening don't pile up;
+    # a client that joins later gets them in its snapshot
+    delta = pacemaker_state.take_delta()
+    if delta is None or not (connected_clients or stream_clients):
         return
     
     # Create the message
     try:
-        message = json.dumps(current_state)
+        base, seq, changes = delta
+        start = time.perf_counter()
+        message = json.dumps({"type": "delta", "seq": seq, "base": base, "changes": changes})
         frame = create_websocket_frame(message)
-        
-        # Send to all clients
-        clients_to_remove = []
-        for client in connected_clients:
-            try:
-                client.sendall(frame)
-            except Exception as e:
-                print(f"Error sending to client: {e}")
-                clients_to_remove.append(client)
-        
-        # Remove disconnected clients
-        for client in clients_to_remove:
-            if client in connected_clients:
-                connected_clients.remove(client)
-                try:
-                    client.close()
-                except:
-                    pass
+        SERIALIZATION_SECONDS.labels('delta').observe(time.perf_counter() - start)
+        encoded = encoded_state()
+        send_to_all_clients(frame, encoded.binary, encoded.event)
     except Exception as e:
-        print(f"Error broadcasting state: {e}")
+        log.error("Error broadcasting state: %s", e)
 
-def periodic_broadcast():
-    """Periodically broadcast the state to all clients"""
-    while True:
-        try:
-            # Only broadcast if there are clients connected
-            if connected_clients:
-                broadcast_state()
-        except Exception as e:
-            print(f"Error in periodic broadcast: {e}")
-        time.sleep(0.03)  # Broadcast 33 times per second (reduced from 0.05)
-        
-def run_websocket_server():
-    """Run the WebSocket server"""
-    try:
-        # Create a socket
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind(('0.0.0.0', WS_PORT))
-        server_socket.listen(5)
-        
-        print(f"WebSocket server running on port {WS_PORT}")
-        
-        # Start a thread for periodic broadcasts
-        broadcast_thread = threading.Thread(target=periodic_broadcast)
-        broadcast_thread.daemon = True
-        broadcast_thread.start()
-        
-        # Accept client connections
+def send_to_all_clients(frame, binary_frame=None, event=None):
+    """Queue one frame for every connected client (binary_frame, if given, for
+    binary clients) and event, if given, for every /api/stream client.
+
+    Safe to call from any thread: the writes are handed to the asyncio loop,
+    so the caller never waits on a socket.
+    """
+    if ws_loop is None:
+        return
+    ws_loop.call_soon_threadsafe(_write_to_all_clients, frame, binary_frame or frame, event)
+
+def _write_to_all_clients(frame, binary_frame, event):
+    # binary_frame is frame itself for messages with no binary encoding: binary
+    # clients get those as JSON text frames (see BINARY_STATE)
+    start = time.perf_counter()
+    for client in connected_clients:
+        client.send(binary_frame if client.binary else frame)
+    if event is not None:
+        for client in stream_clients:
+            client.send(event)
+    BROADCAST_FANOUT_SECONDS.observe(time.perf_counter() - start)
+
+def broadcast_heartbeat():
+    """Tell idle clients we are alive and which version they should be at"""
+    frames = pacemaker_state.cached('heartbeat', lambda seq, state: (
+        create_websocket_frame(json.dumps({"type": "heartbeat", "seq": seq})),
+        create_websocket_frame(BINARY_HEARTBEAT.pack(BINARY_TYPE_HEARTBEAT, seq), opcode=0x2),
+        # Comment line keeps proxies and the browser from timing out
+        b': keepalive\n\n'))
+    send_to_all_clients(*frames)
+
+# History columns as they appear in replayed states (wire names, like snapshots)
+REPLAY_FIELDS = {
+    'time': 'lastUpdate',
+    'version': 'version',
+    'rate': 'rate',
+    'a_output': 'a_output',
+    'v_output': 'v_output',
+    'a_sensitivity': 'aSensitivity',
+    'v_sensitivity': 'vSensitivity',
+    'mode': 'mode',
+    'locked': 'isLocked',
+}
+REPLAY_WIRE_NAMES = [REPLAY_FIELDS[name] for name in pacemaker_recorder.COLUMN_NAMES]
+REPLAY_BATCH = 256  # Most states in one replay frame
+REPLAY_QUEUE_CHECK = 0.005  # seconds between checks of full client queues
+
+class ReplayEngine:
+    """Re-sends recorded history to every WebSocket client, for debriefs.
+
+    A thread reads the recorded rows from disk a chunk at a time and, when
+    each one is due, sends it as {"type": "replay", "states": [...]}: at
+    speed 1 the gaps between changes are as recorded, at N they are N times
+    shorter, and at speed 0 rows go out as fast as the client queues take
+    them. Rows that fall due together share a frame. Pause, resume, seek and
+    speed changes apply immediately and are announced with a replay_status
+    message. The live state and its broadcasts are left alone.
+    """
+
+    def __init__(self, history):
+        self.history = history
+        self.state = 'idle'  # idle, playing, paused or finished
+        self.speed = 1.0
+        self.start = None
+        self.end = None
+        self.position = None  # Recording time of the last row sent (or the seek target)
+        self.sent = 0
+        self._generation = 0  # Bumped by start/seek/stop: the reader starts over
+        self._anchor_wall = 0.0
+        self._anchor_time = 0.0
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def status(self):
+        with self._changed:
+            return {'state': self.state, 'speed': self.speed, 'start': self.start, 'end': self.end,
+                    'position': self.position, 'sent': self.sent}
+
+    def _announce(self):
+        status = self.status()
+        send_to_all_clients(create_websocket_frame(json.dumps(dict(status, type='replay_status'))))
+        return status
+
+    def _reanchor(self, recording_time):
+        # Playback clock: row t is due at anchor_wall + (t - anchor_time) / speed
+        self._anchor_wall = time.monotonic()
+        self._anchor_time = recording_time
+
+    def play(self, start=None, end=None, speed=1.0):
+        if speed < 0:
+            raise ValueError('Speed must be 0 (as fast as possible) or positive')
+        with self._changed:
+            self.state = 'playing'
+            self.speed = speed
+            self.start = start
+            self.end = end
+            self.position = start
+            self.sent = 0
+            self._generation += 1
+            self._anchor_time = None  # Anchored on the first row
+            self._changed.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='history-replay')
+                self._thread.daemon = True
+                self._thread.start()
+        return self._announce()
+
+    def pause(self):
+        with self._changed:
+            if self.state == 'playing':
+                self.state = 'paused'
+                self._changed.notify_all()
+        return self._announce()
+
+    def resume(self):
+        with self._changed:
+            if self.state == 'paused':
+                self.state = 'playing'
+                if self._anchor_time is not None:
+                    self._reanchor(self.position)
+                self._changed.notify_all()
+        return self._announce()
+
+    def seek(self, position):
+        with self._changed:
+            if self.state == 'idle':
+                raise ValueError('No replay to seek in')
+            if self.state == 'finished':
+                self.state = 'paused'
+            self.position = position
+            self._generation += 1
+            self._anchor_time = None
+            self._changed.notify_all()
+        return self._announce()
+
+    def set_speed(self, speed):
+        if speed < 0:
+            raise ValueError('Speed must be 0 (as fast as possible) or positive')
+        with self._changed:
+            self.speed = speed
+            if self._anchor_time is not None and self.position is not None:
+                self._reanchor(self.position)
+            self._changed.notify_all()
+        return self._announce()
+
+    def stop(self):
+        with self._changed:
+            self.state = 'idle'
+            self._generation += 1
+            self._changed.notify_all()
+        return self._announce()
+
+    def run(self):
         while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self.state == 'playing')
+                generation = self._generation
+                start, end = self.position, self.end
             try:
-                client_socket, address = server_socket.accept()
-                print(f"New connection from {address}")
-                
-                # Handle the client in a separate thread
-                client_thread = threading.Thread(target=handle_websocket_client, args=(client_socket,))
-                client_thread.daemon = True
-                client_thread.start()
+                if self._play(generation, start, end):
+                    with self._changed:
+                        if self._generation == generation:
+                            self.state = 'finished'
+                    self._announce()
             except Exception as e:
-                print(f"Error accepting connection: {e}")
-    except Exception as e:
-        print(f"WebSocket server error: {e}")
-    finally:
+                log.error("Replay error: %s", e)
+                with self._changed:
+                    if self._generation == generation:
+                        self.state = 'idle'
+                self._announce()
+
+    def _play(self, generation, start, end):
+        """Send rows from start until end; returns False if interrupted by start/seek/stop"""
+        rows = self.history.iter_rows(start, end, chunk=REPLAY_BATCH)
         try:
-            server_socket.close()
-        except:
-            pass
+            batch = []
+            for row in rows:
+                while True:
+                    with self._changed:
+                        if self._generation != generation:
+                            return False
+                        if self.state == 'playing':
+                            if self._anchor_time is None:
+                                self._reanchor(row[0])
+                            if self.speed == 0:
+                                break
+                            delay = self._anchor_wall + (row[0] - self._anchor_time) / self.speed - time.monotonic()
+                            if delay <= 0:
+                                break
+                            if not batch:
+                                self._changed.wait(delay)
+                                continue
+                        elif not batch:
+                            self._changed.wait()
+                            continue
+                    # This row isn't due yet: send the ones that are before waiting
+                    self._send(generation, batch)
+                    batch = []
+                batch.append(row)
+                if len(batch) >= REPLAY_BATCH:
+                    self._send(generation, batch)
+                    batch = []
+            if batch:
+                self._send(generation, batch)
+            return True
+        finally:
+            rows.close()
+
+    def _send(self, generation, batch):
+        # As fast as possible still must not overflow the client queues, or
+        # they would collapse to a live snapshot and lose replay frames. A
+        # client that is already lagging isn't waited for, and no client is
+        # waited for longer than a write may stall before it is dropped, so
+        # one dead socket can't hold the replay up for everyone else.
+        deadline = time.monotonic() + WS_SEND_TIMEOUT
+        with self._changed:
+            while any(len(client.queue) >= WS_SEND_QUEUE_DEPTH // 2 and not client.lagging
+                      for client in list(connected_clients)):
+                if self._generation != generation:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Seek and stop notify, so they don't wait for the queues to drain
+                self._changed.wait(min(REPLAY_QUEUE_CHECK, remaining))
+        message = {"type": "replay", "states": [dict(zip(REPLAY_WIRE_NAMES, row)) for row in batch]}
+        with self._changed:
+            if self._generation != generation:
+                return
+            self.position = batch[-1][0]
+            self.sent += len(batch)
+        send_to_all_clients(create_websocket_frame(json.dumps(message)))
+
+
+replay = ReplayEngine(history) if history else None
 
-# Attach event listeners
-rate_encoder.when_rotated = update_rate
-a_output_encoder.when_rotated = update_a_output
-v_output_encoder.when_rotated = update_v_output
-mode_output_encoder.when_rotated = update_mode_output
-lock_button.when_released = toggle_lock
-up_button.when_released = handle_up_button
-down_button.when_released = handle_down_button
-left_button.when_released = handle_left_button
-emergency_button.when_released = handle_emergency_button
+async def serve_connections(ports):
+    """Accept HTTP and WebSocket clients on the asyncio event loop, on every port in ports"""
+    global ws_loop, wsgi_executor
+    ws_loop = asyncio.get_running_loop()
+    wsgi_executor = ThreadPoolExecutor(pacemaker_http.THREADS, thread_name_prefix='wsgi')
+
+    servers = [await asyncio.start_server(handle_connection, '0.0.0.0', port, backlog=128) for port in ports]
+    log.info("Server running on port %s", ', '.join(str(port) for port in ports))
+
+    # Start the thread that pushes state changes to clients
+    broadcast_thread = threading.Thread(target=broadcast_scheduler.run)
+    broadcast_thread.daemon = True
+    broadcast_thread.start()
+
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+def run_websocket_server():
+    """Run the WebSocket server on WS_PORT (used when Flask is served separately)"""
+    try:
+        asyncio.run(serve_connections([WS_PORT]))
+    except Exception as e:
+        log.error("WebSocket server error: %s", e)
+
+def run_unified_server():
+    """Serve REST, WebSocket and SSE on HTTP_PORT (and WebSockets on WS_PORT) from one loop"""
+    asyncio.run(serve_connections([HTTP_PORT, WS_PORT]))
+
+# Attach event listeners - the GPIO threads only queue a command
+rate_detents = DetentAccumulator('rate_encoder', rate_encoder, update_rate,
+                                 ENCODER_ACCELERATION['rate_encoder'])
+a_output_detents = DetentAccumulator('a_output_encoder', a_output_encoder, update_a_output,
+                                     ENCODER_ACCELERATION['a_output_encoder'])
+v_output_detents = DetentAccumulator('v_output_encoder', v_output_encoder, update_v_output,
+                                     ENCODER_ACCELERATION['v_output_encoder'])
+mode_output_encoder.when_rotated = state_commands.handler('mode_encoder', update_mode_output)
+button_gestures = pacemaker_buttons.ButtonGestures(BUTTON_GESTURES, post_button_gesture)
+for name, button in (('lock', lock_button), ('up', up_button), ('down', down_button),
+                     ('left', left_button), ('emergency', emergency_button)):
+    button_gestures.attach(name, button)
+button_gestures.start()
+state_commands.start()
+
+@app.errorhandler(DeviceLockedError)
+def device_locked(e):
+    return jsonify({'error': str(e)}), 403
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    # Label by route pattern, not path, so the number of series stays fixed
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUEST_SECONDS.labels(route, request.method, response.status_code).observe(
+        time.perf_counter() - g.request_start)
+    return response
+
+# Recent log records, oldest first: ?since=<seq> for only newer ones,
+# ?level=warning to filter, ?limit=N (default 200)
+@app.route('/api/logs', methods=['GET'])
+def get_logs():
+    since = request.args.get('since', -1, type=int)
+    limit = request.args.get('limit', 200, type=int)
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    try:
+        level = pacemaker_log.parse_level(request.args.get('level'), pacemaker_log.DEBUG)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    records, next_since = log.records(since, level, limit)
+    return jsonify({'records': records, 'next': next_since})
+
+# Button presses after ?since=<cursor>, oldest first, with next to pass back
+# as since and missed for presses that fell out of the buffer. ?wait=<seconds>
+# (at most LONG_POLL_TIMEOUT) holds the request until there is one; without
+# since, returns just the current cursor to start from
+@app.route('/api/events', methods=['GET'])
+def get_button_events():
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'events': [], 'next': button_events.cursor, 'missed': 0})
+    if since < 0:
+        return jsonify({'error': 'since must not be negative'}), 400
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    wait = min(max(request.args.get('wait', 0.0, type=float), 0.0), LONG_POLL_TIMEOUT)
+    if wait:
+        button_events.wait(since, wait)
+    events, next_cursor, missed = button_events.since(since, limit)
+    return jsonify({'events': events, 'next': next_cursor, 'missed': missed})
+
+# Recorded parameter history with ?start= <= time < ?end= (unix seconds), as
+# one list per column; ?columns=rate,mode to pick columns, ?limit=N (default
+# 10000). When the limit cuts the range short, pass next back as start
+@app.route('/api/history', methods=['GET'])
+def get_history():
+    if history is None:
+        return jsonify({'error': 'History recording is disabled'}), 404
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    limit = request.args.get('limit', 10000, type=int)
+    columns = request.args.get('columns')
+    try:
+        result = history.query(start, end, limit, columns.split(',') if columns else None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result)
+
+# Replay of the recorded history to the WebSocket clients. Start with
+# {"start": t, "end": t, "speed": 1} (all optional; speed 0 is as fast as
+# possible), then pause/resume/stop, seek {"time": t} or speed {"speed": n}.
+# Every call returns the replay status
+@app.route('/api/replay', methods=['GET'])
+def get_replay():
+    if replay is None:
+        return jsonify({'error': 'History recording is disabled'}), 404
+    return jsonify(replay.status())
+
+@app.route('/api/replay/<action>', methods=['POST'])
+def control_replay(action):
+    if replay is None:
+        return jsonify({'error': 'History recording is disabled'}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        if action == 'start':
+            start, end = data.get('start'), data.get('end')
+            status = replay.play(None if start is None else float(start), None if end is None else float(end),
+                                 float(data.get('speed', 1.0)))
+        elif action == 'pause':
+            status = replay.pause()
+        elif action == 'resume':
+            status = replay.resume()
+        elif action == 'stop':
+            status = replay.stop()
+        elif action == 'seek':
+            status = replay.seek(float(data['time']))
+        elif action == 'speed':
+            status = replay.set_speed(float(data['speed']))
+        else:
+            return jsonify({'error': f'Unknown replay action: {action}'}), 404
+    except KeyError as e:
+        return jsonify({'error': f'Missing {e.args[0]}'}), 400
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(status)
+
+# Counters and histograms in the Prometheus text format
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # New endpoint for WebSocket clients to get full state
+# With ?since=<version> it is a long poll: the request is held until the state
+# moves on from that version, or answered with 304 after LONG_POLL_TIMEOUT.
+# Any other version (e.g. one from before a server restart) gets the state now
 @app.route('/api/state', methods=['GET'])
 def get_full_state():
-    return jsonify(current_state)
+    since = request.args.get('since', type=int)
+    if since is not None and not pacemaker_state.wait_for_change(since, LONG_POLL_TIMEOUT):
+        return Response(status=304, headers={'X-State-Version': str(since)})
+
+    encoded = encoded_state()
+    return Response(encoded.json, mimetype='application/json',
+                    headers={'X-State-Version': str(encoded.seq)})
+
+# Server-Sent Events stream of the full state, pushed only when it changes
+@app.route('/api/stream', methods=['GET'])
+def stream_state():
+    # Resume after the last event the browser saw when it reconnects
+    last_seen = request.headers.get('Last-Event-ID', -1, type=int)
+
+    def events():
+        seq = last_seen
+        cursor = button_events.cursor
+        connections = SSE_CLIENTS.labels('wsgi')
+        connections.inc()
+        try:
+            while True:
+                if pacemaker_state.wait_for_change(seq, SSE_KEEPALIVE_INTERVAL):
+                    # Let a burst of changes settle into one event
+                    time.sleep(BROADCAST_COALESCE_WINDOW)
+                    # A button press touches the state, so it wakes this up too
+                    presses, cursor, _ = button_events.since(cursor)
+                    for event in presses:
+                        yield button_event_message(event)[1]
+                    encoded = encoded_state()
+                    seq = encoded.seq
+                    yield encoded.event
+                else:
+                    # Comment line keeps proxies and the browser from timing out
+                    yield b': keepalive\n\n'
+        finally:
+            # The server closes the generator once a write fails after the client left
+            connections.dec()
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # API endpoints for Lock status
 @app.route('/api/lock', methods=['GET'])
 def get_lock():
     return jsonify({
-        'locked': is_locked
+        'locked': pacemaker_state.is_locked
     })
 
 @app.route('/api/lock/toggle', methods=['POST'])
 def set_lock():
-    toggle_lock()  # Use the same function to ensure consistent behavior
+    is_locked = state_commands.call('toggle_lock', toggle_lock)  # Use the same function to ensure consistent behavior
     return jsonify({'success': True, 'locked': is_locked})
 
 # API endpoints for Rate
 @app.route('/api/rate', methods=['GET'])
 def get_rate():
-    update_rate()
+    state_commands.call('rate_encoder', update_rate)
     return jsonify({
-        'value': current_rate,
+        'value': pacemaker_state.rate,
         'min': min_rate,
         'max': max_rate
     })
 
+def set_rate_command(new_rate):
+    # Check if locked, but allow in DOO mode
+    require_unlocked()
+    rate = max(min_rate, min(int(new_rate), max_rate))
+    rate_encoder.steps = rate
+    pacemaker_state.update(rate=rate)
+    log.info("Rate updated: %s ppm", rate)
+    return pacemaker_state.rate
+
 @app.route('/api/rate/set', methods=['POST'])
 def set_rate():
-    global current_rate
-    # Check if locked, but allow in DOO mode
-    if is_locked:
-        return jsonify({'error': 'Device is locked'}), 403
-        
     data = request.json
     if 'value' in data:
         new_rate = int(data['value'])
-        rate_encoder.steps = new_rate
-        update_rate()
-        return jsonify({'success': True, 'value': current_rate})
+        value = state_commands.call('set_rate', set_rate_command, new_rate)
+        return jsonify({'success': True, 'value': value})
     return jsonify({'error': 'No value provided'}), 400
 
+def reset_rate_command():
+    # if is_locked or current_mode == 5:  # 5 = DOO mode
+    require_unlocked('Device is locked ')  # removed dooo mode error
+    reset_rate()
+    return pacemaker_state.rate
+
 @app.route('/api/rate/reset', methods=['POST'])
 def api_reset_rate():
     # Check if locked
-    # if is_locked or current_mode == 5:  # 5 = DOO mode
-    if is_locked:
-        return jsonify({'error': 'Device is locked '}), 403 # removed dooo mode error 
-        
-    reset_rate()
-    return jsonify({'success': True, 'value': current_rate})
+    value = state_commands.call('reset_rate', reset_rate_command)
+    return jsonify({'success': True, 'value': value})
+
+def set_output_command(name, value):
+    """Set a_output or v_output to the legal value nearest to value"""
+    # Check if locked, but allow in DOO mode
+    require_unlocked()
+    # Snapping to the ladder also keeps it within bounds
+    value = VALUE_LADDERS[name].snap(value)
+    # Update state
+    pacemaker_state.update(**{name: value})
+    return value
+
+def reset_output_command(reset):
+    require_unlocked()
+    if pacemaker_state.mode == 5:  # 5 = DOO mode
+        raise DeviceLockedError('Device is locked or in DOO mode')
+    reset()
 
 # API endpoints for A. Output
 @app.route('/api/a_output', methods=['GET'])
 def get_a_output():
-    update_a_output()
+    state_commands.call('a_output_encoder', update_a_output)
     return jsonify({
-        'value': current_a_output,
+        'value': pacemaker_state.a_output,
         'min': min_a_output,
         'max': max_a_output
     })
 
 @app.route('/api/a_output/set', methods=['POST'])
 def set_a_output():
-    global current_a_output, last_a_output_steps
-    # Check if locked, but allow in DOO mode
-    if is_locked:
-        return jsonify({'error': 'Device is locked'}), 403
-        
     data = request.json
     if 'value' in data:
         new_a_output = float(data['value'])
-        # Apply the new value
-        current_a_output = new_a_output
-        # Round to the nearest valid step size
-        step_size = get_output_step_size(current_a_output)
-        current_a_output = round(current_a_output / step_size) * step_size
-        # Make sure it's within bounds
-        current_a_output = max(min_a_output, min(current_a_output, max_a_output))
-        # Update state
-        current_state["a_output"] = current_a_output
-        current_state["lastUpdate"] = time.time()
-        return jsonify({'success': True, 'value': current_a_output})
+        new_a_output = state_commands.call('set_a_output', set_output_command, 'a_output', new_a_output)
+        return jsonify({'success': True, 'value': new_a_output})
     return jsonify({'error': 'No value provided'}), 400
 
 @app.route('/api/a_output/reset', methods=['POST'])
 def api_reset_a_output():
     # Check if locked
-    if is_locked or current_mode == 5:  # 5 = DOO mode
+    try:
+        state_commands.call('reset_a_output', reset_output_command, reset_a_output)
+    except DeviceLockedError:
         return jsonify({'error': 'Device is locked or in DOO mode'}), 403
-        
-    reset_a_output()
-    return jsonify({'success': True, 'value': current_a_output})
+    return jsonify({'success': True, 'value': pacemaker_state.a_output})
 
 # API endpoints for V. Output
 @app.route('/api/v_output', methods=['GET'])
 def get_v_output():
-    update_v_output()
+    state_commands.call('v_output_encoder', update_v_output)
     return jsonify({
-        'value': current_v_output,
+        'value': pacemaker_state.v_output,
         'min': min_v_output,
         'max': max_v_output
     })
 
 @app.route('/api/v_output/set', methods=['POST'])
 def set_v_output():
-    global current_v_output, last_v_output_steps
-    # Check if locked, but allow in DOO mode
-    if is_locked:
-        return jsonify({'error': 'Device is locked'}), 403
-        
     data = request.json
     if 'value' in data:
         new_v_output = float(data['value'])
-        # Apply the new value
-        current_v_output = new_v_output
-        # Round to the nearest valid step size
-        step_size = get_output_step_size(current_v_output)
-        current_v_output = round(current_v_output / step_size) * step_size
-        # Make sure it's within bounds
-        current_v_output = max(min_v_output, min(current_v_output, max_v_output))
-        # Update state
-        current_state["v_output"] = current_v_output
-        current_state["lastUpdate"] = time.time()
-        return jsonify({'success': True, 'value': current_v_output})
+        new_v_output = state_commands.call('set_v_output', set_output_command, 'v_output', new_v_output)
+        return jsonify({'success': True, 'value': new_v_output})
     return jsonify({'error': 'No value provided'}), 400
 
 @app.route('/api/v_output/reset', methods=['POST'])
 def api_reset_v_output():
     # Check if locked
-    if is_locked or current_mode == 5:  # 5 = DOO mode
+    try:
+        state_commands.call('reset_v_output', reset_output_command, reset_v_output)
+    except DeviceLockedError:
         return jsonify({'error': 'Device is locked or in DOO mode'}), 403
-        
-    reset_v_output()
-    return jsonify({'success': True, 'value': current_v_output})
-    
+    return jsonify({'success': True, 'value': pacemaker_state.v_output})
+
 # New API endpoint for sensitivity controls
 @app.route('/api/sensitivity', methods=['GET'])
 def get_sensitivity():
-    return jsonify({
-        'a_sensitivity': a_sensitivity,
-        'v_sensitivity': v_sensitivity,
-        'active_control': active_control
-    })
+    with pacemaker_state:
+        return jsonify({
+            'a_sensitivity': pacemaker_state.a_sensitivity,
+            'v_sensitivity': pacemaker_state.v_sensitivity,
+            'active_control': pacemaker_state.active_control
+        })
+
+def set_sensitivity_command(fields, new_control):
+    # Check if locked
+    require_unlocked()
+
+    if new_control is not None and pacemaker_state.active_control != new_control:
+        # Important: Reset encoder state when changing controls
+        fields['active_control'] = new_control
+        # Force reset of encoder tracking state
+        fields['last_mode_steps'] = None
+        log.info("Active control changed to: %s", new_control)
+
+        # Set encoder position appropriately for the new control
+        if new_control == 'none':
+            mode_output_encoder.steps = 50  # Neutral position
+        else:
+            # Don't change encoder steps - just reset tracking
+            pass
+
+    # Also reset the watchdog timer
+    fields['last_mode_activity'] = time.time()
+    pacemaker_state.update(**fields)
+    return {
+        'a_sensitivity': pacemaker_state.a_sensitivity,
+        'v_sensitivity': pacemaker_state.v_sensitivity,
+        'active_control': pacemaker_state.active_control
+    }
 
 @app.route('/api/sensitivity/set', methods=['POST'])
 def set_sensitivity():
-    global a_sensitivity, v_sensitivity, active_control, mode_output_encoder, last_mode_encoder_activity
-    
-    # Check if locked
-    if is_locked:
-        return jsonify({'error': 'Device is locked'}), 403
-        
     data = request.json
-    updated = False
-    
+
+    # Validate everything first so a bad value leaves the state untouched
+    fields = {}
+    new_control = None
+
     # Handle active_control changes
     if 'active_control' in data:
         new_control = data['active_control']
-        
-        if new_control in ['none', 'a_sensitivity', 'v_sensitivity']:
-            if active_control != new_control:
-                # Important: Reset encoder state when changing controls
-                active_control = new_control
-                # Force reset of encoder tracking state
-                if hasattr(update_mode_output, 'last_steps'):
-                    delattr(update_mode_output, 'last_steps')
-                last_mode_encoder_activity = time.time()
-                updated = True
-                print(f"Active control changed to: {active_control}")
-                
-                # Set encoder position appropriately for the new control
-                if new_control == 'none':
-                    mode_output_encoder.steps = 50  # Neutral position
-                else:
-                    # Don't change encoder steps - just reset tracking
-                    pass
-        else:
+        if new_control not in ['none', 'a_sensitivity', 'v_sensitivity']:
             return jsonify({'error': 'Invalid active control value'}), 400
-    
+
     # Handle a_sensitivity
     if 'a_sensitivity' in data:
         try:
             new_value = float(data['a_sensitivity'])
             # Validate range
             if new_value == 0 or min_a_sensitivity <= new_value <= max_a_sensitivity:
-                a_sensitivity = round(new_value, 1)  # Round to 1 decimal place
-                # Update state
-                current_state["aSensitivity"] = a_sensitivity
-                current_state["lastUpdate"] = time.time()
-                updated = True
-                print(f"A sensitivity set to: {a_sensitivity}")
+                fields['a_sensitivity'] = A_SENSITIVITY_LADDER.snap(new_value)
+                log.info("A sensitivity set to: %s", fields['a_sensitivity'])
             else:
                 return jsonify({'error': f'A sensitivity value out of range ({min_a_sensitivity}-{max_a_sensitivity} or 0)'}), 400
         except Exception as e:
             return jsonify({'error': str(e)}), 400
-    
+
     # Handle v_sensitivity
     if 'v_sensitivity' in data:
         try:
             new_value = float(data['v_sensitivity'])
             # Validate range
             if new_value == 0 or min_v_sensitivity <= new_value <= max_v_sensitivity:
-                v_sensitivity = round(new_value, 1)  # Round to 1 decimal place
-                # Update state
-                current_state["vSensitivity"] = v_sensitivity
-                current_state["lastUpdate"] = time.time()
-                updated = True
-                print(f"V sensitivity set to: {v_sensitivity}")
+                fields['v_sensitivity'] = V_SENSITIVITY_LADDER.snap(new_value)
+                log.info("V sensitivity set to: %s", fields['v_sensitivity'])
             else:
                 return jsonify({'error': f'V sensitivity value out of range ({min_v_sensitivity}-{max_v_sensitivity} or 0)'}), 400
         except Exception as e:
             return jsonify({'error': str(e)}), 400
-    
-     # Return success
-    if updated:
-        # Also reset the watchdog timer
-        last_mode_encoder_activity = time.time()
-        
-        return jsonify({
-            'success': True,
-            'a_sensitivity': a_sensitivity,
-            'v_sensitivity': v_sensitivity,
-            'active_control': active_control
-        })
+
+    # Return success
+    if fields or new_control is not None:
+        result = state_commands.call('set_sensitivity', set_sensitivity_command, fields, new_control)
+        return jsonify(dict(result, success=True))
     else:
         return jsonify({'error': 'No valid parameters provided'}), 400
-    
+
+def reset_mode_encoder_command():
+    hardware_reset_mode_encoder()
+    # Also reset both sensitivity values to defaults
+    pacemaker_state.update(a_sensitivity=0.5, v_sensitivity=2.0)
+
 # API endpoint for emergency reset
 @app.route('/api/reset_encoder', methods=['POST'])
 def api_reset_encoder():
     encoder_type = request.json.get('type', 'mode')
-    
+
     if encoder_type == 'mode':
-        hardware_reset_mode_encoder()
-        # Also reset both sensitivity values to defaults
-        global a_sensitivity, v_sensitivity
-        a_sensitivity = 0.5
-        v_sensitivity = 2.0
-        current_state["aSensitivity"] = a_sensitivity
-        current_state["vSensitivity"] = v_sensitivity
-        current_state["lastUpdate"] = time.time()
-        broadcast_state()
+        state_commands.call('reset_mode_encoder', reset_mode_encoder_command)
         return jsonify({'success': True, 'message': 'Mode encoder reset successful with defaults'})
     else:
-        return jsonify({'error': 'Unknown encoder type'}), 400     
-     
-    
+        return jsonify({'error': 'Unknown encoder type'}), 400
+
+def apply_controls_command(updates):
+    """Apply a batch of control updates if the device is unlocked; returns (applied, version).
+
+    A batch that only sets isLocked is let through while locked, so a
+    client can unlock the device with the same request it locked it with.
+    """
+    if not (isinstance(updates, dict) and set(updates) == {'isLocked'}):
+        require_unlocked()
+    applied = apply_control_updates(updates)
+    return applied, pacemaker_state.version
+
 # API endpoint for setting mode
 @app.route('/api/mode/set', methods=['POST'])
 def set_mode():
-    global current_mode, current_state
-    
-    # Check if locked
-    if is_locked:
-        return jsonify({'error': 'Device is locked'}), 403
-        
     data = request.json
+
     if 'mode' in data:
-        new_mode = int(data['mode'])
-        # Valid mode is between 0-7
-        if 0 <= new_mode <= 7:
-            current_mode = new_mode
-            # Update state
-            current_state["mode"] = current_mode
-            current_state["lastUpdate"] = time.time()
-            
-            # If setting to DOO mode (5), apply emergency settings
-            if new_mode == 5:
-                reset_rate()  # Set rate to 80 ppm
-                current_a_output = 20.0  # Set A output to 20 mA
-                current_v_output = 25.0  # Set V output to 25 mA
-                # Update state
-                current_state["a_output"] = current_a_output
-                current_state["v_output"] = current_v_output
-            
-            return jsonify({'success': True, 'mode': current_mode})
-        else:
+        # Valid mode is between 0-7; setting DOO mode (5) also applies
+        # the emergency settings (80 ppm, 20 mA, 25 mA)
+        try:
+            applied, version = state_commands.call('set_mode', apply_controls_command, {'mode': data['mode']})
+        except ValueError:
             return jsonify({'error': 'Invalid mode value'}), 400
+        return jsonify({'success': True, 'mode': applied['mode']})
     return jsonify({'error': 'No mode provided'}), 400
 
-# This version prevents false button detections
+# Batch endpoint: set any of rate, a_output, v_output, a/v sensitivity, mode,
+# active_control and isLocked in one request. All fields are validated first
+# and then applied together, so viewers never see an intermediate state.
+# While locked, only a batch of isLocked alone is accepted.
+@app.route('/api/controls', methods=['POST'])
+def set_controls():
+    data = request.json
+    if not data:
+        return jsonify({'error': 'No controls provided'}), 400
+
+    try:
+        applied, version = state_commands.call('set_controls', apply_controls_command, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'success': True, 'applied': applied, 'version': version})
+
+def recent_presses():
+    """Whether each button was pressed within the last BUTTON_PRESSED_WINDOW,
+    for pollers that predate /api/events. Reading them clears nothing"""
+    now = time.time()
+    return tuple(now - button_events.last(button) <= BUTTON_PRESSED_WINDOW
+                 for button in ('up', 'down', 'left', 'emergency'))
+
+def take_health_flags():
+    """Read the control/button flags for a health poll and clear encoder_active"""
+    flags = (pacemaker_state.active_control, pacemaker_state.encoder_active) + recent_presses()
+    pacemaker_state.update(encoder_active=False)
+    return flags
+
+# Button presses come from /api/events; the buttons here only say whether
+# each one was pressed within the last BUTTON_PRESSED_WINDOW
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    global up_button_pressed, down_button_pressed, left_button_pressed, emergency_button_pressed, encoder_activity_flag
-    
-    # Create response data - make a copy of the current button states
-    # IMPORTANT: We're only using the flag variables, not trying to read hardware directly
-    status_data = {
+    flags = state_commands.call('health_poll', take_health_flags)
+
+    # The body only changes with the state version, these flags or the event
+    # cursor, so it is serialized once and reused by every poll until one moves
+    body = pacemaker_state.cached(('health', button_events.cursor) + flags, lambda seq, state: json.dumps({
         'status': 'ok',
-        'rate': current_rate,
-        'a_output': current_a_output,
-        'v_output': current_v_output,
-        'locked': is_locked,
-        'mode': current_mode,
-        'a_sensitivity': a_sensitivity,
-        'v_sensitivity': v_sensitivity,
-        'active_control': active_control,
-        'encoder_active': encoder_activity_flag,
+        'rate': state['rate'],
+        'a_output': state['a_output'],
+        'v_output': state['v_output'],
+        'locked': state['isLocked'],
+        'mode': state['mode'],
+        'a_sensitivity': state['aSensitivity'],
+        'v_sensitivity': state['vSensitivity'],
+        'active_control': flags[0],
+        'encoder_active': flags[1],
         'buttons': {
-            'up_pressed': up_button_pressed,
-            'down_pressed': down_button_pressed,
-            'left_pressed': left_button_pressed,
-            'emergency_pressed': emergency_button_pressed
-        }
-    }
-    
-    # Only reset flags for buttons that were actually pressed
-    if up_button_pressed:
-        up_button_pressed = False
-        print("Reset up button flag")
-    
-    if down_button_pressed:
-        down_button_pressed = False
-        print("Reset down button flag")
-    
-    if left_button_pressed:
-        left_button_pressed = False
-        print("Reset left button flag")
-    
-    if emergency_button_pressed:
-        emergency_button_pressed = False
-        print("Reset emergency button flag")
-    
-    encoder_activity_flag = False
-    
-    return jsonify(status_data)
+            'up_pressed': flags[2],
+            'down_pressed': flags[3],
+            'left_pressed': flags[4],
+            'emergency_pressed': flags[5]
+        },
+        'events': button_events.cursor
+    }).encode())
+
+    return Response(body, mimetype='application/json')
+
+# Apply latency of the state command queue
+@app.route('/api/commands', methods=['GET'])
+def command_stats():
+    return jsonify(state_commands.latency_stats())
 
 
 # API endpoint to get hardware information
 @app.route('/api/hardware', methods=['GET'])
 def get_hardware_info():
-    global up_button_pressed, down_button_pressed, left_button_pressed, emergency_button_pressed
+    up_pressed, down_pressed, left_pressed, emergency_pressed = recent_presses()
     return jsonify({
         'status': 'ok',
         'hardware': {
@@ -1185,63 +2352,45 @@ def get_hardware_info():
                 'rotation_count': mode_output_encoder.steps
             },
             'buttons': {
-                'up_pressed': up_button_pressed,
-                'down_pressed': down_button_pressed,
-                'left_pressed': left_button_pressed,
-                'emergency_pressed': emergency_button_pressed
+                'up_pressed': up_pressed,
+                'down_pressed': down_pressed,
+                'left_pressed': left_pressed,
+                'emergency_pressed': emergency_pressed
             }
         }
     })
 
 if __name__ == '__main__':
-    # Start WebSocket server in a separate thread
-    websocket_thread = threading.Thread(target=run_websocket_server)
-    websocket_thread.daemon = True
-    websocket_thread.start()
-    
-    # Initialize state with current values
-    current_state = {
-        "rate": current_rate,
-        "a_output": current_a_output,
-        "v_output": current_v_output,
-        "aSensitivity": a_sensitivity,
-        "vSensitivity": v_sensitivity,
-        "mode": current_mode,
-        "isLocked": is_locked,
-        "isPaused": False,
-        "pauseTimeLeft": 0,
-        "batteryLevel": 100,
-        "lastUpdate": time.time()
-    }
-    
-        # Add this near the start of the main code
-    def initialize_encoder_trackers():
-        # Set initial tracking values for encoders
-        if not hasattr(update_rate, 'last_steps'):
-            update_rate.last_steps = rate_encoder.steps
-        
-        if not hasattr(update_mode_output, 'last_steps'):
-            update_mode_output.last_steps = mode_output_encoder.steps
-        
-        print(f"Initialized mode encoder tracking: steps={mode_output_encoder.steps}")
-
-    # Call this function before starting the server
-    initialize_encoder_trackers()
+    # Unless everything shares the unified server, WebSockets get their own loop thread
+    if HTTP_SERVER != 'unified':
+        websocket_thread = threading.Thread(target=run_websocket_server)
+        websocket_thread.daemon = True
+        websocket_thread.start()
     
     # Ensure mode encoder starts synced
-    update_mode_output.last_steps = mode_output_encoder.steps
+    state_commands.call('init_mode_tracking',
+                        lambda: pacemaker_state.update(last_mode_steps=mode_output_encoder.steps))
+    print(f"Initialized mode encoder tracking: steps={mode_output_encoder.steps}")
     
     print("Pacemaker Server Started with WebSocket support")
-    print(f"WebSocket server on port {WS_PORT} for real-time data sharing")
-    print(f"HTTP API server on port 5000")
-    print(f"Rate encoder on pins CLK=27, DT=22 (initial value: {current_rate} ppm)")
-    print(f"A. Output encoder on pins CLK=21, DT=20 (initial value: {current_a_output} mA)")
-    print(f"V. Output encoder on pins CLK=13, DT=6 (initial value: {current_v_output} mA)")
+    if HTTP_SERVER == 'unified':
+        print(f"HTTP API, WebSocket and SSE on port {HTTP_PORT} (WebSocket also on {WS_PORT})")
+    else:
+        print(f"WebSocket server on port {WS_PORT} for real-time data sharing")
+        print(f"HTTP API server on port {HTTP_PORT}")
+    print(f"Rate encoder on pins CLK=27, DT=22 (initial value: {pacemaker_state.rate} ppm)")
+    print(f"A. Output encoder on pins CLK=21, DT=20 (initial value: {pacemaker_state.a_output} mA)")
+    print(f"V. Output encoder on pins CLK=13, DT=6 (initial value: {pacemaker_state.v_output} mA)")
     print(f"Mode Output encoder on pins CLK=10, DT=9 (initial value: {current_mode_output})")
-    print(f"Lock button on pin GPIO 17 (initial state: {'Locked' if is_locked else 'Unlocked'})")
+    print(f"Lock button on pin GPIO 17 (initial state: {'Locked' if pacemaker_state.is_locked else 'Unlocked'})")
     print(f"Up button on pin GPIO 26")
     print(f"Down button on pin GPIO 14")
     print(f"Left button on pin GPIO 15")
     print(f"Emergency DOO button on pin GPIO 23")
+    print(f"Input backend: {hardware.BACKEND}")
+    hardware.start_trace_from_env()
     
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    if HTTP_SERVER == 'unified':
+        run_unified_server()
+    else:
+        pacemaker_http.serve(app, '0.0.0.0', HTTP_PORT, HTTP_SERVER)
\ No newline at end of file
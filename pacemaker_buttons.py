@@ -0,0 +1,131 @@
+"""Debounce and gestures for the push buttons, driven by one config table.
+
+Each button gets a ButtonConfig; the engine turns its raw press/release edges
+into gestures and hands them to on_gesture(button, action):
+
+    pressed  every accepted press, as soon as the contact closes
+    double   also sent for a press within double_press seconds of the last one
+    repeat   while held: after repeat_delay, then every repeat_interval
+    long     once, when held for long_press seconds
+
+A press within `debounce` seconds of the previous edge is contact bounce and
+ignored (on top of gpiozero's own bounce_time). Times come from
+time.monotonic, so a clock step can neither swallow a press nor fire one
+twice. An edge costs a lock and a few comparisons; repeat and long-press
+deadlines are kept in one heap served by a single timer thread, not a
+thread or Timer per press.
+
+    engine = ButtonGestures({'up': ButtonConfig(repeat_delay=0.4, repeat_interval=0.1)}, on_gesture)
+    engine.attach('up', up_button)
+    engine.start()
+"""
+import collections
+import heapq
+import threading
+import time
+
+# Unset (None) gestures are off; debounce defaults to gpiozero's bounce_time
+ButtonConfig = collections.namedtuple(
+    'ButtonConfig', ['debounce', 'double_press', 'repeat_delay', 'repeat_interval', 'long_press'],
+    defaults=(0.05, None, None, None, None))
+
+
+class _ButtonState:
+    __slots__ = ('config', 'held', 'last_edge', 'last_press', 'generation')
+
+    def __init__(self, config):
+        self.config = config
+        self.held = False
+        self.last_edge = None
+        self.last_press = None
+        self.generation = 0  # Bumped on every press and release, so stale deadlines are skipped
+
+
+class ButtonGestures:
+    """Gesture engine for a table of {button name: ButtonConfig}"""
+
+    def __init__(self, table, on_gesture, clock=time.monotonic):
+        self.on_gesture = on_gesture  # Called with the lock held, so it must not block
+        self.clock = clock
+        self.buttons = {name: _ButtonState(config) for name, config in table.items()}
+        self.ignored = 0  # Edges thrown away as bounce
+        self._deadlines = []  # Heap of (time, sequence, button, generation, action)
+        self._sequence = 0
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def attach(self, name, button):
+        """Feed a gpiozero (or simulated) button's edges to the engine"""
+        button.when_pressed = lambda: self.press(name)
+        button.when_released = lambda: self.release(name)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='button-gestures')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def press(self, name, now=None):
+        now = self.clock() if now is None else now
+        state = self.buttons[name]
+        config = state.config
+        with self._changed:
+            if state.held or (state.last_edge is not None and now - state.last_edge < config.debounce):
+                self.ignored += 1
+                return
+            state.held = True
+            state.last_edge = now
+            state.generation += 1
+            double = (config.double_press is not None and state.last_press is not None
+                      and now - state.last_press <= config.double_press)
+            # A double ends the sequence: a third press starts a new one
+            state.last_press = None if double else now
+            self.on_gesture(name, 'pressed')
+            if double:
+                self.on_gesture(name, 'double')
+            if config.repeat_delay is not None:
+                self._schedule(now + config.repeat_delay, name, state.generation, 'repeat')
+            if config.long_press is not None:
+                self._schedule(now + config.long_press, name, state.generation, 'long')
+
+    def release(self, name, now=None):
+        now = self.clock() if now is None else now
+        state = self.buttons[name]
+        with self._changed:
+            if not state.held:
+                return
+            state.held = False
+            state.last_edge = now
+            state.generation += 1
+
+    def _schedule(self, when, name, generation, action):
+        self._sequence += 1
+        heapq.heappush(self._deadlines, (when, self._sequence, name, generation, action))
+        if self._deadlines[0][1] == self._sequence:
+            self._changed.notify()  # New earliest deadline
+
+    def tick(self, now=None):
+        """Fire every repeat/long-press deadline that is due; returns seconds
+        until the next one, or None if there is none (normally run() calls this)"""
+        now = self.clock() if now is None else now
+        with self._changed:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                when, _, name, generation, action = heapq.heappop(self._deadlines)
+                state = self.buttons[name]
+                if state.generation != generation:
+                    continue  # Released (or pressed again) since
+                self.on_gesture(name, action)
+                if action == 'repeat':
+                    # After a stall, carry on from now instead of firing a burst to catch up
+                    interval = state.config.repeat_interval
+                    self._schedule(max(when + interval, now + interval * 0.5), name, generation, 'repeat')
+            return self._deadlines[0][0] - now if self._deadlines else None
+
+    def run(self):
+        while True:
+            self.tick()
+            with self._changed:
+                # A press scheduling an earlier deadline cuts the wait short with notify()
+                timeout = self._deadlines[0][0] - self.clock() if self._deadlines else None
+                if timeout is None or timeout > 0:
+                    self._changed.wait(timeout)
@@ -0,0 +1,71 @@
+"""Ring buffer of button events with a cursor, so every consumer sees every press once.
+
+append() gives each event the next cursor (1, 2, 3, ...) and wakes anyone
+waiting. A consumer remembers the cursor of the last event it handled and
+asks for the events since it; any number of consumers can read the same
+events, and nothing is cleared by reading. The ring keeps the last
+`capacity` events: a consumer that falls further behind is told how many it
+missed instead of silently getting a gap.
+
+    events = EventLog(256)
+    events.append('up')
+    new, cursor, missed = events.since(0)
+"""
+import threading
+import time
+
+
+class EventLog:
+    """Fixed-size ring of timestamped events, numbered by a cursor that only goes up"""
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._head = 1  # Cursor of the next event
+        self._last = {}  # Button -> time of its last event
+        self._changed = threading.Condition()
+
+    @property
+    def cursor(self):
+        """Cursor of the newest event, 0 before the first"""
+        return self._head - 1
+
+    def append(self, button, action='pressed', when=None):
+        """Record an event and return it as a dict; safe to call with locks held"""
+        when = time.time() if when is None else when
+        with self._changed:
+            event = {'cursor': self._head, 'time': when, 'button': button, 'action': action}
+            self._slots[self._head % self.capacity] = event
+            self._last[button] = when
+            self._head += 1
+            self._changed.notify_all()
+        return event
+
+    def last(self, button):
+        """Time of the last event for button, or 0 if there was none"""
+        return self._last.get(button, 0)
+
+    def since(self, cursor, limit=None):
+        """Events after cursor still in the ring, oldest first.
+
+        Returns (events, next, missed): pass next back as cursor to get only
+        newer ones; missed counts the events that were overwritten before
+        they could be read. A cursor ahead of the log (the server restarted)
+        is treated as 0, and so is a negative one. A limit below 1 counts as
+        1, so next never goes back.
+        """
+        if limit is not None:
+            limit = max(1, limit)
+        with self._changed:
+            head = self._head
+            if cursor >= head or cursor < 0:
+                cursor = 0
+            first = max(cursor + 1, head - self.capacity)
+            last = head if limit is None else min(head, first + limit)
+            events = [self._slots[index % self.capacity] for index in range(first, last)]
+        return events, last - 1, first - cursor - 1
+
+    def wait(self, cursor, timeout):
+        """Block until there is an event after cursor; returns False on timeout"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._head - 1 != cursor, timeout)
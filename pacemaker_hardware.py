@@ -0,0 +1,265 @@
+"""Input hardware for the pacemaker servers: real GPIO, gpiozero mock pins or a simulator.
+
+The backend is picked with the PACEMAKER_INPUT_BACKEND environment variable:
+
+    gpio  real gpiozero devices on the Raspberry Pi (default)
+    mock  gpiozero devices on MockFactory pins, no Pi needed
+    sim   plain-Python encoders and buttons, no gpiozero needed
+
+With mock or sim a trace of rotations and button presses can be replayed
+through the same callbacks the real hardware fires, e.g. for benchmarking:
+
+    PACEMAKER_INPUT_BACKEND=sim PACEMAKER_SIM_TRACE=spin.trace PACEMAKER_SIM_RATE=2000 \
+        python3 enhanced_pacemaker_server.py
+
+A trace file has one event per line, "<device> <action>", where the action is
+a number of detents (+1, -3) or press/release/click; '#' starts a comment.
+
+clock() times inputs (e.g. for encoder acceleration). On real and mock pins
+it is time.monotonic; under sim it is a virtual clock that only moves when
+the simulator says so (advance(), the interval of rotate(), or the schedule
+of replay()), so timing-dependent behaviour is the same on every run and
+every machine.
+"""
+import os
+import threading
+import time
+
+BACKEND = os.environ.get('PACEMAKER_INPUT_BACKEND', 'gpio')
+
+# Devices created so far, by name, so traces can refer to them
+devices = {}
+
+if BACKEND in ('gpio', 'mock'):
+    from gpiozero import RotaryEncoder, Button
+    if BACKEND == 'mock':
+        from gpiozero import Device
+        from gpiozero.pins.mock import MockFactory
+        Device.pin_factory = MockFactory()
+elif BACKEND != 'sim':
+    raise ValueError(f"Unknown PACEMAKER_INPUT_BACKEND {BACKEND!r} (expected gpio, mock or sim)")
+
+_sim_time = 0.0
+
+
+def _sim_clock():
+    return _sim_time
+
+
+clock = _sim_clock if BACKEND == 'sim' else time.monotonic
+
+
+def advance(seconds):
+    """Move the simulated clock on (sim backend); real time just passes"""
+    global _sim_time
+    if BACKEND == 'sim':
+        _sim_time += seconds
+    elif seconds > 0:
+        time.sleep(seconds)
+
+
+class SimEncoder:
+    """Stand-in for gpiozero.RotaryEncoder: same steps and rotation callbacks, driven by rotate()"""
+
+    def __init__(self, a, b, max_steps=16, wrap=False, **kwargs):
+        self.pins = (a, b)
+        self.max_steps = max_steps
+        self.wrap = wrap
+        self._steps = 0
+        self.when_rotated = None
+        self.when_rotated_clockwise = None
+        self.when_rotated_counter_clockwise = None
+
+    @property
+    def steps(self):
+        return self._steps
+
+    @steps.setter
+    def steps(self, value):
+        value = int(value)
+        if self.max_steps:
+            value = max(-self.max_steps, min(self.max_steps, value))
+        self._steps = value
+
+    def rotate(self, detents, interval=0):
+        """Turn by detents (positive is clockwise), firing the callbacks once per
+        detent, with interval seconds of the simulated clock between detents"""
+        direction = 1 if detents > 0 else -1
+        for index in range(abs(detents)):
+            if index and interval:
+                advance(interval)
+            # Same limits as gpiozero: clamp at +/-max_steps, or wrap around
+            if not self.max_steps or direction * self._steps < self.max_steps:
+                self._steps += direction
+            elif self.wrap:
+                self._steps = -direction * self.max_steps
+            callback = self.when_rotated_clockwise if direction > 0 else self.when_rotated_counter_clockwise
+            if callback:
+                callback()
+            if self.when_rotated:
+                self.when_rotated()
+
+
+class SimButton:
+    """Stand-in for gpiozero.Button, driven by press() and release()"""
+
+    def __init__(self, pin, bounce_time=None, **kwargs):
+        self.pin = pin
+        self.bounce_time = bounce_time
+        self.is_pressed = False
+        self.when_pressed = None
+        self.when_released = None
+
+    def press(self):
+        if not self.is_pressed:
+            self.is_pressed = True
+            if self.when_pressed:
+                self.when_pressed()
+
+    def release(self):
+        if self.is_pressed:
+            self.is_pressed = False
+            if self.when_released:
+                self.when_released()
+
+
+def create_encoder(name, a, b, **kwargs):
+    """A rotary encoder on pins a/b for the configured backend"""
+    if BACKEND == 'sim':
+        encoder = SimEncoder(a, b, **kwargs)
+    else:
+        encoder = RotaryEncoder(a, b, **kwargs)
+    devices[name] = encoder
+    return encoder
+
+
+def create_button(name, pin, **kwargs):
+    """A push button on pin for the configured backend"""
+    if BACKEND == 'sim':
+        button = SimButton(pin, **kwargs)
+    else:
+        button = Button(pin, **kwargs)
+    devices[name] = button
+    return button
+
+
+def rotate(name, detents, interval=0):
+    """Turn a simulated or mock encoder by detents, interval seconds apart"""
+    encoder = devices[name]
+    if BACKEND == 'sim':
+        encoder.rotate(detents, interval)
+    elif BACKEND == 'mock':
+        # Drive the quadrature sequence gpiozero decodes as one detent
+        first, second = (encoder.a.pin, encoder.b.pin) if detents > 0 else (encoder.b.pin, encoder.a.pin)
+        for index in range(abs(detents)):
+            if index and interval:
+                advance(interval)
+            first.drive_low()
+            second.drive_low()
+            first.drive_high()
+            second.drive_high()
+    else:
+        raise RuntimeError('Cannot drive real GPIO inputs from software')
+
+
+def press(name):
+    button = devices[name]
+    if BACKEND == 'sim':
+        button.press()
+    elif BACKEND == 'mock':
+        button.pin.drive_low()  # Buttons are pulled up, so low is pressed
+    else:
+        raise RuntimeError('Cannot drive real GPIO inputs from software')
+
+
+def release(name):
+    button = devices[name]
+    if BACKEND == 'sim':
+        button.release()
+    elif BACKEND == 'mock':
+        button.pin.drive_high()
+    else:
+        raise RuntimeError('Cannot drive real GPIO inputs from software')
+
+
+def click(name):
+    press(name)
+    release(name)
+
+
+def apply_event(name, action):
+    """Apply one trace event: a detent count, or press/release/click"""
+    if action == 'press':
+        press(name)
+    elif action == 'release':
+        release(name)
+    elif action == 'click':
+        click(name)
+    else:
+        rotate(name, int(action))
+
+
+def load_trace(path):
+    """Read a trace file into a list of (device, action) events"""
+    events = []
+    with open(path) as trace_file:
+        for line in trace_file:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                name, action = line.split()
+                events.append((name, action))
+    return events
+
+
+def spin_trace(name, detents):
+    """Synthetic trace of one encoder turned detents steps, one event per detent"""
+    return [(name, 1 if detents > 0 else -1)] * abs(detents)
+
+
+def replay(events, rate=None, repeat=1):
+    """Apply events in order, at rate events per second (None: as fast as possible).
+
+    Events are scheduled against the start time rather than slept between,
+    so the average rate holds even when a handler is occasionally slow. The
+    simulated clock reads each event's scheduled time, not when it actually
+    ran. Returns (events applied, seconds taken).
+    """
+    global _sim_time
+    interval = 1.0 / rate if rate else 0
+    start = time.perf_counter()
+    sim_start = _sim_time
+    count = 0
+    for _ in range(repeat):
+        for name, action in events:
+            if interval:
+                delay = start + count * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if BACKEND == 'sim':
+                    _sim_time = sim_start + count * interval
+            apply_event(name, action)
+            count += 1
+    return count, time.perf_counter() - start
+
+
+def start_replay(events, rate=None, repeat=1):
+    """Replay events on a background thread, like inputs arriving from the GPIO thread"""
+    def run():
+        count, elapsed = replay(events, rate, repeat)
+        print(f"Replayed {count} input events in {elapsed:.3f}s ({count / elapsed if elapsed else 0:.0f}/s)")
+
+    thread = threading.Thread(target=run, name='input-replay')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def start_trace_from_env():
+    """Start replaying PACEMAKER_SIM_TRACE if it is set (mock and sim backends)"""
+    path = os.environ.get('PACEMAKER_SIM_TRACE')
+    if not path:
+        return None
+    rate = float(os.environ.get('PACEMAKER_SIM_RATE', '0')) or None
+    repeat = int(os.environ.get('PACEMAKER_SIM_REPEAT', '1'))
+    print(f"Replaying input trace {path} ({BACKEND} backend, {rate or 'max'} events/s)")
+    return start_replay(load_trace(path), rate, repeat)
@@ -0,0 +1,250 @@
+"""HTTP serving for the pacemaker servers' Flask app.
+
+app.run() is Werkzeug's development server: a thread per request and a new
+connection for every request (HTTP/1.0), which is a lot of overhead for a web
+app that polls several times a second per tab. waitress serves the same app
+from a fixed pool of threads with HTTP/1.1 keep-alive, in this process, so
+the GPIO callbacks, the state and the WebSocket loop are shared exactly as
+with the development server. (A multi-process server would open the GPIO
+pins and hold a separate state in every worker.)
+
+PACEMAKER_HTTP_SERVER picks the server:
+
+    unified   enhanced_pacemaker_server only (its default): HTTP, WebSocket
+              and SSE on one port and one asyncio loop, see below;
+              pacemaker_server uses waitress instead
+    waitress  production server (default for pacemaker_server; falls back
+              to dev if not installed)
+    dev       Flask/Werkzeug development server
+
+For the unified server this module also has a small asyncio HTTP/1.1 front
+end: read_request() parses a request head off a stream, so the caller can
+decide between a WebSocket upgrade, a natively served stream and the app,
+and respond_wsgi() runs the app in a thread pool and writes its response,
+keeping the connection alive.
+
+PACEMAKER_HTTP_THREADS sets the size of the waitress (or unified) thread
+pool. Every waiting /api/state?since= long poll holds a thread, and with
+waitress so does every open /api/stream, so leave room for them on top of
+the polling tabs.
+"""
+import asyncio
+import io
+import os
+import sys
+import urllib.parse
+
+SERVER = os.environ.get('PACEMAKER_HTTP_SERVER', 'waitress')
+THREADS = int(os.environ.get('PACEMAKER_HTTP_THREADS', '16'))
+
+STATUS_REASONS = {400: 'Bad Request', 411: 'Length Required', 413: 'Payload Too Large',
+                  431: 'Request Header Fields Too Large', 505: 'HTTP Version Not Supported'}
+
+
+def serve(app, host='0.0.0.0', port=5000, server=None, threads=None):
+    """Serve app until interrupted with the configured (or given) server"""
+    server = server or SERVER
+    threads = threads or THREADS
+    if server == 'unified':
+        # One PACEMAKER_HTTP_SERVER for both servers: only the enhanced one has the unified loop
+        print("The unified server is only in enhanced_pacemaker_server, using waitress")
+        server = 'waitress'
+    if server == 'waitress':
+        try:
+            import waitress
+        except ImportError:
+            print("waitress is not installed (pip install -r requirements.txt), using the development server")
+            server = 'dev'
+        else:
+            print(f"HTTP API on port {port}: waitress, {threads} threads")
+            waitress.serve(app, host=host, port=port, threads=threads, ident='pacemaker')
+            return
+    if server != 'dev':
+        raise ValueError(f"Unknown PACEMAKER_HTTP_SERVER {server!r} (expected unified, waitress or dev)")
+    print(f"HTTP API on port {port}: Flask development server")
+    app.run(host=host, port=port, debug=False, threaded=True)
+
+
+class HTTPError(Exception):
+    """A request that can only be answered with an error status"""
+
+    def __init__(self, status):
+        super().__init__(f'{status} {STATUS_REASONS.get(status, "")}')
+        self.status = status
+
+
+class HTTPRequest:
+    """Request line and headers of one HTTP/1.x request"""
+
+    __slots__ = ('method', 'target', 'version', 'headers')
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # Lower-case name -> value, repeated headers joined with ', '
+
+    def header(self, name, default=None):
+        return self.headers.get(name, default)
+
+    @property
+    def path(self):
+        return self.target.split('?', 1)[0]
+
+    @property
+    def keep_alive(self):
+        connection = self.header('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+
+async def read_request(reader, timeout):
+    """Read the next request head; None if the client closed the connection between requests"""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise HTTPError(400)
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(431)
+    lines = head.decode('latin-1').lstrip('\r\n').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HTTPError(400)
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise HTTPError(505)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(':')
+        if not separator:
+            raise HTTPError(400)
+        name = name.strip().lower()
+        value = value.strip()
+        headers[name] = f'{headers[name]}, {value}' if name in headers else value
+    return HTTPRequest(method, target, version, headers)
+
+
+async def read_body(reader, request, max_size):
+    if 'chunked' in request.header('transfer-encoding', '').lower():
+        raise HTTPError(411)
+    try:
+        length = int(request.header('content-length', '0'))
+    except ValueError:
+        raise HTTPError(400)
+    if length > max_size:
+        raise HTTPError(413)
+    return await reader.readexactly(length) if length > 0 else b''
+
+
+async def send_error(writer, status):
+    """Answer with a bare error status and close"""
+    writer.write(f'HTTP/1.1 {status} {STATUS_REASONS.get(status, "Error")}\r\n'
+                 f'Content-Length: 0\r\nConnection: close\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+
+
+def wsgi_environ(request, body, server_port, peer):
+    path, _, query = request.target.partition('?')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': urllib.parse.unquote(path, 'latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': request.header('host', 'localhost').split(':')[0],
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': request.version,
+        'REMOTE_ADDR': peer[0] if peer else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+
+_END = object()
+
+
+def _start_wsgi(app, environ):
+    """Run the app (on a pool thread). Responses with a Content-Length are read
+    whole here, so they cost one trip to the pool; others are returned as an
+    iterator to stream."""
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response[:] = [status, list(headers)]
+        return lambda data: None  # The legacy write() callable; Flask doesn't use it
+
+    result = app(environ, start_response)
+    iterator = iter(result)
+    first = next(iterator, _END) if not response else None
+    status, headers = response
+    if any(name.lower() == 'content-length' for name, value in headers):
+        try:
+            content = b''.join(iterator) if first is None else (b'' if first is _END else first + b''.join(iterator))
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return status, headers, content, None, None, None
+    return status, headers, None, result, iterator, first
+
+
+async def respond_wsgi(app, request, body, writer, executor, server_port):
+    """Run app for request on executor and write the response; returns whether to keep the connection"""
+    loop = asyncio.get_running_loop()
+    environ = wsgi_environ(request, body, server_port, writer.get_extra_info('peername'))
+    status, headers, content, result, iterator, first = await loop.run_in_executor(executor, _start_wsgi, app, environ)
+
+    keep_alive = request.keep_alive
+    chunked = False
+    if content is None:
+        if request.version == 'HTTP/1.1':
+            headers.append(('Transfer-Encoding', 'chunked'))
+            chunked = True
+        else:
+            keep_alive = False
+    headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+    head = f'{request.version} {status}\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in headers) + '\r\n'
+    writer.write(head.encode('latin-1'))
+    if content is not None:
+        if request.method != 'HEAD':
+            writer.write(content)
+        await writer.drain()
+        return keep_alive
+
+    # Streamed response: one trip to the pool per chunk
+    try:
+        chunk = first
+        while True:
+            if chunk is None:
+                chunk = await loop.run_in_executor(executor, next, iterator, _END)
+            if chunk is _END:
+                break
+            if chunk and request.method != 'HEAD':
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+            chunk = None
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(executor, result.close)
+    return keep_alive
@@ -0,0 +1,163 @@
+"""Ring-buffer logger: callers store a record and return, a background thread writes.
+
+log() takes a lock, puts (seq, time, level, message, args) into a
+preallocated slot and returns; the message is only %-formatted later, by the
+writer thread. The writer sleeps until a record arrives, then waits
+flush_interval (less if the buffer fills to half) so a burst goes out in one
+write; with nothing to log it does not wake at all. Records at or above
+`level` are kept in the ring, and those at or above `stream_level` are also
+written to the stream, so debug detail stays queryable through records()
+without reaching the SD card. If the writer falls a whole buffer behind,
+the oldest records are overwritten and a line says how many were lost.
+"""
+import atexit
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+LEVELS = {name.lower(): level for level, name in LEVEL_NAMES.items()}
+
+
+def parse_level(name, default=INFO):
+    """Level number for a name such as 'info' (case-insensitive); default if name is empty"""
+    if not name:
+        return default
+    try:
+        return LEVELS[name.lower()]
+    except KeyError:
+        raise ValueError(f'Unknown log level {name!r} (expected one of {", ".join(LEVELS)})')
+
+
+class RingBufferLogger:
+    """Fixed-size ring of log records with a background writer"""
+
+    def __init__(self, capacity=4096, level=DEBUG, stream_level=INFO, stream=None, flush_interval=0.1):
+        self.capacity = capacity
+        self.level = level
+        self.stream_level = stream_level
+        self.stream = stream  # None: whatever sys.stdout is when flushing
+        self.flush_interval = flush_interval
+        self._slots = [None] * capacity
+        self._head = 0  # Sequence number of the next record
+        self._flushed = 0  # Everything before this has been written
+        self._pending = False  # Records logged since the writer last woke
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()  # Set by the first record after a flush
+        self._full = threading.Event()  # Set when the buffer is half full
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def log(self, level, message, *args):
+        if level < self.level:
+            return
+        record = (time.time(), level, message, args)
+        with self._lock:
+            seq = self._head
+            self._slots[seq % self.capacity] = (seq,) + record
+            self._head = seq + 1
+            wake = not self._pending
+            self._pending = True
+        if wake:
+            self._wake.set()
+        if seq - self._flushed >= self.capacity // 2:
+            self._full.set()
+
+    def debug(self, message, *args):
+        self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+    def run(self):
+        while True:
+            self._wake.wait()
+            self._full.wait(self.flush_interval)
+            # Clear before flushing: anything logged from here on wakes us again
+            with self._lock:
+                self._pending = False
+                self._wake.clear()
+                self._full.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write(f"Log writer error: {e}\n")
+
+    def _records(self, start, end):
+        """Records with seq in [start, end) that have not been overwritten"""
+        for seq in range(max(start, end - self.capacity), end):
+            record = self._slots[seq % self.capacity]
+            if record is not None and record[0] == seq:
+                yield record
+
+    @staticmethod
+    def _format(record):
+        seq, when, level, message, args = record
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = f'{message} {args!r}'
+        return message
+
+    def flush(self):
+        """Write every record not yet written (normally done by the writer thread)"""
+        with self._flush_lock:
+            head = self._head
+            lines = []
+            written = 0
+            for record in self._records(self._flushed, head):
+                written += 1
+                if record[2] >= self.stream_level:
+                    stamp = time.strftime('%H:%M:%S', time.localtime(record[1]))
+                    millis = int(record[1] * 1000) % 1000
+                    lines.append(f'{stamp}.{millis:03d} {LEVEL_NAMES[record[2]]:<7} {self._format(record)}\n')
+            lost = head - self._flushed - written
+            if lost:
+                lines.insert(0, f'{lost} log records were overwritten before they could be written\n')
+            self._flushed = head
+            if lines:
+                stream = self.stream or sys.stdout
+                stream.write(''.join(lines))
+                stream.flush()
+
+    def records(self, since=-1, level=DEBUG, limit=None):
+        """Records after seq `since` still in the buffer, oldest first, as dicts.
+
+        Returns (records, next_since): pass next_since back to get only newer ones.
+        """
+        head = self._head
+        result = []
+        next_since = since
+        for record in self._records(since + 1, head):
+            next_since = record[0]
+            if record[2] >= level:
+                result.append({
+                    'seq': record[0],
+                    'time': record[1],
+                    'level': LEVEL_NAMES[record[2]],
+                    'message': self._format(record),
+                })
+                if limit is not None and len(result) >= limit:
+                    break
+        else:
+            next_since = max(next_since, head - 1)
+        return result, next_since
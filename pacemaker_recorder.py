@@ -0,0 +1,335 @@
+"""Append-only history of the pacing parameters, in memory-mapped columnar segment files.
+
+A segment file is a small header followed by one preallocated region per
+column, each holding `capacity` fixed-width values, so record i is slot i of
+every column. A time-range query binary-searches the time column of the
+mapped file and unpacks only the slices it returns; nothing is read whole.
+The header holds the number of records written, updated after the record
+itself, so a reader never sees half a record.
+
+record() only appends the row to a deque, wakes the writer and returns. The
+writer thread sleeps while there is nothing to write; woken, it lets rows
+collect for flush_interval, then writes them to the current segment and
+starts a new one when it is full, older than segment_seconds, or the clock
+went backwards (times within a segment are always ascending). Segment files are named after the time of
+their first record, in milliseconds, so they sort in recording order.
+
+Queries only open the segments whose first and last times overlap the range
+asked for. A finished segment never changes, so its times are noted when it
+is closed (or read once, for segments from earlier runs) and kept. With
+max_segments set, the oldest segments beyond that many are deleted whenever
+a new one is started, which bounds the disk space the history takes.
+"""
+import atexit
+import bisect
+import collections
+import glob
+import mmap
+import os
+import struct
+import sys
+import threading
+
+MAGIC = b'PMHIST01'
+HEADER = struct.Struct('<8sII')  # magic, capacity, count
+COUNT = struct.Struct('<I')
+COUNT_OFFSET = 12
+HEADER_SIZE = 64
+
+# (name, struct code, scale): values are stored as round(value * scale)
+COLUMNS = (
+    ('time', 'd', 1),  # unix time of the change
+    ('version', 'I', 1),  # state version, restarts at 0 with the server
+    ('rate', 'H', 1),  # ppm
+    ('a_output', 'H', 10),  # mA, stored in tenths
+    ('v_output', 'H', 10),
+    ('a_sensitivity', 'H', 10),  # mV, stored in tenths
+    ('v_sensitivity', 'H', 10),
+    ('mode', 'B', 1),
+    ('locked', '?', 1),
+)
+COLUMN_NAMES = tuple(name for name, code, scale in COLUMNS)
+COLUMN_STRUCTS = tuple(struct.Struct('<' + code) for name, code, scale in COLUMNS)
+ROW_SIZE = sum(column.size for column in COLUMN_STRUCTS)
+
+
+class _TimeColumn:
+    """The time column of a segment as a sequence, for bisect"""
+
+    def __init__(self, segment, count):
+        self.segment = segment
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return COLUMN_STRUCTS[0].unpack_from(self.segment.map, self.segment.offsets[0] + 8 * index)[0]
+
+
+class Segment:
+    """One segment file mapped into memory"""
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        with open(path, 'r+b' if writable else 'rb') as segment_file:
+            self.map = mmap.mmap(segment_file.fileno(), 0,
+                                 access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, self.capacity, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or len(self.map) < HEADER_SIZE + self.capacity * ROW_SIZE:
+            self.map.close()
+            raise ValueError(f'{path} is not a history segment')
+        self.offsets = []
+        offset = HEADER_SIZE
+        for column in COLUMN_STRUCTS:
+            self.offsets.append(offset)
+            offset += self.capacity * column.size
+
+    @classmethod
+    def create(cls, path, capacity):
+        with open(path, 'xb') as segment_file:
+            segment_file.write(HEADER.pack(MAGIC, capacity, 0))
+            segment_file.truncate(HEADER_SIZE + capacity * ROW_SIZE)  # Sparse until written
+        return cls(path, writable=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.map.close()
+
+    @property
+    def count(self):
+        return COUNT.unpack_from(self.map, COUNT_OFFSET)[0]
+
+    def times(self, count=None):
+        return _TimeColumn(self, self.count if count is None else count)
+
+    def append(self, row):
+        index = self.count
+        for (name, code, scale), column, offset, value in zip(COLUMNS, COLUMN_STRUCTS, self.offsets, row):
+            column.pack_into(self.map, offset + index * column.size, round(value * scale) if scale != 1 else value)
+        # Publish the record only once all its columns are written
+        COUNT.pack_into(self.map, COUNT_OFFSET, index + 1)
+
+    def read(self, start, stop, columns):
+        """Values of records [start, stop) as {column: list}, one unpack per column"""
+        result = {}
+        for index in columns:
+            name, code, scale = COLUMNS[index]
+            size = COLUMN_STRUCTS[index].size
+            values = struct.unpack_from(f'<{stop - start}{code}', self.map, self.offsets[index] + start * size)
+            result[name] = [value / scale for value in values] if scale != 1 else list(values)
+        return result
+
+
+class HistoryRecorder:
+    """Records rows of COLUMNS values to segment files in directory from a background thread"""
+
+    def __init__(self, directory, capacity=65536, segment_seconds=3600, flush_interval=0.5, backlog=65536,
+                 max_segments=None):
+        self.directory = directory
+        self.capacity = capacity
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments  # None keeps every segment
+        self.flush_interval = flush_interval
+        self.backlog = backlog
+        self.recorded = 0
+        self.dropped = 0  # Rows thrown away because the writer fell backlog rows behind
+        self._pending = collections.deque()
+        self._last_values = None
+        self._segment = None
+        self._segment_start = None
+        self._segment_last = None
+        self._bounds = {}  # Path of a finished segment -> (first time, last time), None if empty
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()  # Set when a row is queued
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='history-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.close)
+
+    def record(self, row):
+        """Queue a row of COLUMNS values (time first); safe to call with locks held"""
+        if len(self._pending) >= self.backlog:
+            self.dropped += 1
+            return
+        self._pending.append(row)
+        self._wake.set()
+
+    def run(self):
+        while not self._stop.is_set():
+            self._wake.wait()
+            # Let a burst of changes collect into one write
+            self._stop.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write(f"History writer error: {e}\n")
+
+    def flush(self):
+        """Write every queued row (normally done by the writer thread)"""
+        with self._write_lock:
+            while self._pending:
+                row = self._pending.popleft()
+                # Only transitions are kept: skip rows where no parameter moved
+                if row[2:] == self._last_values:
+                    continue
+                self._last_values = row[2:]
+                when = row[0]
+                if (self._segment is None or self._segment.count >= self._segment.capacity
+                        or when - self._segment_start >= self.segment_seconds or when < self._segment_last):
+                    self._rotate(when)
+                self._segment.append(row)
+                self._segment_last = when
+                self.recorded += 1
+
+    def _rotate(self, when):
+        if self._segment is not None:
+            self._segment.map.flush()
+            self._segment.close()
+            self._bounds[self._segment.path] = (self._segment_start, self._segment_last)
+        name = int(when * 1000)
+        while True:
+            try:
+                self._segment = Segment.create(os.path.join(self.directory, f'{name}.seg'), self.capacity)
+                break
+            except FileExistsError:
+                name += 1
+        self._segment_start = when
+        if self.max_segments is not None:
+            self._expire()
+
+    def _expire(self):
+        # Readers that already have an old segment mapped keep it until they are done
+        for path in self.segments()[:-self.max_segments]:
+            if path == self._segment.path:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                sys.stderr.write(f"History: could not delete {path}: {e}\n")
+            self._bounds.pop(path, None)
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+        with self._write_lock:
+            if self._segment is not None:
+                self._segment.map.flush()
+                self._segment.close()
+                self._bounds[self._segment.path] = (self._segment_start, self._segment_last)
+                self._segment = None
+
+    def segments(self):
+        """Paths of all segment files, oldest first"""
+        return sorted(glob.glob(os.path.join(self.directory, '*.seg')),
+                      key=lambda path: int(os.path.basename(path).split('.')[0]))
+
+    def _segments_between(self, start, end):
+        """Paths of the segments that can hold rows with start <= time < end, oldest first"""
+        with self._write_lock:
+            current = self._segment.path if self._segment is not None else None
+            paths = []
+            for path in self.segments():
+                if path == current:
+                    paths.append(path)  # Still growing: its times aren't known yet
+                    continue
+                if path not in self._bounds:
+                    try:
+                        with Segment(path) as segment:
+                            count = segment.count
+                            times = segment.times(count)
+                            self._bounds[path] = (times[0], times[count - 1]) if count else None
+                    except (OSError, ValueError):
+                        continue
+                bounds = self._bounds[path]
+                if bounds is None:
+                    continue
+                first, last = bounds
+                if (start is None or last >= start) and (end is None or first < end):
+                    paths.append(path)
+            return paths
+
+    def iter_rows(self, start=None, end=None, chunk=256):
+        """Yield recorded rows (tuples in COLUMNS order) with start <= time < end, oldest first.
+
+        Rows are read from the mapped files chunk rows at a time, so a whole
+        session is never in memory; rows recorded while iterating are
+        included if they fall in the range.
+        """
+        self.flush()
+        indexes = range(len(COLUMNS))
+        for path in self._segments_between(start, end):
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError):
+                continue
+            with segment:
+                position = 0 if start is None else bisect.bisect_left(segment.times(), start)
+                while True:
+                    count = segment.count
+                    stop = min(count, position + chunk)
+                    if end is not None:
+                        stop = bisect.bisect_left(segment.times(count), end, position, stop)
+                    if position >= stop:
+                        break
+                    columns = segment.read(position, stop, indexes)
+                    rows = list(zip(*(columns[name] for name in COLUMN_NAMES)))
+                    position = stop
+                    # Hand out rows only after the reads, so no exported buffer outlives the map
+                    yield from rows
+
+    def query(self, start=None, end=None, limit=None, columns=None):
+        """Recorded rows with start <= time < end, at most limit, as columns.
+
+        Returns {'columns': {name: [values]}, 'count': n, 'next': t}, where
+        next is the time of the first row left out by the limit (pass it
+        back as start), or None if there is nothing more.
+        """
+        if columns is None:
+            indexes = list(range(len(COLUMNS)))
+        else:
+            unknown = set(columns) - set(COLUMN_NAMES)
+            if unknown:
+                raise ValueError(f'Unknown history columns: {", ".join(sorted(unknown))}')
+            # Time always comes along so rows can be placed
+            indexes = [0] + [COLUMN_NAMES.index(name) for name in columns if name != 'time']
+        self.flush()
+        result = {COLUMNS[index][0]: [] for index in indexes}
+        count = 0
+        next_start = None
+        for path in self._segments_between(start, end):
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError):
+                continue
+            with segment:
+                times = segment.times()
+                first = 0 if start is None else bisect.bisect_left(times, start)
+                stop = len(times) if end is None else bisect.bisect_left(times, end)
+                if first >= stop:
+                    continue
+                if limit is not None and count >= limit:
+                    next_start = times[first]
+                    break
+                if limit is not None and stop - first > limit - count:
+                    stop = first + limit - count
+                    next_start = times[stop]
+                for name, values in segment.read(first, stop, indexes).items():
+                    result[name].extend(values)
+                count += stop - first
+                if next_start is not None:
+                    break
+        return {'columns': result, 'count': count, 'next': next_start}
@@ -1,6 +1,7 @@
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from gpiozero import RotaryEncoder, Button, LED
+import pacemaker_hardware as hardware
+import pacemaker_http
 import time
 
 app = Flask(__name__)
@@ -8,15 +9,15 @@ CORS(app)  # Enable CORS for all routes
 
 
 
-rate_encoder = RotaryEncoder(27, 22, max_steps=200, wrap=False)
-a_output_encoder = RotaryEncoder(21, 20, max_steps=200, wrap=False)
-v_output_encoder = RotaryEncoder(13, 6, max_steps=200, wrap=False)
-mode_output_encoder = RotaryEncoder(10, 9, max_steps=200, wrap=False)
-lock_button = Button(17, bounce_time=0.05)
-up_button = Button(26, bounce_time=0.05)
-down_button = Button(16, bounce_time=0.05)
-left_button = Button(18, bounce_time=0.05)
-emergency_button = Button(23, bounce_time=0.05)
+rate_encoder = hardware.create_encoder('rate', 27, 22, max_steps=200, wrap=False)
+a_output_encoder = hardware.create_encoder('a_output', 21, 20, max_steps=200, wrap=False)
+v_output_encoder = hardware.create_encoder('v_output', 13, 6, max_steps=200, wrap=False)
+mode_output_encoder = hardware.create_encoder('mode', 10, 9, max_steps=200, wrap=False)
+lock_button = hardware.create_button('lock', 17, bounce_time=0.05)
+up_button = hardware.create_button('up', 26, bounce_time=0.05)
+down_button = hardware.create_button('down', 16, bounce_time=0.05)
+left_button = hardware.create_button('left', 18, bounce_time=0.05)
+emergency_button = hardware.create_button('emergency', 23, bounce_time=0.05)
 
 # Set up the Rate rotary encoder (pins defined as in your example)
 # rate_encoder = RotaryEncoder(27, 22, max_steps=200, wrap=False)
@@ -750,4 +751,5 @@ if __name__ == '__main__':
     print(f"Down button on pin GPIO 14")
     print(f"Left button on pin GPIO 8")
     print(f"Emergency DOO button on pin GPIO 23")
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    hardware.start_trace_from_env()
+    pacemaker_http.serve(app, '0.0.0.0', 5000)
\ No newline at end of file
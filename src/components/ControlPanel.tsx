@@ -17,7 +17,7 @@ import {
   EncoderControlData,
   getSensitivityDebug,
   resetEncoder,
-  getSensitivity
+  subscribeToState
 } from '../utils/encoderApi';
 
 
@@ -454,39 +454,16 @@ useEffect(() => {
   useEffect(() => {
     if (!encoderConnected) return;
     
-    // Create a dedicated function to fetch and update sensitivity values
-    const syncSensitivityValues = async () => {
-      try {
-        const sensitivity = await getSensitivity();
-        if (sensitivity) {
-          // Update the sensitivity values in the UI directly from hardware
-          if (sensitivity.a_sensitivity !== undefined) {
-            setDddSettings(prev => ({
-              ...prev,
-              aSensitivity: sensitivity.a_sensitivity
-            }));
-          }
-          
-          if (sensitivity.v_sensitivity !== undefined) {
-            setDddSettings(prev => ({
-              ...prev,
-              vSensitivity: sensitivity.v_sensitivity
-            }));
-            setVviSensitivity(sensitivity.v_sensitivity);
-          }
-        }
-      } catch (error) {
-        console.error('Failed to sync sensitivity values:', error);
-      }
-    };
-    
-    // Initial sync
-    syncSensitivityValues();
-    
-    // Set up periodic sync
-    const interval = setInterval(syncSensitivityValues, 200);
-    
-    return () => clearInterval(interval);
+    // Update the sensitivity values in the UI directly from hardware
+    // whenever the server pushes a change
+    return subscribeToState((state) => {
+      setDddSettings(prev => ({
+        ...prev,
+        aSensitivity: state.aSensitivity,
+        vSensitivity: state.vSensitivity
+      }));
+      setVviSensitivity(state.vSensitivity);
+    });
   }, [encoderConnected]);
     
   // Start encoder polling if connected
@@ -618,8 +595,8 @@ useEffect(() => {
         }
     
       },
-      // Poll interval
-      100,
+      // Health poll interval; values and button presses are pushed
+      1000,
       // Skip updates from these sources
       ['frontend']
     );
@@ -858,35 +835,24 @@ useEffect(() => {
   useEffect(() => {
     if (!encoderConnected) return;
     
-    const checkLockState = async () => {
-      try {
-        const lockState = await getLockState();
-        if (lockState !== null && lockState !== isLocked) {
-          setIsLocked(lockState);
-          
-          // If device just unlocked, reset the auto-lock timer
-          if (!lockState && autoLockTimer) {
-            resetAutoLockTimer();
-          }
-          
-          // If device just locked, clear any auto-lock timer
-          if (lockState && autoLockTimer) {
-            clearTimeout(autoLockTimer);
-            setAutoLockTimer(null);
-          }
+    // Lock state changes are pushed by the server as they happen
+    return subscribeToState((state) => {
+      const lockState = state.isLocked;
+      if (lockState !== isLocked) {
+        setIsLocked(lockState);
+        
+        // If device just unlocked, reset the auto-lock timer
+        if (!lockState && autoLockTimer) {
+          resetAutoLockTimer();
+        }
+        
+        // If device just locked, clear any auto-lock timer
+        if (lockState && autoLockTimer) {
+          clearTimeout(autoLockTimer);
+          setAutoLockTimer(null);
         }
-      } catch (error) {
-        console.error('Error checking lock state:', error);
       }
-    };
-    
-    // Initial check
-    checkLockState();
-    
-    // Check every 100ms for lock state changes
-    const interval = setInterval(checkLockState, 100);
-    
-    return () => clearInterval(interval);
+    });
   }, [encoderConnected, isLocked, autoLockTimer, resetAutoLockTimer]);
 
   // Toggle lock state
@@ -1,5 +1,5 @@
 import React, { useEffect, useCallback, useState } from 'react';
-import { updateControls } from '../utils/encoderApi';
+import { updateControls, subscribeToState } from '../utils/encoderApi';
 
 // Interface for the DDD Settings component
 interface DDDSettingsProps {
@@ -80,25 +80,13 @@ const DDDSettings: React.FC<DDDSettingsProps> = ({
   useEffect(() => {
     if (!encoderConnected) return;
     
-    const fetchDirectHardwareValues = async () => {
-      try {
-        const response = await fetch('http://raspberrypi.local:5000/api/sensitivity');
-        if (response.ok) {
-          const data = await response.json();
-          setHardwareValues({
-            a: data.a_sensitivity || 0,
-            v: data.v_sensitivity || 0
-          });
-        }
-      } catch (err) {
-        console.error('Error fetching direct sensitivity values:', err);
-      }
-    };
-    
-    fetchDirectHardwareValues();
-    const interval = setInterval(fetchDirectHardwareValues, 100);
-    
-    return () => clearInterval(interval);
+    // Sensitivity changes are pushed by the server as they happen
+    return subscribeToState((state) => {
+      setHardwareValues({
+        a: state.aSensitivity || 0,
+        v: state.vSensitivity || 0
+      });
+    });
   }, [encoderConnected]);
 
 
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import CircularControl from './CircularControl';
+import { subscribeToState, PacemakerState } from '../utils/encoderApi';
 
 interface HardwareAOutputControlProps {
   value: number;
@@ -17,33 +18,21 @@ const HardwareAOutputControl: React.FC<HardwareAOutputControlProps> = ({
   const [connectionStatus, setConnectionStatus] = useState('connecting');
   const [rotationCount, setRotationCount] = useState(0);
   
-  // Function to fetch the current encoder value from Raspberry Pi
-  const fetchAOutputFromHardware = async () => {
-    try {
-      const response = await fetch('http://raspberrypi.local:5000/api/a_output');
-      
-      if (response.ok) {
-        const data = await response.json();
-        // Only update if value has changed significantly (allowing for float precision issues)
-        if (Math.abs(data.value - value) > 0.05) {
-          if (isLocked) {
-            onLockError();
-          } else {
-            onChange(data.value);
-          }
-        }
-        setConnectionStatus('connected');
-        
-        // Also fetch hardware status occasionally to get rotation count
-        if (Math.random() < 0.1) { // ~10% chance per poll to reduce requests
-          fetchHardwareStatus();
-        }
+  // Apply a state update pushed from the Raspberry Pi
+  const handleHardwareState = (state: PacemakerState) => {
+    // Only update if value has changed significantly (allowing for float precision issues)
+    if (Math.abs(state.a_output - value) > 0.05) {
+      if (isLocked) {
+        onLockError();
       } else {
-        setConnectionStatus('error');
+        onChange(state.a_output);
       }
-    } catch (err) {
-      console.error('Error fetching A. Output:', err);
-      setConnectionStatus('error');
+    }
+    setConnectionStatus('connected');
+    
+    // Also fetch hardware status occasionally to get rotation count
+    if (Math.random() < 0.1) { // ~10% chance per update to reduce requests
+      fetchHardwareStatus();
     }
   };
   
@@ -78,15 +67,12 @@ const HardwareAOutputControl: React.FC<HardwareAOutputControlProps> = ({
     }
   };
   
-  // Set up polling to fetch the A. Output from hardware
+  // Subscribe to A. Output changes pushed from the hardware
   useEffect(() => {
-    // Initial fetch
-    fetchAOutputFromHardware();
-    
-    // Poll every 200ms
-    const intervalId = setInterval(fetchAOutputFromHardware, 200);
-    
-    return () => clearInterval(intervalId);
+    return subscribeToState(
+      handleHardwareState,
+      (connected) => setConnectionStatus(connected ? 'connected' : 'error')
+    );
   }, []);
   
   // Update hardware when the A. Output is changed in UI
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import CircularControl from './CircularControl';
+import { subscribeToState, PacemakerState } from '../utils/encoderApi';
 
 interface HardwareRateControlProps {
   value: number;
@@ -16,29 +17,17 @@ const HardwareRateControl: React.FC<HardwareRateControlProps> = ({
 }) => {
   const [connectionStatus, setConnectionStatus] = useState('connecting');
   
-  // Function to fetch the current encoder value from Raspberry Pi
-  const fetchRateFromHardware = async () => {
-    try {
-      const response = await fetch('http://raspberrypi.local:5000/api/rate');
-      
-      if (response.ok) {
-        const data = await response.json();
-        // Only update if value has changed
-        if (data.value !== value) {
-          if (isLocked) {
-            onLockError();
-          } else {
-            onChange(data.value);
-          }
-        }
-        setConnectionStatus('connected');
+  // Apply a state update pushed from the Raspberry Pi
+  const handleHardwareState = (state: PacemakerState) => {
+    // Only update if value has changed
+    if (state.rate !== value) {
+      if (isLocked) {
+        onLockError();
       } else {
-        setConnectionStatus('error');
+        onChange(state.rate);
       }
-    } catch (err) {
-      console.error('Error fetching rate:', err);
-      setConnectionStatus('error');
     }
+    setConnectionStatus('connected');
   };
   
   // Send rate changes back to the hardware
@@ -56,15 +45,12 @@ const HardwareRateControl: React.FC<HardwareRateControlProps> = ({
     }
   };
   
-  // Set up polling to fetch the rate from hardware
+  // Subscribe to rate changes pushed from the hardware
   useEffect(() => {
-    // Initial fetch
-    fetchRateFromHardware();
-    
-    // Poll every 200ms
-    const intervalId = setInterval(fetchRateFromHardware, 200);
-    
-    return () => clearInterval(intervalId);
+    return subscribeToState(
+      handleHardwareState,
+      (connected) => setConnectionStatus(connected ? 'connected' : 'error')
+    );
   }, []);
   
   // Update hardware when the rate is changed in UI
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import CircularControl from './CircularControl';
+import { subscribeToState, PacemakerState } from '../utils/encoderApi';
 
 interface HardwareVOutputControlProps {
   value: number;
@@ -16,29 +17,17 @@ const HardwareVOutputControl: React.FC<HardwareVOutputControlProps> = ({
 }) => {
   const [connectionStatus, setConnectionStatus] = useState('connecting');
   
-  // Function to fetch the current encoder value from Raspberry Pi
-  const fetchVOutputFromHardware = async () => {
-    try {
-      const response = await fetch('http://raspberrypi.local:5000/api/v_output');
-      
-      if (response.ok) {
-        const data = await response.json();
-        // Only update if value has changed
-        if (Math.abs(data.value - value) > 0.05) {
-          if (isLocked) {
-            onLockError();
-          } else {
-            onChange(data.value);
-          }
-        }
-        setConnectionStatus('connected');
+  // Apply a state update pushed from the Raspberry Pi
+  const handleHardwareState = (state: PacemakerState) => {
+    // Only update if value has changed
+    if (Math.abs(state.v_output - value) > 0.05) {
+      if (isLocked) {
+        onLockError();
       } else {
-        setConnectionStatus('error');
+        onChange(state.v_output);
       }
-    } catch (err) {
-      console.error('Error fetching V. Output:', err);
-      setConnectionStatus('error');
     }
+    setConnectionStatus('connected');
   };
   
   // Send V. Output changes back to the hardware
@@ -56,15 +45,12 @@ const HardwareVOutputControl: React.FC<HardwareVOutputControlProps> = ({
     }
   };
   
-  // Set up polling to fetch the V. Output from hardware
+  // Subscribe to V. Output changes pushed from the hardware
   useEffect(() => {
-    // Initial fetch
-    fetchVOutputFromHardware();
-    
-    // Poll every 200ms
-    const intervalId = setInterval(fetchVOutputFromHardware, 200);
-    
-    return () => clearInterval(intervalId);
+    return subscribeToState(
+      handleHardwareState,
+      (connected) => setConnectionStatus(connected ? 'connected' : 'error')
+    );
   }, []);
   
   // Update hardware when the V. Output is changed in UI
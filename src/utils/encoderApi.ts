@@ -13,6 +13,7 @@ export interface ApiStatus {
     emergency_pressed?: boolean;
   };
   encoder_active?: boolean;
+  events?: number;
   a_sensitivity?: number;
   v_sensitivity?: number;
   active_control?: string;
@@ -49,6 +50,21 @@ export interface EncoderControlData {
   v_sensitivity?: number;
 }
 
+// Full state as pushed by /api/stream and returned by /api/state
+export interface PacemakerState {
+  rate: number;
+  a_output: number;
+  v_output: number;
+  aSensitivity: number;
+  vSensitivity: number;
+  mode: number;
+  isLocked: boolean;
+  isPaused: boolean;
+  pauseTimeLeft: number;
+  batteryLevel: number;
+  lastUpdate: number;
+}
+
 // Base URL for API calls
 const apiBaseUrl = 'http://raspberrypi.local:5000/api';
 
@@ -142,89 +158,39 @@ export const getSensitivityDebug = async (): Promise<void> => {
 };
 
 // Update control values on the hardware
+// Everything goes in one request to /api/controls, which validates the whole
+// batch and applies it at once, so viewers never see a half-applied change
 export const updateControls = async (data: EncoderControlData): Promise<void> => {
+  const controls: Record<string, number | string> = {};
+  
+  if (data.rate !== undefined) controls.rate = data.rate;
+  if (data.a_output !== undefined) controls.a_output = data.a_output;
+  if (data.v_output !== undefined) controls.v_output = data.v_output;
+  if (data.a_sensitivity !== undefined) controls.a_sensitivity = data.a_sensitivity;
+  if (data.v_sensitivity !== undefined) controls.v_sensitivity = data.v_sensitivity;
+  if (data.active_control !== undefined) controls.active_control = data.active_control;
+  if (data.mode !== undefined) controls.mode = data.mode;
+  
+  if (Object.keys(controls).length === 0) return;
+  
   try {
-    const promises = [];
-    
-    if (data.rate !== undefined) {
-      promises.push(
-        fetch(`${getBaseUrl()}/rate/set`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ value: data.rate }),
-        }).then(handleApiError)
-      );
-    }
+    const response = await fetch(`${getBaseUrl()}/controls`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(controls),
+    });
     
-    if (data.a_output !== undefined) {
-      promises.push(
-        fetch(`${getBaseUrl()}/a_output/set`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ value: data.a_output }),
-        }).then(handleApiError)
-      );
+    // If we get a 403, it's likely because the device is locked
+    // Just log it for sensitivity-only changes rather than treating it as a fatal error
+    const sensitivityOnly = Object.keys(controls).every(key =>
+      ['a_sensitivity', 'v_sensitivity', 'active_control'].includes(key)
+    );
+    if (response.status === 403 && sensitivityOnly) {
+      console.log('Device locked - sensitivity update rejected');
+      return;
     }
     
-    if (data.v_output !== undefined) {
-      promises.push(
-        fetch(`${getBaseUrl()}/v_output/set`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ value: data.v_output }),
-        }).then(handleApiError)
-      );
-    }
-
-    // Handle sensitivity updates
-     // Modified sensitivity update logic with better error handling
-     if (data.a_sensitivity !== undefined || data.v_sensitivity !== undefined || data.active_control !== undefined) {
-      const sensitivityData: any = {};
-      
-      if (data.a_sensitivity !== undefined) {
-        sensitivityData.a_sensitivity = data.a_sensitivity;
-      }
-      
-      if (data.v_sensitivity !== undefined) {
-        sensitivityData.v_sensitivity = data.v_sensitivity;
-      }
-      
-      if (data.active_control !== undefined) {
-        sensitivityData.active_control = data.active_control;
-      }
-      
-      if (Object.keys(sensitivityData).length > 0) {
-        try {
-          const response = await fetch(`${getBaseUrl()}/sensitivity/set`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(sensitivityData),
-          });
-          
-          // If we get a 403, it's likely because the device is locked
-          // Just log it rather than treating it as a fatal error
-          if (response.status === 403) {
-            console.log('Device locked - sensitivity update rejected');
-          } else if (!response.ok) {
-            console.error(`Sensitivity update failed: ${response.status}`);
-          }
-        } catch (err) {
-          console.error('Error in sensitivity update:', err);
-        }
-      }
-    }
-
-    if (data.mode !== undefined) {
-      promises.push(
-        fetch(`${getBaseUrl()}/mode/set`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ mode: data.mode }),
-        }).then(handleApiError)
-      );
-    }
-    
-    await Promise.all(promises);
+    await handleApiError(response);
   } catch (error) {
     console.error('Error updating controls:', error);
     throw error;
@@ -328,21 +294,47 @@ export const updateSensitivityControlDebounced = debounce(
   100 // 100ms debounce time
 );
 
+// A hardware button gesture from /api/events: every press is 'pressed',
+// held up/down buttons 'repeat', and 'double'/'long' follow the server's
+// BUTTON_GESTURES table
+export interface ButtonEvent {
+  cursor: number;
+  time: number;
+  button: 'up' | 'down' | 'left' | 'emergency';
+  action: 'pressed' | 'repeat' | 'double' | 'long';
+}
+
+// An auto-repeat acts like another press, so held buttons scroll menus;
+// double and long presses get their own event, e.g. hardware-left-button-double
+const buttonEventName = (event: ButtonEvent) =>
+  `hardware-${event.button}-button-${event.action === 'repeat' ? 'pressed' : event.action}`;
+
 export const startEncoderPolling = (
   onDataUpdate: (data: EncoderControlData) => void,
   onStatusUpdate: (status: ApiStatus) => void,
-  pollInterval = 100,
+  pollInterval = 1000,
   ignoreUpdateSources: string[] = []
 ) => {
   let isPolling = true;
   
-  // Button state trackers to prevent duplicate events
-  let lastButtonStates = {
-    up: false,
-    down: false,
-    left: false,
-    emergency: false
-  };
+  // Control values and button presses are pushed by the server as they
+  // happen, so the health poll is only for the status and encoder activity
+  const stopState = subscribeToState((state) => {
+    onDataUpdate({
+      rate: state.rate,
+      a_output: state.a_output,
+      v_output: state.v_output,
+      locked: state.isLocked,
+      mode: state.mode,
+      a_sensitivity: state.aSensitivity,
+      v_sensitivity: state.vSensitivity
+    });
+  });
+  
+  const stopButtonEvents = subscribeToButtonEvents((event) => {
+    console.log(`Detected ${event.button.toUpperCase()} button ${event.action} from hardware`);
+    window.dispatchEvent(new CustomEvent(buttonEventName(event)));
+  });
   
   const pollHealth = async () => {
     if (!isPolling) return;
@@ -353,58 +345,6 @@ export const startEncoderPolling = (
       if (status) {
         // Update status data
         onStatusUpdate(status);
-        
-        // Extract control values and pass to data update handler
-        const controlData: EncoderControlData = {
-          rate: status.rate,
-          a_output: status.a_output,
-          v_output: status.v_output,
-          locked: status.locked,
-          mode: status.mode,
-          a_sensitivity: status.a_sensitivity,
-          v_sensitivity: status.v_sensitivity
-        };
-        
-        onDataUpdate(controlData);
-        
-        // Check for button presses - with guard against duplicate events
-        if (status.buttons) {
-          // Handle up button press - only trigger once per press
-          if (status.buttons.up_pressed && !lastButtonStates.up) {
-            console.log("Detected UP button press from hardware");
-            window.dispatchEvent(new CustomEvent('hardware-up-button-pressed'));
-            lastButtonStates.up = true;
-          } else if (!status.buttons.up_pressed && lastButtonStates.up) {
-            lastButtonStates.up = false; // Reset the state tracking
-          }
-          
-          // Handle down button press - only trigger once per press
-          if (status.buttons.down_pressed && !lastButtonStates.down) {
-            console.log("Detected DOWN button press from hardware");
-            window.dispatchEvent(new CustomEvent('hardware-down-button-pressed'));
-            lastButtonStates.down = true;
-          } else if (!status.buttons.down_pressed && lastButtonStates.down) {
-            lastButtonStates.down = false; // Reset the state tracking
-          }
-          
-          // Handle left button press - only trigger once per press
-          if (status.buttons.left_pressed && !lastButtonStates.left) {
-            console.log("Detected LEFT button press from hardware");
-            window.dispatchEvent(new CustomEvent('hardware-left-button-pressed'));
-            lastButtonStates.left = true;
-          } else if (!status.buttons.left_pressed && lastButtonStates.left) {
-            lastButtonStates.left = false; // Reset the state tracking
-          }
-          
-          // Handle emergency button press - only trigger once per press
-          if (status.buttons.emergency_pressed && !lastButtonStates.emergency) {
-            console.log("Detected EMERGENCY button press from hardware");
-            window.dispatchEvent(new CustomEvent('hardware-emergency-button-pressed'));
-            lastButtonStates.emergency = true;
-          } else if (!status.buttons.emergency_pressed && lastButtonStates.emergency) {
-            lastButtonStates.emergency = false; // Reset the state tracking
-          }
-        }
       }
     } catch (error) {
       console.error('Polling error:', error);
@@ -421,5 +361,148 @@ export const startEncoderPolling = (
   // Return a function to stop polling
   return () => {
     isPolling = false;
+    stopState();
+    stopButtonEvents();
   };
-};
\ No newline at end of file
+};
+
+// One EventSource shared by every subscriber. The server only pushes when the
+// state changes, and the browser reconnects on its own, resuming from the last
+// event id it saw. Button presses come over the same stream as 'button'
+// events, so a tab holds a single connection however much it listens to.
+type StateListener = {
+  onState: (state: PacemakerState) => void;
+  onConnectionChange?: (connected: boolean) => void;
+};
+
+let stateSource: EventSource | null = null;
+let lastState: PacemakerState | null = null;
+const stateListeners = new Set<StateListener>();
+const buttonListeners = new Set<(event: ButtonEvent) => void>();
+
+// Cursor of the last button event handled, kept across subscriptions so a
+// remounted panel neither replays old presses nor skips new ones
+let buttonCursor: number | null = null;
+// Pushed events held back while /api/events fills a gap, so order is kept
+let buttonBacklog: ButtonEvent[] | null = null;
+
+const deliverButtonEvent = (event: ButtonEvent) => {
+  if (buttonCursor !== null && event.cursor <= buttonCursor) return;
+  buttonCursor = event.cursor;
+  buttonListeners.forEach(l => l(event));
+};
+
+// Fetch what the stream can't replay: the presses missed while disconnected,
+// or in a gap in the pushed cursors. Without a cursor yet, just learn the
+// current one. pending are pushed events to deliver after the fetched ones
+const catchUpButtonEvents = async (pending: ButtonEvent[] = []) => {
+  if (buttonBacklog) {
+    buttonBacklog.push(...pending);
+    return;
+  }
+  buttonBacklog = pending;
+  try {
+    const query = buttonCursor === null ? '' : `?since=${buttonCursor}`;
+    const response = await fetch(`${getBaseUrl()}/events${query}`, {
+      headers: { 'Accept': 'application/json' }
+    });
+    if (!response.ok) {
+      throw new Error(`Server responded with ${response.status}`);
+    }
+    const data: { events: ButtonEvent[]; next: number; missed: number } = await response.json();
+    if (data.missed > 0) {
+      console.warn(`Missed ${data.missed} button events`);
+    }
+    if (buttonCursor === null || data.next < buttonCursor) {
+      // First connection, or the server restarted and its cursor with it
+      buttonCursor = data.events.length ? data.events[0].cursor - 1 : data.next;
+    }
+    data.events.forEach(deliverButtonEvent);
+  } catch (error) {
+    console.error('Button event catch-up error:', error);
+  } finally {
+    const backlog = buttonBacklog ?? [];
+    buttonBacklog = null;
+    backlog.forEach(deliverButtonEvent);
+  }
+};
+
+const openStream = () => {
+  if (stateSource) return;
+  stateSource = new EventSource(`${getBaseUrl()}/stream`);
+
+  stateSource.addEventListener('state', (event) => {
+    lastState = JSON.parse((event as MessageEvent).data);
+    stateListeners.forEach(l => l.onState(lastState!));
+  });
+
+  stateSource.addEventListener('button', (event) => {
+    const press: ButtonEvent = JSON.parse((event as MessageEvent).data);
+    if (buttonBacklog) {
+      buttonBacklog.push(press);
+    } else if (buttonCursor !== null && press.cursor > buttonCursor + 1) {
+      catchUpButtonEvents([press]);
+    } else {
+      deliverButtonEvent(press);
+    }
+  });
+
+  stateSource.onopen = () => {
+    stateListeners.forEach(l => l.onConnectionChange?.(true));
+    if (buttonListeners.size > 0) {
+      catchUpButtonEvents();
+    }
+  };
+
+  stateSource.onerror = () => {
+    stateListeners.forEach(l => l.onConnectionChange?.(false));
+  };
+};
+
+// The stream closes with the last subscriber of either kind
+const closeStreamIfUnused = () => {
+  if (stateListeners.size === 0 && buttonListeners.size === 0 && stateSource) {
+    stateSource.close();
+    stateSource = null;
+    lastState = null;
+  }
+};
+
+export const subscribeToState = (
+  onState: (state: PacemakerState) => void,
+  onConnectionChange?: (connected: boolean) => void
+): (() => void) => {
+  const listener: StateListener = { onState, onConnectionChange };
+  stateListeners.add(listener);
+
+  if (!stateSource) {
+    openStream();
+  } else if (lastState) {
+    // Late subscribers get the current state straight away
+    onState(lastState);
+  }
+
+  // Return a function to unsubscribe
+  return () => {
+    stateListeners.delete(listener);
+    closeStreamIfUnused();
+  };
+};
+
+// Every hardware button event once, in order, from the shared stream
+export const subscribeToButtonEvents = (
+  onEvent: (event: ButtonEvent) => void
+): (() => void) => {
+  buttonListeners.add(onEvent);
+  if (!stateSource) {
+    openStream();
+  } else if (stateSource.readyState === EventSource.OPEN) {
+    // Already connected: fill in anything pressed since the last subscriber left
+    catchUpButtonEvents();
+  }
+
+  return () => {
+    buttonListeners.delete(onEvent);
+    closeStreamIfUnused();
+  };
+};